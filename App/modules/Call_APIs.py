@@ -11,6 +11,10 @@ import pytz # Timezones
 from modules.Database.Queries import Sensor as sensor_query
 from modules.Database.Queries import Alert as alert_query
 
+# Sensor Functions
+
+import modules.Sensors.Sensor_Functions as sensors
+
 # Data Manipulation
 
 import numpy as np
@@ -19,6 +23,17 @@ import pandas as pd
 # Importing Libraries
 from importlib import import_module
 
+# Concurrency
+
+import os
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Messaging management when a monitor fails
+
+from modules.Users.Send_Messages import Message_mgmt
+
 ## Workflow
 
 def workflow(runtime, timezone):
@@ -30,10 +45,12 @@ def workflow(runtime, timezone):
     sensors_df fields are:
 
     sensor_id - int - our unique identifier
+    sensor_type - str - our sensor_type identifier
     current_reading - float - the raw sensor value
     update_frequency - int - frequency this sensor is updated (in minutes)
     pollutant - str - abbreviated name of pollutant sensor reads
     metric - str - unit to append to readings
+    health_code - int - current_reading related to current health benchmarks (index in Sensor_Functions.health_descriptors, -1 = no reading)
     health_descriptor - str - current_reading related to current health benchmarks
     radius_meters - int - max distance sensor is relevant
     is_flagged - binary - is the sensor flagged?
@@ -43,8 +60,8 @@ def workflow(runtime, timezone):
     
     # 0 - Initialize storage of above
 
-    sensors_df = pd.DataFrame(columns = ['sensor_id', 'current_reading', 'update_frequency',
-                              'pollutant', 'metric', 'health_descriptor',
+    sensors_df = pd.DataFrame(columns = ['sensor_id', 'sensor_type', 'current_reading', 'update_frequency',
+                              'pollutant', 'metric',
                               'radius_meters', 'is_flagged']
                              )
 
@@ -70,6 +87,8 @@ def workflow(runtime, timezone):
     # 2 - Query all the apis (if they have a type in 1.d)
 
     sensor_api_dict = sensor_query.Get_Sensor_APIs_Information() # information on the different types of apis/monitors/sensors
+    
+    monitor_calls = [] # List of tuples (api_name, monitor_name, monitor_dict, monitor_api_df, sensor_types) to call
 
     for api_name in sensor_api_dict:
 
@@ -90,18 +109,22 @@ def workflow(runtime, timezone):
                 # 2.a - Select from api_df (1.a)
                 
                 monitor_api_df = api_df[api_df.sensor_type.isin(monitor_sensor_types_to_update)] # Select from greater api df
-            
-                # Get the module name
-                module = f'modules.Sensors.APIs.{api_name}.{monitor_name}.Regular_Update'
-    
-                # 2.b Call APIs for a regular update
-                temp_sensors_df = import_module(module).Workflow(monitor_dict, monitor_api_df,
-                                             timezone) # Run Regular Update code for monitor
-                                             
-                # Concatenate to sensors_df
-                sensors_df = pd.concat([sensors_df.astype(temp_sensors_df.dtypes), # if not sensors_df.empty else None,
-                                    temp_sensors_df.astype(sensors_df.dtypes)],
-                                    ignore_index = True)
+                
+                monitor_calls += [(api_name, monitor_name, monitor_dict, monitor_api_df, monitor_sensor_types_to_update)]
+                
+    # 2.b Call APIs for a regular update (all monitors at once)
+    
+    monitor_dfs, failed_sensor_types = Call_monitors(monitor_calls, timezone)
+    
+    # Sensor types that failed to update will be tried again next regular update
+    
+    sensor_types_to_update = sensor_types_to_update - failed_sensor_types
+    
+    # Concatenate to sensors_df (once)
+    
+    if len(monitor_dfs) > 0:
+    
+        sensors_df = pd.concat(monitor_dfs, ignore_index = True)
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # Check if there was any to update
@@ -109,8 +132,171 @@ def workflow(runtime, timezone):
     if len(sensors_df) > 0:
     
         sensors_df = sensors_df.copy()
+        
+        # 3 - Classify every reading into health codes/descriptors (all sensor types in one pass)
+        
+        thresholds_dict = sensors.Get_thresholds_dict(sensor_api_dict)
+        
+        sensors_df['health_code'] = sensors.Classify_Health_Codes(sensors_df.current_reading,
+                                                                  sensors_df.sensor_type,
+                                                                  thresholds_dict)
+        sensors_df['health_descriptor'] = sensors.Health_Codes_to_Descriptors(sensors_df.health_code)
     
     else:
         print('\n~~~\nWarning: No sensors in database to update. \n\nPlease wait a little longer for a regular update\nor conduct a daily update to pull new sensors from APIs\n~~~\n')
 
     return sensors_df, sensor_types_to_update
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+_running = {} # {(api_name, monitor_name) : future} of monitor calls that haven't finished (maybe hung from an earlier cycle)
+_failing = set() # (api_name, monitor_name) of monitors that failed last time they were called (management was told)
+
+def Report_monitor(api_name, monitor_name, problem = None):
+    '''
+    Prints a monitor's problem, and messages management once at the start of a failing streak (and when it recovers)
+    
+    problem - string - what went wrong (None = the monitor worked)
+    '''
+    
+    key = (api_name, monitor_name)
+    
+    if problem is None:
+    
+        if key in _failing:
+            _failing.discard(key)
+            message = f'SpikeAlerts: {api_name} {monitor_name} is working again'
+        else:
+            return
+    
+    else:
+        print(f'\n~~~\nWarning: {api_name} {monitor_name} {problem}. Skipping until next regular update\n~~~\n')
+        
+        if key in _failing:
+            return
+            
+        _failing.add(key)
+        message = f'SpikeAlerts: {api_name} {monitor_name} {problem}. Its sensors are skipped until it works again'
+    
+    try:
+        Message_mgmt(message)
+        
+    except Exception as e:
+        print(f'\n~~~\nWarning: Could not message management ({e})\n~~~\n')
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Call_monitors(monitor_calls, timezone):
+    '''
+    Runs the Regular_Update.Workflow of each monitor concurrently (in a thread pool)
+    so the time to call every api is about that of the slowest one (not the sum of them all)
+    
+    Configured in the .env file with
+    
+    API_MAX_WORKERS - int - the most monitors to call at once (default 4)
+    API_TIMEOUT - int - seconds to wait for each monitor (from when its call starts) before giving up on it this regular update (default 120)
+    
+    A monitor that errors or times out is reported to management once per failing streak (see Report_monitor).
+    Threads can't be stopped, so a monitor whose last call is still running (hung) isn't called again until it finishes
+    
+    parameters:
+    
+    monitor_calls - list of tuples (api_name, monitor_name, monitor_dict, monitor_api_df, sensor_types)
+    timezone - string - a timezone for pytz
+    
+    returns monitor_dfs (list of sensors_df from each monitor that finished),
+            failed_sensor_types (set of sensor_types from monitors that errored, timed out, or are still running)
+    '''
+    
+    monitor_dfs = []
+    failed_sensor_types = set()
+    
+    if len(monitor_calls) == 0:
+        return monitor_dfs, failed_sensor_types
+    
+    max_workers = int(os.getenv('API_MAX_WORKERS', 4))
+    timeout = float(os.getenv('API_TIMEOUT', 120))
+    
+    n_workers = min(max_workers, len(monitor_calls)) # The executor's real size
+    
+    executor = ThreadPoolExecutor(max_workers = n_workers)
+    
+    started = {} # {(api_name, monitor_name) : time.monotonic() when its call started}
+    
+    def Timed(future_key, workflow, *args):
+        started[future_key] = time.monotonic()
+        return workflow(*args)
+    
+    futures = {}
+    
+    for api_name, monitor_name, monitor_dict, monitor_api_df, sensor_types in monitor_calls:
+    
+        key = (api_name, monitor_name)
+        
+        # Still running from an earlier cycle?
+        
+        if key in _running and not _running[key].done():
+            Report_monitor(api_name, monitor_name, 'is still running from an earlier regular update')
+            failed_sensor_types.update(sensor_types)
+            continue
+    
+        # Get the module name
+        module = f'modules.Sensors.APIs.{api_name}.{monitor_name}.Regular_Update'
+        
+        future = executor.submit(Timed, key, import_module(module).Workflow, monitor_dict, monitor_api_df,
+                                 timezone) # Run Regular Update code for monitor
+        
+        _running[key] = future
+        futures[future] = (api_name, monitor_name, sensor_types)
+        
+    # Wait for each monitor until it finishes or has run for timeout seconds (from when its call started)
+    # Calls still queued (eg. behind hung monitors) give up after the time every worker could have used
+    
+    pending = set(futures)
+    
+    queued_deadline = time.monotonic() + timeout * math.ceil(len(futures) / n_workers)
+    
+    def Deadline(future):
+        key = futures[future][:2]
+        return started[key] + timeout if key in started else queued_deadline
+    
+    while len(pending) > 0:
+    
+        now = time.monotonic()
+        
+        for future in list(pending):
+        
+            api_name, monitor_name, sensor_types = futures[future]
+            key = (api_name, monitor_name)
+            
+            if future.done():
+            
+                pending.discard(future)
+                
+                try:
+                    temp_sensors_df = future.result()
+                    
+                    if len(temp_sensors_df) > 0:
+                        monitor_dfs += [temp_sensors_df]
+                        
+                    Report_monitor(api_name, monitor_name)
+                    
+                except Exception as e:
+                    Report_monitor(api_name, monitor_name, f'failed ({e})')
+                    failed_sensor_types.update(sensor_types)
+                    
+            elif now > Deadline(future):
+            
+                pending.discard(future)
+                Report_monitor(api_name, monitor_name, f'did not respond within {timeout:g} seconds')
+                failed_sensor_types.update(sensor_types)
+                
+        if len(pending) > 0:
+        
+            wait_seconds = max(min(Deadline(future) for future in pending) - time.monotonic(), 0)
+            
+            wait(pending, timeout = wait_seconds, return_when = FIRST_COMPLETED)
+            
+    executor.shutdown(wait = False, cancel_futures = True) # Don't wait on monitors that timed out (see _running)
+            
+    return monitor_dfs, failed_sensor_types
@@ -9,6 +9,7 @@ import pytz # Timezones
 
 # from modules import Basic_PSQL as psql
 from modules.POIs import POI_Functions as poi
+from modules.POIs import POI_Index as poi_index
 from modules.Sensors import Sensor_Functions as sensors
 from modules.Database.Queries import Sensor as sensor_queries
 from modules.Database.Queries import General as query
@@ -75,7 +76,11 @@ def workflow(base_config, next_update_time):
 
         # Update the Points of Interest
         
-        poi.Update_POIs_active(base_config['EPSG_CODE'])
+        poi.Sync_projected_geometry(base_config['EPSG_CODE']) # Catch anything the triggers missed (eg. EPSG_CODE changed)
+        poi.Update_POIs_active()
+        
+        if base_config.get('POI_ENGINE') == 'memory':
+            poi_index.Build_index() # New/moved/inactive POIs
         
 #         # Update "Sign Up Information" from REDCap - See Daily_Updates.py
 
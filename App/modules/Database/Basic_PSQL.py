@@ -2,71 +2,478 @@
 
 ## Load modules
 
+import io # For streaming dataframes to COPY
+import itertools # For naming staging tables
+import sys # For finding who made a database call
+import threading # The pool is shared by every thread of this process
+import time # For timing connection checkouts
+from contextlib import contextmanager
+
+import numpy as np # For writing arrays to COPY
+import pandas as pd
+
 import psycopg2
 from psycopg2 import sql
-from modules.Database.db_conn import pg_connection_dict # Our database connection dictionary for psycopg2
+from psycopg2 import pool as pg_pool
+from psycopg2 import extensions as pg_extensions
+from psycopg2 import extras as pg_extras
+from modules.Database.db_conn import pg_connection_dict, pool_config # Our database connection dictionary for psycopg2 & pool settings
+from modules import Metrics as metrics # Timing of every call
 
 # ~~~~~~~~~~~~~~
 
-def send_update(cmd):
+# Connection Pool
+
+# Every query helper below borrows a long-lived connection from one process-wide pool
+# instead of opening (and authenticating) a new connection for each command
+
+# ~~~~~~~~~~~~~~
+
+_pool = None # The psycopg2 ThreadedConnectionPool (created on first use)
+_pool_lock = threading.Lock() # Guards creation of the pool
+_pool_slots = threading.BoundedSemaphore(pool_config['maxconn']) # Borrowers wait here when every connection is checked out
+
+pool_stats = {'checkouts' : 0, # Number of connections borrowed
+              'wait_seconds' : 0.0, # Total time spent waiting for a free connection
+              'max_wait_seconds' : 0.0, # Longest single wait
+              'reconnects' : 0 # Connections discarded as broken and replaced
+              }
+_stats_lock = threading.Lock()
+
+ping_after_seconds = 30 # Check that a connection idle this long still works (SELECT 1) before handing it out
+_last_used = {} # {id(conn) : time.monotonic() it was handed back}
+
+def Get_pool():
     '''
-    Takes a command (sql.SQL() string) and pg_connection_dict
-    Sends the command to postgres
-    And closes connection
+    Returns the process-wide connection pool, creating it on first use
     '''
+
+    global _pool
+
+    with _pool_lock:
+
+        if _pool is None or _pool.closed:
+
+            _pool = pg_pool.ThreadedConnectionPool(pool_config['minconn'],
+                                                   pool_config['maxconn'],
+                                                   **pg_connection_dict,
+                                                   keepalives_idle = pool_config['keepalives_idle'])
+
+    return _pool
+
+# ~~~~~~~~~~~~~~
+
+def Close_pool():
+    '''
+    Closes every connection in the pool (the next query will open a new pool)
+    '''
+
+    global _pool
+
+    with _pool_lock:
+
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+
+        _pool = None
+
+# ~~~~~~~~~~~~~~
+
+def Get_pool_stats(reset = False):
+    '''
+    Returns a copy of the pool counters (checkouts, wait_seconds, max_wait_seconds, reconnects)
+
+    reset - boolean - set the counters back to zero afterwards (eg. once per regular update)
+    '''
+
+    with _stats_lock:
+
+        stats = dict(pool_stats)
+
+        if reset:
+            for key in pool_stats:
+                pool_stats[key] = type(pool_stats[key])(0)
+
+    return stats
+
+# ~~~~~~~~~~~~~~
+
+def _is_healthy(conn):
+    '''
+    Health check for a pooled connection - is it open and not stuck in a broken transaction?
+    '''
+
+    if conn.closed:
+        return False
+
+    status = conn.get_transaction_status()
+
+    if status == pg_extensions.TRANSACTION_STATUS_UNKNOWN: # Server connection lost
+        return False
+
+    if status != pg_extensions.TRANSACTION_STATUS_IDLE: # Left over transaction, start fresh
+        conn.rollback()
+
+    # A connection that sat idle may have been dropped (eg. database restart) without us noticing yet -
+    # find out now, before any of the caller's statements are sent
+
+    if time.monotonic() - _last_used.get(id(conn), 0) > ping_after_seconds:
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1;')
+            conn.rollback()
+
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    return True
+
+# ~~~~~~~~~~~~~~
+
+def _checkout():
+    '''
+    Borrows a healthy connection from the pool (waits if all are in use)
+    '''
+
+    start = time.perf_counter()
+    _pool_slots.acquire()
+    waited = time.perf_counter() - start
+
+    try:
+        pool = Get_pool()
+        conn = pool.getconn()
+
+        if not _is_healthy(conn): # Replace broken connections
+            _last_used.pop(id(conn), None)
+            pool.putconn(conn, close = True)
+            conn = pool.getconn()
+
+            with _stats_lock:
+                pool_stats['reconnects'] += 1
+
+    except Exception:
+        _pool_slots.release()
+        raise
+
+    with _stats_lock:
+        pool_stats['checkouts'] += 1
+        pool_stats['wait_seconds'] += waited
+        pool_stats['max_wait_seconds'] = max(pool_stats['max_wait_seconds'], waited)
+
+    return conn
+
+# ~~~~~~~~~~~~~~
+
+def _checkin(conn, broken = False):
+    '''
+    Returns a connection to the pool (closing it if broken)
+    '''
+
+    close = (broken or conn.closed != 0)
+
+    if close:
+        _last_used.pop(id(conn), None)
+    else:
+        _last_used[id(conn)] = time.monotonic()
+
+    try:
+        Get_pool().putconn(conn, close = close)
+    finally:
+        _pool_slots.release()
+
+# ~~~~~~~~~~~~~~
+
+@contextmanager
+def connection():
+    '''
+    Borrow a connection from the pool for a block of work, eg.
+
+    with psql.connection() as conn:
+        cur = conn.cursor()
+        ...
+
+    Commits when the block finishes, rolls back if it raises,
+    and always hands the connection back to the pool
+
+    Inside a cycle_transaction() the cycle's connection is used instead
+    and nothing is committed until the cycle finishes
+    '''
+
+    if in_cycle_transaction():
+        yield _cycle.conn
+        return
+
+    conn = _checkout()
+    broken = False
+
+    try:
+        yield conn
+        conn.commit()
+
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        broken = (e.pgcode is None) # Don't give a dead connection back to the pool
+        if not broken:
+            conn.rollback()
+        raise
+
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+
+    finally:
+        _checkin(conn, broken)
+
+# ~~~~~~~~~~~~~~
+
+# Cycle Unit of Work
+
+# One regular update (see modules/MAIN.py) runs all of its statements in one transaction
+# So it commits once, or rolls back entirely if any step fails (no half-applied cycles)
+
+# ~~~~~~~~~~~~~~
+
+_cycle = threading.local() # The cycle's connection (per thread)
+
+def in_cycle_transaction():
+    '''
+    Are we inside a cycle_transaction() on this thread?
+    '''
+
+    return getattr(_cycle, 'conn', None) is not None
+
+# ~~~~~~~~~~~~~~
+
+@contextmanager
+def cycle_transaction():
+    '''
+    Run a block of workflows as ONE database transaction, eg.
+
+    with psql.cycle_transaction():
+        Update_Sensor_Tables.workflow(...)
+        Update_Alert_Tables.workflow(...)
+
+    Every send_update/get_response/update_table/insert_into inside the block
+    (on this thread) shares one pooled connection and nothing is committed until the block ends.
+    If anything raises, the whole block is rolled back.
+
+    Nested calls join the outer transaction
+    '''
+
+    if in_cycle_transaction(): # Already in a cycle
+        yield _cycle.conn
+        return
+
+    conn = _checkout()
+    broken = False
+    _cycle.conn = conn
+
+    try:
+        yield conn
+        conn.commit()
+
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        broken = (e.pgcode is None)
+        if not broken:
+            conn.rollback()
+        raise
+
+    except BaseException:
+        if not conn.closed:
+            conn.rollback()
+        raise
+
+    finally:
+        _cycle.conn = None
+        _checkin(conn, broken)
+
+# ~~~~~~~~~~~~~~
+
+class Metered_cursor(pg_extensions.cursor):
+    '''
+    A cursor that counts the statements it sends (round trips) and the rows they return or change
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_trips = 0
+        self.rows = 0
+
+    def execute(self, query, vars = None):
+        result = super().execute(query, vars)
+        self._count()
+        return result
+
+    def executemany(self, query, vars_list):
+        result = super().executemany(query, vars_list)
+        self._count()
+        return result
+
+    def copy_expert(self, sql, file, size = 8192):
+        result = super().copy_expert(sql, file, size)
+        self._count()
+        return result
+
+    def _count(self):
+        self.round_trips += 1
+        self.rows += max(self.rowcount, 0)
+
+def _caller():
+    '''
+    The first function outside of this module on the stack, eg. 'Update_Alert_Tables.Apply_alert_transitions'
+    '''
+
+    frame = sys._getframe(1)
+
+    while frame is not None and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+
+    if frame is None:
+        return 'unknown'
+
+    return frame.f_globals.get('__name__', '').split('.')[-1] + '.' + frame.f_code.co_name
+
+# ~~~~~~~~~~~~~~
+
+def _run(work, retries = 1):
+    '''
+    Runs work(cursor) on a pooled connection and returns its result
+
+    If the connection dropped (eg. database restart) before the statement was sent, it reconnects and retries
+    (not inside a cycle_transaction - the whole cycle has to be redone)
     
-    # Create connection with postgres option keepalives_idle = 1 seconds
-    conn = psycopg2.connect(**pg_connection_dict, 
-                            keepalives_idle=1)
-    
-    # Create cursor
-    cur = conn.cursor()
-    
-    cur.execute(cmd) # Execute
-    
-    conn.commit() # Committ command
-    
-    # Close cursor
-    cur.close()
-    # Close connection
-    conn.close()
-    
+    Once work has started it is never retried - the server may have run (or even committed) it already,
+    and running statements like inserts again would duplicate them
     
+    Each call's time, round trips, and rows are recorded (see modules/Metrics.py)
+    '''
+
+    if in_cycle_transaction():
+        retries = 0
+
+    for attempt in range(retries + 1):
+
+        sent = False # Has work started sending statements?
+
+        try:
+            with connection() as conn:
+                with conn.cursor(cursor_factory = Metered_cursor) as cur:
+                    start = time.perf_counter()
+                    sent = True
+                    try:
+                        return work(cur)
+                    finally:
+                        metrics.Record_query(_caller(), time.perf_counter() - start, cur.round_trips, cur.rows)
+
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+
+            if attempt == retries or e.pgcode is not None or sent: # Only retry lost connections (no server error code) before sending
+                raise
+
+            with _stats_lock:
+                pool_stats['reconnects'] += 1
+
+# ~~~~~~~~~~~~~~
+
+def send_update(cmd):
+    '''
+    Takes a command (sql.SQL() string)
+    Sends the command to postgres on a pooled connection
+    And commits
+    '''
+
+    _run(lambda cur: cur.execute(cmd))
+
+
 # ~~~~~~~~~~~~~~
 
 def get_response(cmd):
     '''
-    Takes a command (sql.SQL() string) and pg_connection_dict
-    Sends the command to postgres
+    Takes a command (sql.SQL() string)
+    Sends the command to postgres on a pooled connection
     Retrieves the response
-    And closes connection
+    And commits
     '''
-    
-    # Create connection with postgres option keepalives_idle = 30 seconds
-    conn = psycopg2.connect(**pg_connection_dict, 
-                            keepalives_idle=30)
-    
-    # Create cursor
-    cur = conn.cursor()
-    
-    cur.execute(cmd) # Execute
-    
-    conn.commit() # Committ command
-    
-    # Fetch Response
-    
-    response = cur.fetchall()
-    
-    # Close cursor
-    cur.close()
-    # Close connection
-    conn.close()
-    
+
+    def work(cur):
+        cur.execute(cmd) # Execute
+        return cur.fetchall() # Fetch Response
+
+    response = _run(work)
+
     return response
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def update_table(correct_df, tablename, unique_identifier):
+def execute_values(cmd, records, template = None, fetch = False):
+    '''
+    Sends a command with a single VALUES %s placeholder and many rows in ONE round trip
+    (psycopg2.extras.execute_values with a page large enough for every record)
+
+    cmd - sql.SQL() string containing VALUES %s
+    records - list of tuples
+    template - optional sql.SQL() string for one row, eg. (%s::int, %s::float)
+    fetch - boolean - return the response?
+
+    Commits, returns the response (list of tuples) if fetch = True
+    '''
+
+    def work(cur):
+
+        cmd_string = cmd.as_string(cur.connection) if isinstance(cmd, sql.Composable) else cmd
+        row_template = template.as_string(cur.connection) if isinstance(template, sql.Composable) else template
+
+        response = pg_extras.execute_values(cur, cmd_string, records,
+                                            template = row_template,
+                                            page_size = max(len(records), 1),
+                                            fetch = fetch)
+        return response
+
+    return _run(work, retries = 0)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+_staging_ids = itertools.count() # Unique names for staging tables
+_column_types = {} # Cache of {tablename : {column : postgres type}}
+
+def Get_column_types(tablename):
+    '''
+    Gets the postgres type of each column of a table (eg. {'sensor_id' : 'integer', 'last_seen' : 'timestamp without time zone'})
+
+    Cached after the first call - used to cast bulk uploads to the right types
+    '''
+
+    if tablename not in _column_types:
+
+        cmd = sql.SQL('''SELECT attname, format_type(atttypid, atttypmod)
+        FROM pg_attribute
+        WHERE attrelid = to_regclass({})
+        AND attnum > 0
+        AND NOT attisdropped;
+        ''').format(sql.Literal(f'"{tablename}"'))
+
+        response = get_response(cmd)
+
+        _column_types[tablename] = dict(response)
+
+    return _column_types[tablename]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def df_to_records(df):
+    '''
+    Converts a dataframe into a list of tuples of python values for psycopg2
+    (numpy scalars -> python scalars, NaN/NaT/NA -> None)
+    '''
+
+    records = df.astype(object).where(df.notna(), None).itertuples(index = False, name = None)
+
+    return list(records)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def update_table(correct_df, tablename, unique_identifier, bulk = True):
     '''
     Updates any fields in our database to match the input dataframe
 
@@ -75,90 +482,196 @@ def update_table(correct_df, tablename, unique_identifier):
     correct_df - pd.dataframe with well formatted data for database
     tablename - table in database
     unique_identifier - string of the unique identifier field
+    bulk - boolean - send the whole dataframe as one UPDATE ... FROM (VALUES ...) in one transaction
+            (False = the original statement & commit per row)
     '''
-    # Create connection with postgres option keepalives_idle = 100 seconds
-    conn = psycopg2.connect(**pg_connection_dict, 
-                            keepalives_idle=100)
-    
-    # Create cursor
-    cur = conn.cursor()
-    
-    cols_to_update = set(correct_df.columns.to_list()) - {unique_identifier}
-    
-    for i, row in correct_df.iterrows():
 
-        cmd = sql.SQL(f'UPDATE "{tablename}" SET ')
+    if len(correct_df) == 0:
+        return
 
-        for i, col in enumerate(cols_to_update):
-            
-            if i > 0:
-                cmd += sql.SQL(',') # Comma separated name-value pairs
-                
-            cmd += sql.SQL('{} = {}').format(sql.Identifier(col),
-                                             sql.Literal(row[col]))
+    cols_to_update = [col for col in correct_df.columns if col != unique_identifier]
 
-        cmd += sql.SQL(' WHERE {} = {};').format(sql.Identifier(unique_identifier),
-                                                 sql.Literal(row[unique_identifier]))
+    if bulk:
 
-        # Execute command
-        cur.execute(cmd)
-    
-        conn.commit() # Commit command
-    
-    # Close cursor
-    cur.close()
-    # Close connection
-    conn.close()
+        # Every value is cast to the type of its column in the table
+        # So strings like '2023-12-01 00:00:00' land in timestamps, None in any column, etc.
+
+        column_types = Get_column_types(tablename)
+        fields = [unique_identifier] + cols_to_update
+
+        template = sql.SQL('({})').format(sql.SQL(', ').join(
+            sql.SQL('%s::{}').format(sql.SQL(column_types[field])) for field in fields))
+
+        cmd = sql.SQL('''UPDATE {} AS t
+        SET {}
+        FROM (VALUES %s) AS v ({})
+        WHERE t.{} = v.{};
+        ''').format(sql.Identifier(tablename),
+                    sql.SQL(', ').join(sql.SQL('{} = v.{}').format(sql.Identifier(col), sql.Identifier(col))
+                                       for col in cols_to_update),
+                    sql.SQL(', ').join(map(sql.Identifier, fields)),
+                    sql.Identifier(unique_identifier),
+                    sql.Identifier(unique_identifier))
+
+        execute_values(cmd, df_to_records(correct_df[fields]), template)
+
+        return
+
+    def work(cur):
+
+        for i, row in correct_df.iterrows():
+
+            cmd = sql.SQL(f'UPDATE "{tablename}" SET ')
+
+            for i, col in enumerate(cols_to_update):
+
+                if i > 0:
+                    cmd += sql.SQL(',') # Comma separated name-value pairs
+
+                cmd += sql.SQL('{} = {}').format(sql.Identifier(col),
+                                                 sql.Literal(row[col]))
+
+            cmd += sql.SQL(' WHERE {} = {};').format(sql.Identifier(unique_identifier),
+                                                     sql.Literal(row[unique_identifier]))
+
+            # Execute command
+            cur.execute(cmd)
+
+            if not in_cycle_transaction():
+                cur.connection.commit() # Commit command
+
+    _run(work, retries = 0)
 
 # # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def insert_into(df, tablename, is_spatial = False):
+def _array_literal(value):
+    '''
+    A list/tuple/array as a postgres array literal for COPY (eg. [1, 2] -> {1,2}, ['a b', None] -> {"a b",NULL})
+    Missing values are returned as None
     '''
-    Takes a well formatted dataframe, df,  
+
+    if value is None or (np.ndim(value) == 0 and pd.isna(value)):
+        return None
+
+    elements = []
+
+    for element in value:
+
+        if isinstance(element, (list, tuple, np.ndarray)):
+            elements += [_array_literal(element)]
+        elif element is None or pd.isna(element):
+            elements += ['NULL']
+        elif isinstance(element, (bool, np.bool_)):
+            elements += ['t' if element else 'f']
+        elif isinstance(element, (int, float, np.integer, np.floating)):
+            elements += [str(element)]
+        else:
+            elements += ['"' + str(element).replace('\\', '\\\\').replace('"', '\\"') + '"']
+
+    return '{' + ','.join(elements) + '}'
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def insert_into(df, tablename, is_spatial = False, returning = None):
+    '''
+    Takes a well formatted dataframe, df,
         with the columns aligned to the fields of a table in the database (tablename)
-    as well as pg_connection_dict
-    Inserts all rows into database
-    And closes connection
-    
+    Inserts all rows into database in one transaction:
+        COPY into a temporary staging table, then one INSERT ... SELECT into tablename
+
     IF YOU ARE INSERTING A SPATIAL DATASET - please indicate this by setting the is_spatial variable = True
-    And be sure that the last column is called geometry with well known text in WGS84 (EPSG:4326) "Lat/lon"
+    And include EITHER
+        a column called geometry with well known text (or hex well known binary) in WGS84 (EPSG:4326) "Lat/lon"
+        OR columns called longitude and latitude (WGS84) - the point geometry is built in the database
+
+    returning - optional string - a field of tablename to return for each inserted row (eg. generated keys like 'sensor_id')
+
+    returns a list of the returning field if returning is given (one per inserted row, in no particular order)
     '''
-    
-    
+
+    if len(df) == 0:
+        return [] if returning else None
+
+    column_types = Get_column_types(tablename)
+    df = df.copy()
     fieldnames = list(df.columns)
-    
-    # Create connection with postgres option keepalives_idle = 100 seconds
-    conn = psycopg2.connect(**pg_connection_dict, 
-                            keepalives_idle=100)
-    
-    # Create cursor
-    cur = conn.cursor()
-    
-    for row in df.itertuples():
-        
-        vals = row[1:]
-        
-        if is_spatial: # We need to treat the geometry column of WKT a little differently
-        
-            q1 = sql.SQL(f'INSERT INTO "{tablename}"' + ' ({}) VALUES ({},{});').format(
-     sql.SQL(', ').join(map(sql.Identifier, fieldnames)),
-     sql.SQL(', ').join(sql.Placeholder() * (len(fieldnames) - 1)),
-     sql.SQL('ST_SetSRID(ST_GeomFromText(%s), 4326)::geometry'))
-        
+
+    is_lonlat = is_spatial and ('geometry' not in fieldnames) # Build points from longitude/latitude columns
+    lonlat_fields = ['longitude', 'latitude'] if is_lonlat else []
+
+    # Staging columns are typed like the table (geometry as text, longitude/latitude as floats)
+
+    staging_types = {}
+
+    for field in fieldnames:
+
+        if field in lonlat_fields:
+            staging_types[field] = 'double precision'
+        elif is_spatial and field == 'geometry':
+            staging_types[field] = 'text'
         else:
-        
-            q1 = sql.SQL(f'INSERT INTO "{tablename}"' + ' ({}) VALUES ({});').format(
-     sql.SQL(', ').join(map(sql.Identifier, fieldnames)),
-     sql.SQL(', ').join(sql.Placeholder() * (len(fieldnames))))
+            staging_types[field] = column_types[field]
 
-        # Execute command
-        cur.execute(q1.as_string(conn), (vals))
-    
-        conn.commit() # Commit command
-    
-    # Close cursor
-    cur.close()
-    # Close connection
-    conn.close()
+            # Whole numbers stored as floats (eg. because of NaNs) would be written as 1.0
+            if staging_types[field] in ('integer', 'bigint', 'smallint') and df[field].dtype.kind == 'f':
+                df[field] = df[field].round().astype('Int64')
+
+            # Lists would be written as python reprs ([1, 2]) - COPY needs postgres array literals ({1,2})
+            elif staging_types[field].endswith('[]'):
+                df[field] = df[field].map(_array_literal)
+
+    # What goes into the table
+
+    insert_fields = [field for field in fieldnames if field not in lonlat_fields]
+    select_fields = []
+
+    for field in insert_fields:
+
+        if is_spatial and field == 'geometry':
+            select_fields += [sql.SQL('ST_SetSRID({}::geometry, 4326)').format(sql.Identifier(field))]
+        else:
+            select_fields += [sql.Identifier(field)]
+
+    if is_lonlat:
+        insert_fields += ['geometry']
+        select_fields += [sql.SQL('ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)')]
+
+    # Write the dataframe as CSV for COPY
+
+    buffer = io.StringIO()
+    df.to_csv(buffer, index = False, header = False, na_rep = '\\N')
+    buffer.seek(0)
+
+    staging_table = sql.Identifier(f'_staging_{next(_staging_ids)}')
+
+    def work(cur):
+
+        cur.execute(sql.SQL('''CREATE TEMPORARY TABLE {} ({}) ON COMMIT DROP;''').format(
+                    staging_table,
+                    sql.SQL(', ').join(sql.SQL('{} {}').format(sql.Identifier(field), sql.SQL(staging_types[field]))
+                                       for field in fieldnames)))
+
+        copy_cmd = sql.SQL('''COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N');''').format(
+                    staging_table,
+                    sql.SQL(', ').join(map(sql.Identifier, fieldnames)))
+
+        cur.copy_expert(copy_cmd.as_string(cur.connection), buffer)
+
+        cmd = sql.SQL('''INSERT INTO {} ({})
+        SELECT {}
+        FROM {}''').format(sql.Identifier(tablename),
+                             sql.SQL(', ').join(map(sql.Identifier, insert_fields)),
+                             sql.SQL(', ').join(select_fields),
+                             staging_table)
+
+        if returning:
+            cmd += sql.SQL(' RETURNING {}').format(sql.Identifier(returning))
+
+        cur.execute(cmd)
+
+        if returning:
+            return [i[0] for i in cur.fetchall()] # Unpack results into list
+
+    return _run(work, retries = 0)
@@ -57,29 +57,3 @@ def Get_extent():
     nwlng, selat, selng, nwlat = response[0]
     
     return nwlng, selat, selng, nwlat
-
-# ~~~~~~~~~~~~~~ 
-
-def Get_reports_for_day(runtime):
-    '''
-    This function gets the count of reports for the day (we're considering overnights to be reports from previous day)
-    '''
-
-    formatted_runtime = runtime.strftime('%Y-%m-%d')
-
-    cmd = sql.SQL(f'''SELECT reports_for_day
-FROM "Daily Log"
-WHERE date = DATE('{formatted_runtime}');
-    ''')#.format(sql.SQL(formatted_runtime))
-    
-    response = psql.get_response(cmd)
-
-    # Unpack response
-    
-    if response[0][0] != None:
-
-        reports_for_day = int(response[0][0])
-    else:
-        reports_for_day = 0
-    
-    return reports_for_day
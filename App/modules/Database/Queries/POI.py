@@ -4,6 +4,7 @@
 
 from psycopg2 import sql
 from modules.Database import Basic_PSQL as psql
+from modules.POIs import Alert_Storage as alert_storage # Alert arrays or "POI Alerts"
 
 ### ~~~~~~~~~~~~~~~~~~~~~
 
@@ -34,7 +35,7 @@ def Get_max_poi_id():
 
 ### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def Get_newly_alerted_pois(sensor_ids, is_sensitive, epsg_code):
+def Get_newly_alerted_pois(sensor_ids, is_sensitive):
     '''
     This function will return a list of poi_ids from "Places of Interest" 
     that are within the distance from an active alert, active, and have empty active and cached alerts
@@ -47,35 +48,39 @@ def Get_newly_alerted_pois(sensor_ids, is_sensitive, epsg_code):
         cache_field += '_sensitive'
         active_field += '_sensitive'
     
-    cmd = sql.SQL('''
-    WITH unalerted_pois as
-    (
-	    SELECT poi_id, geometry
+    if alert_storage.mode == 'links':
+        unalerted_pois = sql.SQL('''SELECT poi_id
+	    FROM "Places of Interest" p
+	    WHERE NOT EXISTS (SELECT 1 FROM "POI Alerts" l WHERE l.poi_id = p.poi_id AND l.sensitive = {})
+	    AND active = TRUE''').format(sql.Literal(is_sensitive))
+    else:
+        unalerted_pois = sql.SQL('''SELECT poi_id
 	    FROM "Places of Interest"
 	    WHERE {} = {}
 	    AND {} = {}
-	    AND active = TRUE
+	    AND active = TRUE''').format(sql.Identifier(active_field), sql.Literal('{}'),
+                                 sql.Identifier(cache_field), sql.Literal('{}'))
+    
+    cmd = sql.SQL('''
+    WITH unalerted_pois as
+    (
+	    {}
     ), alerted_sensors as
     (
-	    SELECT radius_meters, geometry
-	    FROM alerts_w_info
+	    SELECT sensor_id
+	    FROM "Active Alerts"
 	    WHERE sensitive = {}
 	    AND sensor_id = ANY ( {} )
     )
-    SELECT poi_id 
+    SELECT p.poi_id 
     FROM unalerted_pois p
-    INNER JOIN alerted_sensors s 
-    ON (ST_DWithin(ST_Transform(p.geometry, {}),
-				           ST_Transform(s.geometry, {}),
-				           s.radius_meters))
-    GROUP BY poi_id
+    INNER JOIN "Sensor POI Adjacency" adj ON (adj.poi_id = p.poi_id)
+    INNER JOIN alerted_sensors s ON (s.sensor_id = adj.sensor_id)
+    GROUP BY p.poi_id
     ;
-    ''').format(sql.Identifier(active_field), sql.Literal('{}'),
-                sql.Identifier(cache_field), sql.Literal('{}'),
+    ''').format(unalerted_pois,
                 sql.Literal(is_sensitive),
-                sql.Literal(sensor_ids),
-                sql.Literal(int(epsg_code)),
-                sql.Literal(int(epsg_code))
+                sql.Literal(sensor_ids)
                 )
                 
     response = psql.get_response(cmd)
@@ -102,6 +107,36 @@ def Get_pois_to_end_alert(runtime, report_lag, is_sensitive):
     
     formatted_runtime = runtime.strftime('%Y-%m-%d %H:%M:%S')
     
+    if alert_storage.mode == 'links':
+    
+        cmd = sql.SQL('''
+        
+        -- Select the pois with cached alerts & no active alerts
+        -- And the max endtime of the cached alerts
+        SELECT l.poi_id
+        FROM "POI Alerts" l
+        INNER JOIN "Places of Interest" p ON (p.poi_id = l.poi_id)
+        LEFT JOIN "Archived Alerts" a ON (a.alert_id = l.alert_id)
+        WHERE p.active = True
+        AND l.sensitive = {sensitive}
+        AND l.state = 'cached'
+        AND NOT EXISTS (SELECT 1
+                        FROM "POI Alerts" x
+                        WHERE x.poi_id = l.poi_id
+                        AND x.sensitive = {sensitive}
+                        AND x.state = 'active')
+        GROUP BY l.poi_id
+        
+        -- Where endtime + report_lag < runtime (nowish)
+        HAVING MAX(a.start_time + INTERVAL '1 Minutes' * a.duration_minutes) + INTERVAL '1 Minutes' * {report_lag} <= {runtime};
+        ''').format(sensitive = sql.Literal(is_sensitive),
+                    report_lag = sql.Literal(report_lag),
+                    runtime = sql.Literal(formatted_runtime))
+                    
+        response = psql.get_response(cmd)
+        
+        return [i[0] for i in response] # Unpack results into list
+    
     cmd = sql.SQL('''
     
     -- Select the pois with empty active_alerts & non-empty cached_alerts
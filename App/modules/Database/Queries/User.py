@@ -12,6 +12,7 @@ import pytz # Timezones
 
 from psycopg2 import sql
 import modules.Database.Basic_PSQL as psql
+from modules.POIs import Alert_Storage as alert_storage # Alert arrays or "POI Alerts"
 
 def Get_newest_api_id():
     '''
@@ -69,18 +70,28 @@ def Get_Users_to_message_alert(timezone):
     '''
     
     fields = ['user_id', 'poi_name', 'sensitive', 'contact_method', 'api_id']
-
-    cmd = sql.SQL('''
-    -- Users to Alert (user_id, poi_name, sensitive, contact_method, api_id)
-    WITH alerted_pois as
-    (
-	    SELECT poi_id, name, TRUE as "sensitive" -- POIs alerted for sensitive groups
+    
+    if alert_storage.mode == 'links':
+        alerted_pois = sql.SQL('''SELECT DISTINCT p.poi_id, p.name, l.sensitive -- POIs alerted (for either group)
+	    FROM "POI Alerts" l
+	    INNER JOIN "Places of Interest" p ON (p.poi_id = l.poi_id)
+	    WHERE l.state = 'active'
+	    ''')
+    else:
+        alerted_pois = sql.SQL('''SELECT poi_id, name, TRUE as "sensitive" -- POIs alerted for sensitive groups
 	    FROM "Places of Interest"
 	    WHERE active_alerts_sensitive != {}
 	    UNION ALL
 	    SELECT poi_id, name, FALSE as "sensitive" -- POIs alerted for everyone
 	    FROM "Places of Interest"
-	    WHERE active_alerts != {}
+	    WHERE active_alerts != {}''').format(sql.Literal('{}'),
+                                         sql.Literal('{}'))
+
+    cmd = sql.SQL('''
+    -- Users to Alert (user_id, poi_name, sensitive, contact_method, api_id)
+    WITH alerted_pois as
+    (
+	    {}
     )
     SELECT u.user_id, p.name, u.sensitive, u.contact_method, u.api_id
     FROM "Users" u
@@ -94,8 +105,7 @@ def Get_Users_to_message_alert(timezone):
     AND start_time < (CURRENT_TIME AT TIME ZONE {})::time -- Current time less than Start time
     AND end_time > (CURRENT_TIME AT TIME ZONE {})::time -- Current time greater than Start time
     AND last_contact + INTERVAL '1 Minutes' * message_freq <= (CURRENT_TIMESTAMP AT TIME ZONE {})::timestamp; -- has the user been contacted too recently?
-    ''').format(sql.Literal('{}'),
-                sql.Literal('{}'),
+    ''').format(alerted_pois,
                 sql.Literal(timezone),
                 sql.Literal(timezone),
                 sql.Literal(timezone),
@@ -147,6 +157,8 @@ def Get_Users_to_message_unalert(reports_dict, timezone):
     today is in days to contact
     and the time is within their desired contact hours
     
+    All reports (both sensitivities) are looked up in one query
+    
     parameters:
     
     reports_dict - dict - has this format:
@@ -170,90 +182,68 @@ def Get_Users_to_message_unalert(reports_dict, timezone):
     severity - str - health descriptor of worst severity of alerts in this report
     '''
     
-    # Initialize Dataframe for the to return
+    fields = ['user_id', 'contact_method', 'api_id', # User Informations
+              'report_id', 'duration_minutes', 'severity' # Report Informations
+              ]
     
-    user_df = pd.DataFrame(columns = ['user_id', 'contact_method', 'api_id', # User Informations
-                                      'report_id', 'duration_minutes', 'severity' # Report Informations
-                                      ]
-                           )
-                                      
-    # Iterate through the sensitivities
-                                      
-    for is_sensitive in reports_dict:
+    # Unpack reports_dict into lists (same indexing)
     
-        # Iterate through the tuples of (poi_id, report_id)
-        
+    poi_ids, report_ids, sensitivities = [], [], []
+    
+    for is_sensitive in reports_dict:
         for poi_id, report_id in reports_dict[is_sensitive]:
-        
-            # First, get the users' info that are attached to this poi
-            # That should be contacted (within desired contact hours/days)
+            poi_ids += [poi_id]
+            report_ids += [report_id]
+            sensitivities += [is_sensitive == 'TRUE']
             
-            fields = ['user_id', 'contact_method', 'api_id']
-            
-            cmd = sql.SQL('''
-                -- Users to UnAlert (user_id, contact_method, api_id)
-                SELECT u.user_id, u.contact_method, u.api_id
-                FROM "Users" u
-                WHERE
-                alerted = TRUE -- Alerted
-                AND sensitive = {} -- Correct sensitivity?
-                AND poi_id = {} -- Is the user attached to this poi_id?
-                AND EXTRACT(dow FROM CURRENT_DATE AT TIME ZONE {}) = ANY ( days_to_contact ) -- Days to contact user
-                AND start_time < (CURRENT_TIME AT TIME ZONE {})::time -- Current time less than Start time
-                AND end_time > (CURRENT_TIME AT TIME ZONE {})::time -- Current time greater than Start time
-                ''').format(sql.Literal(is_sensitive),
-                            sql.Literal(poi_id),
-                            sql.Literal(timezone),
-                            sql.Literal(timezone),
-                            sql.Literal(timezone)
-                            )
-                            
-            response = psql.get_response(cmd) 
+    if len(report_ids) == 0:
+        return pd.DataFrame(columns = fields)
     
-            # Unpack response into pandas dataframe
-
-            temp_df = pd.DataFrame(response, columns = fields)
-                    
-            # ~~~~~~~~~~~~~~~~~~
-            
-            # Next, get the report's information and add to dataframe
-            
-            cmd = sql.SQL('''
-                          WITH report as
-                        (
-	                        SELECT report_id, duration_minutes, alert_ids
-	                        FROM "Reports Archive"
-	                        WHERE report_id = {}
-                        ), alerts as
-                        (
-	                        SELECT r.report_id, a.sensor_id, a.max_reading
-	                        FROM "Archived Alerts" a
-	                        INNER JOIN report r ON (a.alert_id = ANY (r.alert_ids))
-                        ), health as
-                        (
-	                        SELECT MAX(map_to_health(a.max_reading, s.thresholds)) as health_descriptor
-	                        FROM alerts a
-	                        INNER JOIN sensor_ids_w_info s ON (a.sensor_id = s.sensor_id)
-                        )
-                        SELECT r.duration_minutes, 
-	                           right(h.health_descriptor, -2) as severity
-                        FROM report r, health h;
-                          ''').format(sql.Literal(report_id))
-                          
-            response = psql.get_response(cmd)
+    # All reports at once: the users attached to each report's poi
+    # That should be contacted (within desired contact hours/days)
+    # With the report's duration and worst severity
     
-            # Unpack response & add to dataframe
-            
-            temp_df['report_id'] = report_id
-            temp_df['duration_minutes'] = response[0][0]
-            temp_df['severity'] = response[0][1]
-            
-            # ~~~~~~~~~~~~~~~~~~
-            
-            # Lastly, concatenate to user_df
-            
-            user_df = pd.concat([user_df, temp_df], ignore_index = True)
-               
+    cmd = sql.SQL('''
+    WITH reports as
+    (
+	    SELECT poi_id, report_id, sensitive, n
+	    FROM UNNEST({}::bigint[], {}::text[], {}::boolean[]) WITH ORDINALITY r (poi_id, report_id, sensitive, n)
+    ), report_info as
+    (
+	    SELECT r.report_id, ra.duration_minutes,
+	           right(MAX(map_to_health(a.max_reading, s.thresholds)), -2) as severity
+	    FROM reports r
+	    INNER JOIN "Reports Archive" ra ON (ra.report_id = r.report_id)
+	    LEFT JOIN "Archived Alerts" a ON (a.alert_id = ANY (ra.alert_ids))
+	    LEFT JOIN sensor_ids_w_info s ON (a.sensor_id = s.sensor_id)
+	    GROUP BY r.report_id, ra.duration_minutes
+    )
+    -- Users to UnAlert (user_id, contact_method, api_id) & their report
+    SELECT u.user_id, u.contact_method, u.api_id,
+           r.report_id, i.duration_minutes, i.severity
+    FROM reports r
+    INNER JOIN "Users" u ON (u.poi_id = r.poi_id -- Is the user attached to this poi_id?
+                             AND u.sensitive = r.sensitive) -- Correct sensitivity?
+    INNER JOIN report_info i ON (i.report_id = r.report_id)
+    WHERE
+    u.alerted = TRUE -- Alerted
+    AND EXTRACT(dow FROM CURRENT_DATE AT TIME ZONE {}) = ANY ( u.days_to_contact ) -- Days to contact user
+    AND u.start_time < (CURRENT_TIME AT TIME ZONE {})::time -- Current time less than Start time
+    AND u.end_time > (CURRENT_TIME AT TIME ZONE {})::time -- Current time greater than Start time
+    ORDER BY r.n, u.user_id;
+    ''').format(sql.Literal(poi_ids),
+                sql.Literal(report_ids),
+                sql.Literal(sensitivities),
+                sql.Literal(timezone),
+                sql.Literal(timezone),
+                sql.Literal(timezone)
+                )
+                
+    response = psql.get_response(cmd)
+    
+    # Unpack response into pandas dataframe
+    
+    user_df = pd.DataFrame(response, columns = fields)
     
    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~  
 
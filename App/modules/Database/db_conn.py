@@ -26,3 +26,9 @@ else:
           os.getenv('DB_OPTIONS')
           ]
   pg_connection_dict = dict(zip(['dbname', 'user', 'password', 'port', 'host', 'options'], creds))
+
+# Connection pool settings (see modules/Database/Basic_PSQL.py)
+pool_config = {'minconn' : int(os.getenv('DB_POOL_MIN', 1)), # Connections kept open between cycles
+               'maxconn' : int(os.getenv('DB_POOL_MAX', 5)), # Most connections open at once
+               'keepalives_idle' : int(os.getenv('DB_KEEPALIVES_IDLE', 30)) # Seconds before TCP keepalives
+               }
@@ -2,17 +2,12 @@
 
 # Database 
 
-import psycopg2 # For working with postgresql database
-from modules.Database.db_conn import pg_connection_dict # Getting the connection dictionary
+from modules.Database import Basic_PSQL as psql # Pooled connections to our database
+from psycopg2 import sql
 
 
 def db_need_init():
-  conn = psycopg2.connect(**pg_connection_dict)
-  cur = conn.cursor()
-  cur.execute('SELECT * FROM "extent"')
-  response = cur.fetchall()
-  cur.close()
-  conn.close()
+  response = psql.get_response(sql.SQL('SELECT * FROM "extent"'))
   
   if len(response) > 0:
     return False
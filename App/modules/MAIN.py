@@ -10,6 +10,8 @@ This function is the workflow of one regular update
                         
 sensors_df fields are used to inform the next 2 steps:
                         
+Steps 2-4 share one database transaction (the cycle's unit of work) - they commit once or roll back together
+
 # 2 = Update_Sensor_Tables - Update last_seen, channel_flags, and values in "Sensors" and last_update in "Sensor Type Information"
 
 # 3 = Update_Alerts_Tables - Create new alerts, update ongoing alerts, and end old alerts
@@ -46,6 +48,7 @@ sensor_id_dict is used to inform the next step:
 reports_dict is used to inform the next step:
 
 If the environment variable 'USERS' is set to 'y' then we will do step 5
+(unless RUN_MODE is 'workers' - then App/notify_worker.py does it on its own schedule, finding the reports through "Reports Archive".notified)
                      
 # 5 = Notify_and_Update_Users - NOT DONE - Checks the Users table and compiles info for messaging. Then composes messages, sends them, and updates the "Users" table field, alerted
 
@@ -64,6 +67,8 @@ from modules import Update_POIs_and_Reports # 4
 from modules import Notify_and_Update_Users # 5
 #from modules import Send_Reports_and_Archive # 6 <- probably will move to the daily updates
 from modules.Database.Queries import Sensor as sensor_query # 7
+from modules.Database import Basic_PSQL as psql # For the cycle's database transaction
+from modules import Metrics as metrics # Timing each step
 
 ### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -72,58 +77,76 @@ def main(base_config, runtime, next_system_update):
     '''
     This is the main workflow of one iteration of the SpikeAlerts App
     
-    It should return next_regular_update, next_system_update (both are datetimes)    
-    '''
-    
-    # ~~~~~~~~~~~~~~~~~~~~~
+    It should return next_regular_update, next_system_update (both are datetimes)
     
-    # 0) System Update? - Only sensors/POIs right now
+    Each step is timed along with every database call (see modules/Metrics.py)
+    '''
     
-    if runtime > next_system_update:
-        #pass
-        next_system_update = Daily_Updates.workflow(base_config, next_system_update)
-
-    # ~~~~~~~~~~~~~~~~~~~~~
+    pool_stats = lambda : {'db_pool_' + key : value for key, value in psql.Get_pool_stats(reset = True).items()}
     
-    # 1) Query APIs for current data
-
-    sensors_df, sensor_types_updated = Call_APIs.workflow(runtime, base_config['TIMEZONE'])
-
-    if len(sensors_df) > 0:
+    with metrics.cycle(extra = pool_stats):
     
-        # 2) Update our database tables "Sensors" and "Sensor Type Information"
-
-        Update_Sensor_Tables.workflow(sensors_df, sensor_types_updated, runtime)
-
         # ~~~~~~~~~~~~~~~~~~~~~
-
-        # 3) Workflow for updating our database tables "Active Alerts" and "Archived Alerts"
-
-        sensor_id_dict, ended_alert_ids = Update_Alert_Tables.workflow(sensors_df, runtime)
         
+        # 0) System Update? - Only sensors/POIs right now
+        
+        if runtime > next_system_update:
+            #pass
+            with metrics.stage('Daily_Updates'):
+                next_system_update = Daily_Updates.workflow(base_config, next_system_update)
+
         # ~~~~~~~~~~~~~~~~~~~~~
+        
+        # 1) Query APIs for current data
 
-        # 4) Workflow for updating our database tables "Places of Interest" and "Reports Archive"
+        with metrics.stage('Call_APIs'):
+            sensors_df, sensor_types_updated = Call_APIs.workflow(runtime, base_config['TIMEZONE'])
 
-        reports_dict = Update_POIs_and_Reports.workflow(sensor_id_dict, ended_alert_ids, runtime, base_config)
+        if len(sensors_df) > 0:
         
+            # Steps 2-4 run as one database transaction (see modules/Database/Basic_PSQL.py)
+            # They commit together at the end, or roll back together if any step fails
         
-        if base_config['USERS'] == 'y':
+            with psql.cycle_transaction():
         
-            # ~~~~~~~~~~~~~~~~~~~~~
+                # 2) Update our database tables "Sensors" and "Sensor Type Information"
+
+                with metrics.stage('Update_Sensor_Tables'):
+                    Update_Sensor_Tables.workflow(sensors_df, sensor_types_updated, runtime)
+
+                # ~~~~~~~~~~~~~~~~~~~~~
+
+                # 3) Workflow for updating our database tables "Active Alerts" and "Archived Alerts"
+
+                with metrics.stage('Update_Alert_Tables'):
+                    sensor_id_dict, ended_alert_ids = Update_Alert_Tables.workflow(sensors_df, runtime)
+                
+                # ~~~~~~~~~~~~~~~~~~~~~
 
-            # 5) Workflow for updating our database table "Users" and Compose and send messages
+                # 4) Workflow for updating our database tables "Places of Interest" and "Reports Archive"
 
-            Notify_and_Update_Users.workflow(reports_dict, base_config)
+                with metrics.stage('Update_POIs_and_Reports'):
+                    reports_dict = Update_POIs_and_Reports.workflow(sensor_id_dict, ended_alert_ids, runtime, base_config)
             
-    # ~~~~~~~~~~~~~~~~~~~~
-       
-    # ?) Probably moving this to daily updates - If it's time, send reports to manager/orgs and archive data somewhere
-    
-    # ~~~~~~~~~~~~~~~~~~~~
-       
-    # 6) Get the next regular update time
+            # Messages go out only after the cycle is committed
+            
+            if base_config['USERS'] == 'y' and base_config.get('RUN_MODE') != 'workers':
+            
+                # ~~~~~~~~~~~~~~~~~~~~~
+
+                # 5) Workflow for updating our database table "Users" and Compose and send messages
+
+                with metrics.stage('Notify_and_Update_Users'):
+                    Notify_and_Update_Users.workflow(reports_dict, base_config)
+                
+        # ~~~~~~~~~~~~~~~~~~~~
+           
+        # ?) Probably moving this to daily updates - If it's time, send reports to manager/orgs and archive data somewhere
         
-    next_regular_update = sensor_query.Get_next_regular_update(base_config['TIMEZONE'])
+        # ~~~~~~~~~~~~~~~~~~~~
+           
+        # 6) Get the next regular update time
+            
+        next_regular_update = sensor_query.Get_next_regular_update(base_config['TIMEZONE'])
 
     return next_regular_update, next_system_update
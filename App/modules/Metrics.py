@@ -0,0 +1,305 @@
+# Lightweight instrumentation for the main loop
+
+# Times each stage of a regular update (see MAIN.py) and every database call (see Database/Basic_PSQL.py)
+# At the end of each cycle it
+
+# prints one structured (json) log line (METRICS_LOG)
+# writes the numbers in Prometheus' text format to a file (METRICS_FILE, eg. for node_exporter's textfile collector)
+# and/or serves them at http://METRICS_HOST:METRICS_PORT/metrics (only this machine by default)
+
+## Load modules
+
+import os # For working with Operating System
+from dotenv import load_dotenv # Loading .env info
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+load_dotenv()
+
+# ~~~~~~~~~~~~~~
+
+# Settings
+
+metrics_log = os.getenv('METRICS_LOG', 'true').lower() in ['true', '1', 'yes'] # Print a json line per cycle
+metrics_file = os.getenv('METRICS_FILE', '') # Prometheus text file to write each cycle (optional)
+metrics_port = int(os.getenv('METRICS_PORT', 0)) # Port to serve /metrics on (0 = off)
+metrics_host = os.getenv('METRICS_HOST', '127.0.0.1') # Address to serve /metrics on ('0.0.0.0' = every interface)
+slowest_queries = 5 # Number of slowest database calls to keep per cycle
+
+# ~~~~~~~~~~~~~~
+
+# State
+
+_lock = threading.Lock()
+
+_cycle = None # The cycle being measured (see Start_cycle)
+_stage = None # The stage running right now (database calls are counted toward it)
+
+last_cycle = None # Summary of the last finished cycle (see End_cycle)
+
+totals = {'cycles' : 0, # Counters since the process started
+          'cycle_errors' : 0,
+          'cycle_seconds' : 0.0,
+          'db_calls' : 0,
+          'db_round_trips' : 0,
+          'db_seconds' : 0.0}
+
+_prometheus_text = '' # What /metrics serves
+_server = None
+
+# ~~~~~~~~~~~~~~
+
+def Start_cycle():
+    '''
+    Starts measuring a cycle (a call of MAIN.main)
+    '''
+
+    global _cycle, _stage
+
+    with _lock:
+        _cycle = {'start' : time.perf_counter(),
+                  'stages' : {}, # stage : {'seconds', 'db_calls', 'db_round_trips', 'db_rows', 'db_seconds'}
+                  'queries' : [] # Slowest database calls
+                  }
+        _stage = None
+
+# ~~~~~~~~~~~~~~
+
+@contextmanager
+def stage(name):
+    '''
+    Times a stage of the cycle, eg.
+
+    with metrics.stage('Call_APIs'):
+        ...
+    '''
+
+    global _stage
+
+    previous = _stage
+    _stage = name
+    start = time.perf_counter()
+
+    try:
+        yield
+
+    finally:
+        seconds = time.perf_counter() - start
+
+        with _lock:
+            if _cycle is not None:
+                _Stage_record(name)['seconds'] += seconds
+
+        _stage = previous
+
+def _Stage_record(name):
+    '''
+    The record for a stage in the current cycle (created on first use - call with _lock held)
+    '''
+
+    return _cycle['stages'].setdefault(name, {'seconds' : 0.0, 'db_calls' : 0, 'db_round_trips' : 0,
+                                              'db_rows' : 0, 'db_seconds' : 0.0})
+
+# ~~~~~~~~~~~~~~
+
+def Record_query(caller, seconds, round_trips, rows):
+    '''
+    Records one database call (from Basic_PSQL)
+
+    caller - string - where it came from (eg. 'Update_Alert_Tables.Apply_alert_transitions')
+    seconds - float - how long it took
+    round_trips - int - statements sent to the database
+    rows - int - rows returned or changed
+    '''
+
+    with _lock:
+
+        totals['db_calls'] += 1
+        totals['db_round_trips'] += round_trips
+        totals['db_seconds'] += seconds
+
+        if _cycle is None:
+            return
+
+        record = _Stage_record(_stage or 'other')
+        record['db_calls'] += 1
+        record['db_round_trips'] += round_trips
+        record['db_rows'] += rows
+        record['db_seconds'] += seconds
+
+        _cycle['queries'] += [{'caller' : caller, 'stage' : _stage or 'other', 'seconds' : round(seconds, 4),
+                               'round_trips' : round_trips, 'rows' : rows}]
+        _cycle['queries'] = sorted(_cycle['queries'], key = lambda query : -query['seconds'])[:slowest_queries]
+
+# ~~~~~~~~~~~~~~
+
+def End_cycle(error = None, extra = {}):
+    '''
+    Finishes the cycle, then logs/writes/serves it (see the settings above)
+
+    error - exception - if the cycle failed
+    extra - dictionary - other numbers to report for the cycle (eg. connection pool stats), name : number
+
+    returns the cycle's summary (dictionary)
+    '''
+
+    global _cycle, last_cycle
+
+    with _lock:
+
+        if _cycle is None:
+            return None
+
+        seconds = time.perf_counter() - _cycle['start']
+
+        summary = {'metric' : 'cycle',
+                   'time' : time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                   'seconds' : round(seconds, 4),
+                   'error' : None if error is None else repr(error),
+                   'db_calls' : sum(record['db_calls'] for record in _cycle['stages'].values()),
+                   'db_round_trips' : sum(record['db_round_trips'] for record in _cycle['stages'].values()),
+                   'db_seconds' : round(sum(record['db_seconds'] for record in _cycle['stages'].values()), 4),
+                   'stages' : {name : {key : round(value, 4) if isinstance(value, float) else value
+                                       for key, value in record.items()}
+                               for name, record in _cycle['stages'].items()},
+                   'slowest_queries' : _cycle['queries'],
+                   'extra' : dict(extra)
+                   }
+
+        totals['cycles'] += 1
+        totals['cycle_errors'] += error is not None
+        totals['cycle_seconds'] += seconds
+
+        last_cycle = summary
+        _cycle = None
+
+    if metrics_log:
+        print(json.dumps(summary))
+
+    if metrics_file or metrics_port:
+        Publish(summary)
+
+    return summary
+
+@contextmanager
+def cycle(extra = None):
+    '''
+    Measures a cycle - Start_cycle() then End_cycle() (with the error if one is raised)
+
+    extra - function (optional) - returns a dictionary of other numbers, called at the end of the cycle
+    '''
+
+    Start_cycle()
+
+    try:
+        yield
+
+    except Exception as e:
+        End_cycle(e, extra() if extra else {})
+        raise
+
+    else:
+        End_cycle(None, extra() if extra else {})
+
+# ~~~~~~~~~~~~~~
+
+def Prometheus_text(summary):
+    '''
+    Formats the last cycle & totals in Prometheus' text exposition format
+    '''
+
+    def Line(name, value, labels = {}):
+        label_text = ','.join(f'{label}="{label_value}"' for label, label_value in labels.items())
+        return f'spikealerts_{name}{{{label_text}}} {value}' if labels else f'spikealerts_{name} {value}'
+
+    lines = ['# HELP spikealerts_cycle_seconds Wall time of the last regular update',
+             '# TYPE spikealerts_cycle_seconds gauge',
+             Line('cycle_seconds', summary['seconds']),
+             '# TYPE spikealerts_cycle_failed gauge',
+             Line('cycle_failed', int(summary['error'] is not None)),
+             '# HELP spikealerts_stage_seconds Wall time of each stage in the last regular update',
+             '# TYPE spikealerts_stage_seconds gauge']
+
+    lines += [Line('stage_seconds', record['seconds'], {'stage' : name}) for name, record in summary['stages'].items()]
+
+    for key, help_text in [('db_calls', 'Database calls'),
+                           ('db_round_trips', 'Statements sent to the database'),
+                           ('db_rows', 'Rows returned or changed'),
+                           ('db_seconds', 'Time in database calls')]:
+        lines += [f'# HELP spikealerts_stage_{key} {help_text} by stage in the last regular update',
+                  f'# TYPE spikealerts_stage_{key} gauge']
+        lines += [Line(f'stage_{key}', record[key], {'stage' : name}) for name, record in summary['stages'].items()]
+
+    for key, value in summary['extra'].items():
+        lines += [f'# TYPE spikealerts_{key} gauge', Line(key, value)]
+
+    with _lock:
+        for key, value in totals.items():
+            lines += [f'# TYPE spikealerts_{key}_total counter', Line(f'{key}_total', value)]
+
+    return '\n'.join(lines) + '\n'
+
+# ~~~~~~~~~~~~~~
+
+def Publish(summary):
+    '''
+    Writes the Prometheus text to metrics_file (atomically) and/or updates what metrics_port serves
+    '''
+
+    global _prometheus_text
+
+    text = Prometheus_text(summary)
+    _prometheus_text = text
+
+    if metrics_file:
+        temp_file = metrics_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            f.write(text)
+        os.replace(temp_file, metrics_file) # Readers never see half a file
+
+    if metrics_port:
+        Start_server(metrics_port)
+
+# ~~~~~~~~~~~~~~
+
+class Metrics_Handler(BaseHTTPRequestHandler):
+    '''
+    GET /metrics
+    '''
+
+    def do_GET(self):
+
+        if self.path.rstrip('/') != '/metrics':
+            self.send_error(404)
+            return
+
+        body = _prometheus_text.encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Quiet
+
+def Start_server(port):
+    '''
+    Serves /metrics on metrics_host:port in a background thread (once per process)
+    '''
+
+    global _server
+
+    with _lock:
+
+        if _server is not None:
+            return
+
+        _server = ThreadingHTTPServer((metrics_host, port), Metrics_Handler)
+        _server.daemon_threads = True
+
+    threading.Thread(target = _server.serve_forever, daemon = True).start()
@@ -2,8 +2,12 @@
 
 # File manipulation
 
+import os # For working with Operating System
+import traceback # Showing full error traceback
+
 # Time
 
+import time # For Sleeping
 import datetime as dt # Working with dates/times
 import pytz # Timezones
 
@@ -12,22 +16,27 @@ import pytz # Timezones
 from modules.Database import Basic_PSQL as psql
 from psycopg2 import sql
 from modules.Database.Queries import User as user_queries
+from modules.POIs import Alert_Storage as alert_storage # Alert arrays or "POI Alerts"
 
 # Data Manipulation
 
 import pandas as pd
+import numpy as np
 
 # Messaging Functions
 
-from modules.Users import Send_Messages
+from modules.Users import Outbox # Messages are sent by the outbox worker
 from modules.Users import Compose_Messages
+from modules.Users.Send_Messages import Message_mgmt # For messaging Management that the notify worker errored
 
 ## Workflow
 
 def workflow(reports_dict, base_config):
     '''
     Runs the full workflow to check our "Users" table for folks to contact,
-     compose and send messages, and update the "Users" table alerted & last_contact fields.
+     compose messages and add them to the "Outbox", and update the "Users" table alerted & last_contact fields.
+     
+    The messages are sent by the outbox worker (see modules/Users/Outbox.py), so this never waits on sending.
      
     To Test: Alter sensor health thresholds with
     
@@ -54,9 +63,9 @@ def workflow(reports_dict, base_config):
         
         returns a dataframe, messaging_df, with fields: contact_method, api_id, message
         
-        c) Send Messages - see modules/Users/Send_Messages.py
+        c) Add the messages to the "Outbox" - see modules/Users/Outbox.py
         
-        d) Update internal database of these users with 
+        and update internal database of these users (in the same statement) with 
         last_contact = CURRENT TIMESTAMP AT TIME ZONE {base_config['TIMEZONE']}
         alerted = TRUE
      
@@ -70,9 +79,9 @@ def workflow(reports_dict, base_config):
         
         returns a dataframe, messaging_df, with fields: contact_method, api_id, message
         
-        c) Send Messages (if in_contact_hours = True) - see modules/Users/Sen_Messages.py
+        c) Add the messages to the "Outbox" - see modules/Users/Outbox.py
         
-        d) Update internal database of all these users with
+        and update internal database of all these users (in the same statement) with
         last_contact = CURRENT TIMESTAMP AT TIME ZONE {base_config['TIMEZONE']}
         alerted = FALSE
     
@@ -124,17 +133,13 @@ def workflow(reports_dict, base_config):
         
         # ~~~~~~~~~~~~~~~~~~~~~~~
         
-        # c) Send Messages
-        
-        Send_Messages.workflow(messaging_df, base_config['CONTACT_INFO_API'], base_config['TIMEZONE'])
-        
-        # ~~~~~~~~~~~~~~~~~~~~~~~
-        
-        # d) Update internal database of these users with 
+        # c) Add the messages to the "Outbox" and update internal database of these users with 
         # last_contact = CURRENT TIMESTAMP AT TIME ZONE {base_config['TIMEZONE']}
         # alerted = TRUE
         
-        Update_users_after_message(new_alert_user_df.user_id.to_list(), 'TRUE', base_config['TIMEZONE'])
+        messaging_df['user_id'] = new_alert_user_df.user_id
+        
+        Outbox.Enqueue(messaging_df, 'TRUE', base_config['TIMEZONE'])
     
     # ~~~~~~~~~~~~~~~~~~~~~~~
      
@@ -164,17 +169,13 @@ def workflow(reports_dict, base_config):
         
         # ~~~~~~~~~~~~~~~~~~~~~~~
         
-        # c) Send Messages
-        
-        Send_Messages.workflow(messaging_df, base_config['CONTACT_INFO_API'], base_config['TIMEZONE'])
-        
-        # ~~~~~~~~~~~~~~~~~~~~~~~
-        
-        # d) Update internal database of these users with 
+        # c) Add the messages to the "Outbox" and update internal database of these users with 
         # last_contact = CURRENT TIMESTAMP AT TIME ZONE {base_config['TIMEZONE']}
         # alerted = FALSE
         
-        Update_users_after_message(end_alert_user_df.user_id.to_list(), 'FALSE', base_config['TIMEZONE'])
+        messaging_df['user_id'] = end_alert_user_df.user_id
+        
+        Outbox.Enqueue(messaging_df, 'FALSE', base_config['TIMEZONE'])
     
     # ~~~~~~~~~~~~~~~~~~~~~~~
     
@@ -186,80 +187,73 @@ def workflow(reports_dict, base_config):
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~`
 
-def Parse_new_alert_user_df(new_alert_user_df, epsg_code, webmap_link):
+def Compose_unique_messages(user_df, fields, compose):
     '''
-    Uses the new_alert_user_df Dataframe to compose unique messages 
+    Composes a message for every row (user) of user_df with compose(*values of fields),
+    only calling compose once for each distinct combination of the fields
     
-    returns a dataframe, messaging_df, with fields: poi_name, contact_method, api_id, message
+    returns a numpy array of messages (same indexing as user_df)
     
     '''
-    # Initialize returned value
-        
-    messaging_df = pd.DataFrame(columns = ['contact_method', 'api_id', 'message'])
     
-    for i, new_alert_user in new_alert_user_df.iterrows():
+    # Number the distinct combinations in order of first appearance (drop_duplicates keeps the same order)
     
-        poi_name = new_alert_user.poi_name
+    codes = user_df.groupby(fields, sort = False, dropna = False).ngroup().to_numpy()
     
-        message = Compose_Messages.new_alert_message(poi_name, webmap_link)
-        
-        messaging_df.loc[i] = [new_alert_user.contact_method, new_alert_user.api_id, message]
+    unique_messages = np.array([compose(*values) for values in
+                                user_df[fields].drop_duplicates().itertuples(index = False, name = None)],
+                               dtype = object)
     
-    return messaging_df  
+    return unique_messages[codes]
 
 # ~~~~~~~~~~~~~
 
-def Parse_end_alert_user_df(end_alert_user_df, epsg_code, report_url):
+def Parse_new_alert_user_df(new_alert_user_df, epsg_code, webmap_link):
     '''
-    Uses the end_alert_user_df Dataframe to compose unique messages 
+    Uses the new_alert_user_df Dataframe to compose unique messages 
     
-    returns a dataframe, messaging_df, with fields: poi_name, contact_method, api_id, message
+    returns a dataframe, messaging_df, with fields: contact_method, api_id, message (same index as new_alert_user_df)
     
     '''
-    # Initialize returned value
-        
-    messaging_df = pd.DataFrame(columns = ['contact_method', 'api_id', 'message'])
     
-    for i, end_alert_user in end_alert_user_df.iterrows():
+    if new_alert_user_df.empty:
+        return pd.DataFrame(columns = ['contact_method', 'api_id', 'message'])
     
-        duration = end_alert_user.duration_minutes
-        severity = end_alert_user.severity
+    messages = Compose_unique_messages(new_alert_user_df, ['poi_name'],
+                                       lambda poi_name: Compose_Messages.new_alert_message(poi_name, webmap_link))
     
-        message = Compose_Messages.end_alert_message(end_alert_user.duration_minutes, 
-                                                    end_alert_user.severity,
-                                                    report_url)
-        
-        messaging_df.loc[i] = [end_alert_user.contact_method, end_alert_user.api_id, message]
+    messaging_df = pd.DataFrame({'contact_method' : new_alert_user_df.contact_method.to_numpy(),
+                                 'api_id' : new_alert_user_df.api_id.to_numpy(),
+                                 'message' : messages},
+                                index = new_alert_user_df.index)
     
-    return messaging_df 
+    return messaging_df  
 
 # ~~~~~~~~~~~~~
 
-def Update_users_after_message(user_ids, alerted, timezone):
+def Parse_end_alert_user_df(end_alert_user_df, epsg_code, report_url):
     '''
-    This function updates the users in our database.
-    
-    Changes alerted = True or False and last_contact = CURRENT_TIMESTAMP
+    Uses the end_alert_user_df Dataframe to compose unique messages 
     
-    parameters:
+    returns a dataframe, messaging_df, with fields: contact_method, api_id, message (same index as end_alert_user_df)
     
-    user_ids - list - user_ids in our database to update
-    alerted - string - TRUE or FALSE (not case senstive)
-    timezone - string - pytz timezone
     '''
-
-    cmd = sql.SQL('''
-    UPDATE "Users"
-    SET alerted = {},
-    last_contact = (CURRENT_TIMESTAMP AT TIME ZONE {})::timestamp
-    WHERE user_id = ANY ( {} );
-    ''').format(sql.Literal(alerted),
-                sql.Literal(timezone),
-                sql.Literal(user_ids)
-                )
-                
-    psql.send_update(cmd)     
     
+    if end_alert_user_df.empty:
+        return pd.DataFrame(columns = ['contact_method', 'api_id', 'message'])
+    
+    messages = Compose_unique_messages(end_alert_user_df, ['duration_minutes', 'severity'],
+                                       lambda duration, severity: Compose_Messages.end_alert_message(duration,
+                                                                                                     severity,
+                                                                                                     report_url))
+    
+    messaging_df = pd.DataFrame({'contact_method' : end_alert_user_df.contact_method.to_numpy(),
+                                 'api_id' : end_alert_user_df.api_id.to_numpy(),
+                                 'message' : messages},
+                                index = end_alert_user_df.index)
+    
+    return messaging_df 
+
 # ~~~~~~~~~~~~~
 
 def Unalert_Users():
@@ -297,14 +291,25 @@ def Unalert_Users():
         
         # Update these users' alerted to false
         
-        cmd = sql.SQL('''
-                        WITH unalerted_pois as
-                        (
-	                        SELECT poi_id
+        if alert_storage.mode == 'links':
+            unalerted_pois = sql.SQL('''SELECT poi_id
+	                        FROM "Places of Interest" p
+	                        WHERE NOT EXISTS (SELECT 1
+	                                          FROM "POI Alerts" l
+	                                          WHERE l.poi_id = p.poi_id
+	                                          AND l.sensitive = {})''').format(sql.Literal(is_sensitive))
+        else:
+            unalerted_pois = sql.SQL('''SELECT poi_id
 	                        FROM "Places of Interest"
 	                        WHERE 
 	                        {} = {}
-	                        AND {} = {}
+	                        AND {} = {}''').format(sql.Identifier(active_field), sql.Literal('{}'),
+	                                               sql.Identifier(cache_field), sql.Literal('{}'))
+        
+        cmd = sql.SQL('''
+                        WITH unalerted_pois as
+                        (
+	                        {}
                         ), users_to_update as
                         (
 	                        SELECT u.user_id
@@ -314,15 +319,105 @@ def Unalert_Users():
 	                        AND p.poi_id IS NOT NULL
 	                        AND alerted = TRUE
 	                        AND sensitive = {}
+	                        AND NOT EXISTS (SELECT 1 -- Reports still waiting for the notify worker
+	                                        FROM "Reports Archive" ra
+	                                        WHERE ra.poi_id = u.poi_id
+	                                        AND ra.notified = FALSE)
                         )
                         UPDATE "Users" u
                         SET alerted = FALSE
                         FROM users_to_update uu
                         WHERE u.user_id = uu.user_id
                         ;
-                 ''').format(sql.Identifier(active_field), sql.Literal('{}'),
-                            sql.Identifier(cache_field), sql.Literal('{}'),
+                 ''').format(unalerted_pois,
                             sql.Literal(is_sensitive)
                         )
                 
         psql.send_update(cmd)    
+
+# ~~~~~~~~~~~~~
+
+def Claim_reports():
+    '''
+    Marks the reports waiting for the notify worker (notified = FALSE in "Reports Archive") as notified
+    
+    Other notify workers skip these reports (SKIP LOCKED) until this transaction ends
+    Use inside psql.cycle_transaction() with the workflow, so they are only marked if the messages are queued
+    
+    returns a dictionary (reports_dict) with the same format as workflow's parameter
+    '''
+    
+    cmd = sql.SQL('''
+    WITH waiting AS
+    (
+	    SELECT report_id
+	    FROM "Reports Archive"
+	    WHERE notified = FALSE
+	    FOR UPDATE SKIP LOCKED
+    )
+    UPDATE "Reports Archive" ra
+    SET notified = TRUE
+    FROM waiting w
+    WHERE ra.report_id = w.report_id
+    RETURNING ra.sensitive, ra.poi_id, ra.report_id;
+    ''')
+    
+    response = psql.get_response(cmd)
+    
+    reports_dict = {
+                    'TRUE': [],
+                    'FALSE': []
+                    }
+    
+    for sensitive, poi_id, report_id in response:
+        reports_dict[str(sensitive).upper()] += [(poi_id, report_id)]
+    
+    return reports_dict
+
+# ~~~~~~~~~~~~~
+
+def Run_worker(base_config, stoptime):
+    '''
+    The notify worker (RUN_MODE = 'workers' in .env, see App/notify_worker.py)
+    
+    Runs the workflow every NOTIFY_POLL_SECONDS (default 60) until stoptime, on its own schedule from the sensor loop.
+    Each run claims the reports written since the last one (see Claim_reports) and is one database transaction
+    
+    Management is messaged when runs start failing (once per failing streak) and when they work again
+    
+    parameters:
+    
+    base_config - dictionary - information from the .env file  
+    stoptime - datetime - when to stop
+    '''
+    
+    poll_seconds = float(os.getenv('NOTIFY_POLL_SECONDS', 60))
+    
+    failing = False # Did the last run fail?
+    
+    def Tell_mgmt(message):
+        try:
+            Message_mgmt(message)
+        except Exception as e:
+            print(f'\n~~~\nWarning: Could not message management ({e})\n~~~\n')
+    
+    while dt.datetime.now(pytz.timezone(base_config['TIMEZONE'])) < stoptime:
+    
+        try:
+            with psql.cycle_transaction():
+                reports_dict = Claim_reports()
+                workflow(reports_dict, base_config)
+                
+            if failing:
+                failing = False
+                Tell_mgmt('SpikeAlerts notify worker is working again')
+            
+        except Exception as e:
+            print('\n~~~~~~~~~~~~~~NOTIFY WORKER ERROR~~~~~~~~~~~~\n')
+            traceback.print_exc()
+            
+            if not failing:
+                failing = True
+                Tell_mgmt(f'SpikeAlerts notify worker failed due to {e}\nUsers are not being messaged. Retrying every {poll_seconds:g} seconds')
+            
+        time.sleep(poll_seconds)
@@ -0,0 +1,20 @@
+# How the alerts on each Place of Interest are kept (ALERT_STORAGE in .env)
+
+# 'arrays' - the active_alerts & cached_alerts (and _sensitive) bigint [] columns of "Places of Interest"
+# 'links' - one row per POI & alert in "POI Alerts" (poi_id, alert_id, sensitive, state = 'active' or 'cached')
+#           Indexed joins instead of array searches, and POI rows aren't rewritten as alerts come and go
+
+# Both have the same meaning - the queries that read or change them check mode
+# To switch a running database from arrays to links, see Database/add_poi_alerts.sql
+
+import os # For working with Operating System
+from dotenv import load_dotenv # Loading .env info
+
+load_dotenv()
+
+# ~~~~~~~~~~~~~~
+
+mode = os.getenv('ALERT_STORAGE', 'arrays').lower() # 'arrays' or 'links'
+
+if mode not in ['arrays', 'links']:
+    raise ValueError(f"ALERT_STORAGE must be 'arrays' or 'links', not {mode!r}")
@@ -61,40 +61,100 @@ def Add_POI_pts(lats, lons):
 
  # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
  
-def Update_POIs_active(epsg_code):
+def Sync_projected_geometry(epsg_code):
     '''
-    This function updates the "active" field in the table,
-    base."Places of Interest"
-    based upon if a sensor is nearby or not
+    This function keeps the geometry_projected columns of
+    base."Sensors" and base."Places of Interest"
+    in the local projected coordinate reference system (for fast, indexed distance calculations)
+    
+    It records epsg_code in "extent" (used by the insert/update triggers, see Database/initialize_tables.sql)
+    and only re-projects rows that are missing or in a different system - so is cheap to call repeatedly
+    
+    When it does re-project, it's all one transaction: the per row adjacency triggers are skipped
+    (they would compare sensors in the new system to POIs still in the old one)
+    and "Sensor POI Adjacency" is rebuilt once at the end
     
     parameters:
     
     epsg_code - something to cast as int - The local UTM Coordinate Reference System EPSG code
     '''
 
+    epsg = sql.Literal(int(epsg_code))
+
+    stale = sql.SQL('''geometry IS NOT NULL
+    AND (geometry_projected IS NULL OR ST_SRID(geometry_projected) != {epsg})''').format(epsg = epsg)
+
+    # How many rows need re-projecting? (and does this database have the adjacency table)
+
+    cmd = sql.SQL('''
+    SELECT (SELECT COUNT(*) FROM "Sensors" WHERE {stale})
+           + (SELECT COUNT(*) FROM "Places of Interest" WHERE {stale}),
+           to_regclass('"Sensor POI Adjacency"') IS NOT NULL;
+    ''').format(stale = stale)
+
+    n_stale, has_adjacency = psql.get_response(cmd)[0]
+
+    cmd = sql.SQL('''
+    UPDATE "extent"
+    SET epsg_code = {epsg}
+    WHERE epsg_code IS DISTINCT FROM {epsg};
+    ''').format(epsg = epsg)
+
+    if n_stale > 0:
+
+        cmd += sql.SQL('''
+        SELECT set_config('spikealerts.skip_adjacency', 'on', true); -- Only for this transaction
+        ''')
+
+        for table in ['Sensors', 'Places of Interest']:
+
+            cmd += sql.SQL('''
+            UPDATE {table}
+            SET geometry_projected = ST_Transform(geometry, {epsg})
+            WHERE {stale};
+            ''').format(table = sql.Identifier(table),
+                        epsg = epsg,
+                        stale = stale)
+
+        if has_adjacency:
+
+            cmd += sql.SQL('''
+            TRUNCATE "Sensor POI Adjacency";
+
+            INSERT INTO "Sensor POI Adjacency" (sensor_id, poi_id)
+            SELECT s.sensor_id, p.poi_id
+            FROM "Sensors" s
+            INNER JOIN "Sensor Type Information" i ON (i.sensor_type = s.sensor_type)
+            INNER JOIN "Places of Interest" p ON ST_DWithin(p.geometry_projected, s.geometry_projected, i.radius_meters);
+            ''')
+
+        cmd += sql.SQL('''
+        SELECT set_config('spikealerts.skip_adjacency', 'off', true);
+        ''')
+
+    psql.send_update(cmd) # One transaction
+
+ # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+ 
+def Update_POIs_active():
+    '''
+    This function updates the "active" field in the table,
+    base."Places of Interest"
+    based upon if a sensor is nearby or not
+    
+    Nearby sensors come from "Sensor POI Adjacency" (maintained by the database, see Database/initialize_tables.sql)
+    '''
+
     cmd = sql.SQL('''
-    WITH active_sensors as
-    (
-	    SELECT s.sensor_id, i.radius_meters, s.geometry
-	    FROM "Sensors" s
-	    INNER JOIN sensor_ids_w_info i ON i.sensor_id = s.sensor_id
-	    WHERE s.channel_state = 1
-    ), pois_w_no_nearby_sensors as
-    (
-	    SELECT p.poi_id, 
-			    BOOL_OR ( ST_DWithin(ST_Transform(p.geometry, {}), -- CHANGE THIS!!
-					       ST_Transform(s.geometry, {}), -- CHANGE THIS!!
-					       s.radius_meters)) as nearby_sensor
-	    FROM active_sensors s, "Places of Interest" p
-	    WHERE p.active = TRUE
-	    GROUP BY p.poi_id
-    )
-    UPDATE "Places of Interest" pois
-    SET active = p.nearby_sensor
-    FROM pois_w_no_nearby_sensors p
-    WHERE pois.poi_id = p.poi_id;
-    ''').format(sql.Literal(int(epsg_code)),
-                sql.Literal(int(epsg_code))
-                )
+    UPDATE "Places of Interest" p
+    SET active = FALSE
+    WHERE p.active = TRUE
+    AND NOT EXISTS (SELECT 1
+                    FROM "Sensor POI Adjacency" adj
+                    INNER JOIN "Sensors" s ON (s.sensor_id = adj.sensor_id)
+                    WHERE adj.poi_id = p.poi_id
+                    AND s.channel_state = 1)
+    AND EXISTS (SELECT 1 FROM "Sensors" WHERE channel_state = 1); -- As before, leave everything alone if no sensors are reporting
+    ''')
 
     psql.send_update(cmd)
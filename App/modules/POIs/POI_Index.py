@@ -0,0 +1,287 @@
+# An in-memory spatial index of the active Places of Interest
+
+# An alternative to PostGIS for matching alerted sensors to nearby POIs (set POI_ENGINE=memory in .env)
+# Built from the projected (meters) geometries at startup & each daily update, then queried in vectorized batches
+
+# Points go in a uniform grid (numpy only) with cells the size of the largest sensor radius,
+# so a sensor only needs to look at the POIs in its own and neighbouring cells.
+# Other geometries (eg. polygons) go in every cell their bounding box overlaps, and are checked exactly with shapely (>= 2.0, see requirements.txt)
+
+# POIs added to the database during the day are picked up at the next daily update (see Daily_Updates.py)
+
+# Data Manipulation
+
+import numpy as np
+import datetime as dt
+import shapely # Vectorized geometry functions (shapely >= 2.0)
+
+# Database
+
+from psycopg2 import sql
+import modules.Database.Basic_PSQL as psql
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+current_index = None # The index used by Get_pois_near (see Build_index)
+
+default_cell_size = 1000 # meters - if there aren't any sensor types yet
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _Cell_keys(ix, iy):
+    '''
+    One int64 per grid cell from its column (ix) and row (iy)
+    '''
+
+    return np.asarray(ix, dtype = np.int64) * 2**32 + (np.asarray(iy, dtype = np.int64) + 2**31)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _Group_by_cell(cells):
+    '''
+    Sorts items by their cell key
+
+    returns order (positions of the items sorted by cell), and the distinct keys with where each starts & how many items it has
+    '''
+
+    order = np.argsort(cells, kind = 'stable')
+
+    keys, starts, counts = np.unique(cells[order], return_index = True, return_counts = True)
+
+    return order, keys, starts, counts
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _Candidates(keys, starts, counts, query_keys, query_positions):
+    '''
+    Every (query position, item) pair where the item is in one of the query's cells
+
+    keys, starts, counts - from _Group_by_cell
+    query_keys, query_positions - arrays - cells to look in and the location each is for
+
+    returns pair_positions, pair_items (positions in the sorted items)
+    '''
+
+    # Which of those cells have items?
+
+    loc = np.minimum(np.searchsorted(keys, query_keys), len(keys) - 1)
+    found = keys[loc] == query_keys
+
+    query_positions, loc = query_positions[found], loc[found]
+    cell_counts = counts[loc]
+
+    pair_positions = np.repeat(query_positions, cell_counts)
+    pair_items = (np.repeat(starts[loc], cell_counts)
+                  + np.arange(cell_counts.sum()) - np.repeat(np.cumsum(cell_counts) - cell_counts, cell_counts))
+
+    return pair_positions, pair_items
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Make_index(poi_ids, xs, ys, cell_size, shape_poi_ids = [], shapes = []):
+    '''
+    Makes an index of POIs in a projected coordinate reference system (meters)
+
+    parameters:
+
+    poi_ids, xs, ys - array-likes - point POIs and their coordinates
+    cell_size - float - width of the grid cells in meters (best as the largest radius that will be queried)
+    shape_poi_ids, shapes - array-likes (optional) - POIs that aren't points and their shapely geometries
+
+    returns a dictionary (the index)
+    '''
+
+    poi_ids = np.asarray(poi_ids, dtype = np.int64)
+    xs = np.asarray(xs, dtype = float)
+    ys = np.asarray(ys, dtype = float)
+
+    # Sort the points by grid cell, then keep where each cell starts & how many points are in it
+
+    order, keys, starts, counts = _Group_by_cell(_Cell_keys(np.floor(xs / cell_size), np.floor(ys / cell_size)))
+
+    index = {'cell_size' : float(cell_size),
+             'keys' : keys, 'starts' : starts, 'counts' : counts,
+             'poi_ids' : poi_ids[order], 'xs' : xs[order], 'ys' : ys[order],
+             'shape_poi_ids' : np.asarray(shape_poi_ids, dtype = np.int64),
+             'shapes' : np.asarray(shapes, dtype = object),
+             'shape_bounds' : np.empty((0, 4)),
+             'built' : dt.datetime.now()
+             }
+
+    # Other geometries - one entry for each cell their bounding box overlaps
+
+    index['shape_keys'] = index['shape_starts'] = index['shape_counts'] = np.empty(0, dtype = np.int64)
+    index['shape_cells'] = np.empty(0, dtype = np.int64) # Entry -> position in shapes
+
+    if len(shapes) > 0:
+
+        index['shape_bounds'] = shapely.bounds(index['shapes'])
+
+        minx, miny, maxx, maxy = (np.floor(index['shape_bounds'] / cell_size).astype(np.int64)).T
+
+        widths, heights = maxx - minx + 1, maxy - miny + 1
+        n_cells = widths * heights
+
+        shape_positions = np.repeat(np.arange(len(shapes)), n_cells)
+        cell_numbers = np.arange(n_cells.sum()) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells) # Within each shape
+
+        cells = _Cell_keys(minx[shape_positions] + cell_numbers // heights[shape_positions],
+                           miny[shape_positions] + cell_numbers % heights[shape_positions])
+
+        order, keys, starts, counts = _Group_by_cell(cells)
+
+        index['shape_keys'], index['shape_starts'], index['shape_counts'] = keys, starts, counts
+        index['shape_cells'] = shape_positions[order]
+
+    return index
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Query_index(index, xs, ys, radii):
+    '''
+    Finds every POI in the index within a radius of each location (like ST_DWithin)
+
+    parameters:
+
+    index - dictionary - from Make_index
+    xs, ys - array-likes - locations in the index's coordinate reference system (eg. alerted sensors)
+    radii - array-like - distance in meters for each location
+
+    returns two numpy arrays of matching pairs (same indexing):
+
+    positions - position of the location in xs/ys
+    poi_ids - a POI within its radius
+    '''
+
+    xs = np.asarray(xs, dtype = float)
+    ys = np.asarray(ys, dtype = float)
+    radii = np.asarray(radii, dtype = float)
+
+    positions, poi_ids = [np.empty(0, dtype = np.int64)], [np.empty(0, dtype = np.int64)]
+
+    if len(xs) == 0:
+        return positions[0], poi_ids[0]
+
+    # ~~~~~~~~~~~~~~~~
+    # The cells within reach of each location
+
+    cell_size = index['cell_size']
+    reach = int(np.ceil(radii.max() / cell_size))
+
+    dx, dy = np.meshgrid(np.arange(-reach, reach + 1), np.arange(-reach, reach + 1))
+
+    query_keys = _Cell_keys(np.floor(xs / cell_size)[:, None] + dx.ravel(),
+                            np.floor(ys / cell_size)[:, None] + dy.ravel()).ravel()
+    query_positions = np.repeat(np.arange(len(xs)), dx.size)
+
+    # ~~~~~~~~~~~~~~~~
+    # Points - every (location, point in cell) candidate pair, then the distance
+
+    if len(index['keys']) > 0:
+
+        pair_positions, pair_points = _Candidates(index['keys'], index['starts'], index['counts'],
+                                                  query_keys, query_positions)
+
+        distance_squared = ((index['xs'][pair_points] - xs[pair_positions])**2
+                            + (index['ys'][pair_points] - ys[pair_positions])**2)
+
+        is_near = distance_squared <= radii[pair_positions]**2
+
+        positions += [pair_positions[is_near]]
+        poi_ids += [index['poi_ids'][pair_points[is_near]]]
+
+    # ~~~~~~~~~~~~~~~~
+    # Other geometries - candidates from the cells (once each), bounding boxes, then the exact distance
+
+    if len(index['shape_keys']) > 0:
+
+
+        pair_positions, pair_entries = _Candidates(index['shape_keys'], index['shape_starts'], index['shape_counts'],
+                                                   query_keys, query_positions)
+
+        pairs = np.unique(pair_positions * len(index['shapes']) + index['shape_cells'][pair_entries])
+        pair_positions, pair_shapes = pairs // len(index['shapes']), pairs % len(index['shapes'])
+
+        minx, miny, maxx, maxy = index['shape_bounds'][pair_shapes].T
+
+        box_dx = np.maximum(np.maximum(minx - xs[pair_positions], xs[pair_positions] - maxx), 0)
+        box_dy = np.maximum(np.maximum(miny - ys[pair_positions], ys[pair_positions] - maxy), 0)
+
+        in_box = box_dx**2 + box_dy**2 <= radii[pair_positions]**2
+        pair_positions, pair_shapes = pair_positions[in_box], pair_shapes[in_box]
+
+        distances = shapely.distance(index['shapes'][pair_shapes],
+                                     shapely.points(xs[pair_positions], ys[pair_positions]))
+
+        is_near = distances <= radii[pair_positions]
+
+        positions += [pair_positions[is_near]]
+        poi_ids += [index['shape_poi_ids'][pair_shapes[is_near]]]
+
+    return np.concatenate(positions), np.concatenate(poi_ids)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Build_index():
+    '''
+    Builds the index (current_index) from the active POIs in base."Places of Interest"
+    Uses geometry_projected (see POI_Functions.Sync_projected_geometry)
+
+    The cell size is the largest radius_meters in "Sensor Type Information"
+
+    returns the index (dictionary)
+    '''
+
+    global current_index
+
+    cmd = sql.SQL('''
+    SELECT poi_id,
+           CASE WHEN GeometryType(geometry_projected) = 'POINT' THEN ST_X(geometry_projected) END,
+           CASE WHEN GeometryType(geometry_projected) = 'POINT' THEN ST_Y(geometry_projected) END,
+           CASE WHEN GeometryType(geometry_projected) != 'POINT' THEN ST_AsBinary(geometry_projected) END
+    FROM "Places of Interest"
+    WHERE active = TRUE
+    AND geometry_projected IS NOT NULL;
+    ''')
+
+    response = psql.get_response(cmd)
+
+    cmd = sql.SQL('''
+    SELECT MAX(radius_meters)
+    FROM "Sensor Type Information";
+    ''')
+
+    max_radius = psql.get_response(cmd)[0][0]
+
+    points = [row for row in response if row[3] is None]
+    others = [row for row in response if row[3] is not None]
+
+    shapes = []
+
+    if len(others) > 0:
+        shapes = shapely.from_wkb([bytes(row[3]) for row in others])
+
+    current_index = Make_index([row[0] for row in points],
+                               [row[1] for row in points],
+                               [row[2] for row in points],
+                               max_radius or default_cell_size,
+                               [row[0] for row in others],
+                               shapes)
+
+    print(f'Built the POI index: {len(points)} points and {len(others)} other geometries')
+
+    return current_index
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Get_pois_near(xs, ys, radii):
+    '''
+    Query_index on current_index (building it first if needed, eg. at startup)
+
+    See Query_index for parameters and what is returned
+    '''
+
+    if current_index is None:
+        Build_index()
+
+    return Query_index(current_index, xs, ys, radii)
@@ -8,12 +8,24 @@ from dotenv import load_dotenv # Loading .env info
 # Web
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 
 # Time
 
 import datetime as dt
 import pytz # Timezones
+import time # For timing calls
+
+# Data Structures
+
+from collections import deque
+
+# Concurrency
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Data Manipulation
 
@@ -29,24 +41,133 @@ load_dotenv() # Load .env file) # Load .env file
 # API Key
 
 purpleAir_api = os.getenv('PURPLEAIR_API_TOKEN') # PurpleAir API Read Key
-name_filter = os.getenv('PURPLEAIR_NAME_FILTER') # PurpleAir API Read Key
+name_filter = os.getenv('PURPLEAIR_NAME_FILTER', '') # Only keep sensors with this in their name (optional)
+base_url = os.getenv('PURPLEAIR_BASE_URL', 'https://api.purpleair.com/v1') # Point at a stand-in for offline testing (see Benchmarks/PurpleAir_Stand_In.py)
+
+# HTTP settings
+
+connect_timeout = float(os.getenv('PURPLEAIR_CONNECT_TIMEOUT', 5)) # Seconds to wait to connect
+read_timeout = float(os.getenv('PURPLEAIR_READ_TIMEOUT', 60)) # Seconds to wait between bytes of a response
+max_retries = int(os.getenv('PURPLEAIR_MAX_RETRIES', 3)) # Retries on connection errors, 429 (rate limited), and 5xx
+backoff_factor = float(os.getenv('PURPLEAIR_BACKOFF', 1)) # Retries wait backoff_factor * (1, 2, 4, ...) seconds (or Retry-After)
+
+# Incremental polling (see Standard/Regular_Update.py)
+
+incremental = os.getenv('PURPLEAIR_INCREMENTAL', 'true').lower() in ['true', '1', 'yes'] # Only ask for sensors modified since the last poll
+full_refresh_minutes = float(os.getenv('PURPLEAIR_FULL_REFRESH_MINUTES', 60)) # Still ask for every sensor this often
+
+#### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+### A keep-alive session shared by every call to PurpleAir
+
+def Make_session(pool_maxsize = 10):
+    '''
+    Creates a requests.Session for PurpleAir that
+    
+    keeps connections open between calls (no new DNS lookup/TLS handshake each time),
+    asks for gzipped responses,
+    and retries with exponential backoff on connection errors, 429, and 5xx responses
+    
+    pool_maxsize - int - most connections kept open at once (for concurrent calls)
+    '''
+    
+    retry = Retry(total = max_retries,
+                  backoff_factor = backoff_factor,
+                  status_forcelist = [429, 500, 502, 503, 504],
+                  allowed_methods = ['GET'],
+                  respect_retry_after_header = True,
+                  raise_on_status = False) # Return the last response instead of raising
+                  
+    adapter = HTTPAdapter(pool_connections = 1,
+                          pool_maxsize = pool_maxsize,
+                          max_retries = retry)
+    
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    
+    session.headers.update({'X-API-Key' : purpleAir_api,
+                            'Accept-Encoding' : 'gzip'})
+    
+    return session
+
+session = Make_session()
+
+#### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+### Timing metrics for calls to PurpleAir
+
+api_timings = deque(maxlen = 100) # The most recent calls (oldest dropped first)
+
+def Get_API_timings():
+    '''
+    Returns a list of dictionaries, one per recent call to PurpleAir, with:
+    
+    time - datetime - when the call was made
+    status - int - HTTP status (None if the request failed)
+    connect_seconds - float - connecting, sending the request, and waiting for the response headers
+    transfer_seconds - float - downloading the response body
+    parse_seconds - float - reading the json into a dataframe
+    bytes - int - size of the response body as sent (gzipped)
+    rows - int - number of sensors in the response
+    '''
+    
+    return list(api_timings)
+
+#### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 # Function to get Sensors Data from PurpleAir
 
-def getSensorsData(query='', name_filter=''):
-    # my_url is assigned the URL we are going to send our request to.
-    url = 'https://api.purpleair.com/v1/sensors?' + query
+def getSensorsData(query='', name_filter='', timezone = 'America/Chicago'):
+    '''
+    Queries /v1/sensors with the query string
+    
+    returns a formatted dataframe (empty if the call failed)
+    '''
 
-    # my_headers is assigned the context of our request we want to make. In this case
-    # we will pass through our API read key using the variable created above.
-    my_headers = {'X-API-Key':purpleAir_api}
+    purpleAir_df, succeeded = _getSensorsData(query, name_filter, timezone)
+    
+    return purpleAir_df
+    
+def _getSensorsData(query='', name_filter='', timezone = 'America/Chicago'):
+    '''
+    Same as getSensorsData() but returns (purpleAir_df, succeeded) so a failed call can be told apart from an empty response
+    '''
+    
+    # my_url is assigned the URL we are going to send our request to.
+    url = base_url + '/sensors?' + query
+    
+    timing = {'time' : dt.datetime.now(dt.timezone.utc), 'status' : None,
+              'connect_seconds' : None, 'transfer_seconds' : None, 'parse_seconds' : None,
+              'bytes' : None, 'rows' : 0}
 
-    # This line creates and sends the request and then assigns its response to the
-    # variable, response.
-    response = requests.get(url, headers=my_headers)
+    # This line sends the request through our keep-alive session (with the API key in its headers)
+    # and then assigns its response to the variable, response.
+    # The body is streamed so the download can be timed separately from waiting for the response.
+    
+    try:
+        response = session.get(url, timeout = (connect_timeout, read_timeout), stream = True)
+        
+        timing['status'] = response.status_code
+        timing['connect_seconds'] = response.elapsed.total_seconds() # Until the headers arrived
+        
+        start = time.perf_counter()
+        content = response.content # Download (and decompress) the body
+        timing['transfer_seconds'] = time.perf_counter() - start
+        timing['bytes'] = response.raw.tell() # Bytes as sent (before decompressing)
+        
+    except requests.exceptions.RequestException as e:
+        print('ERROR in PurpleAir API Call')
+        print(e)
+        
+        api_timings.append(timing)
+        
+        return pd.DataFrame(), False # Return an empty dataframe
     
     # Checking the response
     
+    start = time.perf_counter()
+    
     if response.status_code != 200: 
         print('ERROR in PurpleAir API Call')
         print('HTTP Status: ' + str(response.status_code))
@@ -56,103 +177,249 @@ def getSensorsData(query='', name_filter=''):
         
     else:
         response_dict = response.json() # Read response as a json (dictionary)
-        col_names = response_dict['fields']
-        data = np.array(response_dict['data'])
-
-        df = pd.DataFrame(data, columns = col_names) # Format as Pandas dataframe
+        
+        df = Parse_PurpleAir_response(response_dict, timezone) # Typed dataframe, column by column (see below)
+        df.attrs['data_time_stamp'] = response_dict.get('data_time_stamp') # When PurpleAir's data is from (seconds since epoch)
 
     # Filter by name_filter if it exists
     
-    if len(name_filter) > 0: # If specified
-        is_name_filter = df.name.apply(lambda x: name_filter.upper() in x.upper())
-        purpleAir_df =  df[is_name_filter].copy()
+    if len(name_filter) > 0 and len(df) > 0: # If specified
+        is_name_filter = df.name.fillna('').str.upper().str.contains(name_filter.upper(), regex = False)
+        purpleAir_df =  df[is_name_filter].reset_index(drop = True)
     else: # Else
-        purpleAir_df = df.copy()
-
-    # Reformat datatypes (see next function)
-
-    if len(purpleAir_df) > 0:
-        purpleAir_df = Reformat_PurpleAir_data(purpleAir_df) # Format
+        purpleAir_df = df
+        
+    timing['parse_seconds'] = time.perf_counter() - start
+    timing['rows'] = len(purpleAir_df)
+    api_timings.append(timing)
     
-    return purpleAir_df
+    return purpleAir_df, (response.status_code == 200)
     
 #### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     
-### The Function to format columns in PurpleAir dataframe
+### The Function to read a PurpleAir response into a typed dataframe
+
+# PurpleAir fields by datatype (any other field is read as a float, or left as is if it isn't numeric)
 
-def Reformat_PurpleAir_data(df, timezone = 'America/Chicago'):
+int_fields = {'sensor_index', 'channel_flags', 'channel_state', 'altitude',
+              'channel_flags_manual', 'channel_flags_auto', 'location_type', 'private', 'confidence'}
+datetime_fields = {'last_seen', 'date_created', 'last_modified'} # Seconds since epoch
+string_fields = {'name', 'model', 'hardware', 'firmware_version', 'firmware_upgrade', 'icon'}
+
+def Parse_PurpleAir_response(response_dict, timezone = 'America/Chicago'):
     '''
-    This function formats the purpleAir_df into the following:
+    This function reads the json from /v1/sensors (fields & data) into a dataframe, one column at a time
+    
+    Each column is built straight from the rows with its datatype (no detour through an array of strings):
     
     integers
-    sensor_index, channel_flags, channel_state, altitude
+    sensor_index, channel_flags, channel_state, altitude (floats if PurpleAir left any out)
     
     datetimes in timezone
-    last_seen, date_created
+    last_seen, date_created, last_modified
     
+    strings
+    name (& other text fields)
+    
+    floats
+    everything else (eg. pm2.5_10minute, latitude, longitude)
     
     Finally, it renames sensor_index to api_id
     '''
     
-    cols = set(df.columns.to_list())
-    
-    # Integers
-    
-    int_cols = {'channel_flags', 'channel_state', 'altitude', 'sensor_index'}
+    fields = response_dict['fields']
+    data = response_dict['data']
     
-    for col in cols.intersection(int_cols):
+    if len(data) == 0:
+        return pd.DataFrame(columns = ['api_id' if field == 'sensor_index' else field for field in fields])
     
-        df[col] = df[col].astype(int)
+    columns = {}
     
-    # Datetimes
+    for field, values in zip(fields, zip(*data)): # Transpose rows into columns
     
-    datetime_cols = ['last_seen', 'date_created']
-    
-    for col in cols.intersection(datetime_cols):
-    
-        df[col] = pd.to_datetime(df[col].astype(int),
-                                         utc = True,
-                                         unit='s').dt.tz_convert(timezone)
-    # Rename sensor_index to api_id
-                                 
-    formatted_df = df.rename(columns = {'sensor_index':'api_id'}
-                                ).copy()
-    return formatted_df
+        if field in string_fields:
+            column = np.array(values, dtype = object)
+            
+        elif field in datetime_fields:
+            column = pd.to_datetime(np.array(values, dtype = float),
+                                    utc = True,
+                                    unit = 's').tz_convert(timezone)
+        else:
+            try:
+                column = np.array(values, dtype = float) # None -> NaN
+            except (ValueError, TypeError): # Not numeric
+                column = np.array(values, dtype = object)
+            
+            if field in int_fields and not np.isnan(column).any():
+                column = column.astype(np.int64)
+                
+        columns['api_id' if field == 'sensor_index' else field] = column
+        
+    return pd.DataFrame(columns)
     
 #### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     
 ### The Function to get a dataframe from purpleair for select sensor_indices
 
-def Get_with_sensor_index(sensor_indices, fields, timezone = 'America/Chicago'):
+def Get_with_sensor_index(sensor_indices, fields, timezone = 'America/Chicago', modified_since = None):
     
     ''' This function queries the PurpleAir API for sensors in the list of sensor_ids for readings over a spike threshold. 
     It will return an unformatted pandas dataframe with the specified fields as well as a runtime (datetime)
     
+    Large lists of sensor_indices are split into URL safe batches that are requested in parallel
+    (see Chunk_sensor_indices & Tune_chunk_size below)
+    
     Inputs:
     
     sensor_indices = list of integers of purpleair sensor ids to query
     fields - list of strings that line up with PurpleAir api
+    modified_since - int (optional) - seconds since epoch, only return sensors modified since then
     
     Outputs:
     
     df = Pandas DataFrame with fields (datatypes formatted!)
+    
+        df.attrs['succeeded'] - bool - did every batch succeed? (an empty df can also mean nothing was modified)
+        df.attrs['data_time_stamp'] - int - when PurpleAir's data is from (oldest batch), use as the next modified_since
+        
     runtime = datetime object when query was run
     '''
     
     ### Setting parameters for API
     fields_string = 'fields=' + '%2C'.join(fields)
-    sensor_string = 'show_only=' + '%2C'.join(pd.Series(sensor_indices).astype(str))
+    
+    if modified_since is not None:
+        fields_string += f'&modified_since={int(modified_since)}'
+        
+    sensor_strings = pd.Series(sensor_indices).astype(str).to_list()
+    
+    ### Split the sensor indices into batches (see Chunk_sensor_indices)
+    
+    chunks = Chunk_sensor_indices(sensor_strings, len(fields_string))
 
-    query_string = '&'.join([fields_string, sensor_string])
+    query_strings = ['&'.join([fields_string, 'show_only=' + '%2C'.join(chunk)]) for chunk in chunks]
     
-    ### Call the api
+    ### Call the api (batches in parallel)
     
     runtime = dt.datetime.now(pytz.timezone(timezone)) # When we call - datetime in our timezone    
-    purpleAir_df = getSensorsData(query_string) # The response is a requests.response object
+    
+    if len(query_strings) > 1:
+        with ThreadPoolExecutor(max_workers = min(chunk_workers, len(query_strings))) as executor:
+            timed_results = list(executor.map(_timed_getSensorsData, query_strings,
+                                              [timezone] * len(query_strings)))
+            
+    else:
+        timed_results = [_timed_getSensorsData(query, timezone) for query in query_strings]
+        
+    results = [(df, succeeded) for df, succeeded, seconds in timed_results]
+    chunk_seconds = [seconds for df, succeeded, seconds in timed_results]
+        
+    Tune_chunk_size(chunk_seconds)
+    
+    ### Reassemble into one dataframe (all or nothing - a partial fleet would look like missing sensors)
+    
+    if not all(succeeded for df, succeeded in results):
+        print(f'ERROR in PurpleAir API Call - {sum(not succeeded for df, succeeded in results)} of {len(results)} batches failed')
+        purpleAir_df = pd.DataFrame()
+        purpleAir_df.attrs = {'succeeded' : False, 'data_time_stamp' : None}
+        
+    else:
+        dfs = [df for df, succeeded in results if len(df) > 0] or [df for df, succeeded in results[:1]] # Keep the columns if nothing came back
+        purpleAir_df = pd.concat(dfs, ignore_index = True) if len(dfs) > 0 else pd.DataFrame()
+        
+        time_stamps = [df.attrs.get('data_time_stamp') for df, succeeded in results]
+        time_stamps = [time_stamp for time_stamp in time_stamps if time_stamp is not None]
+        
+        purpleAir_df.attrs = {'succeeded' : True,
+                              'data_time_stamp' : min(time_stamps) if len(time_stamps) > 0 else None}
             
     return purpleAir_df, runtime
     
 #### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+### Batching show_only queries for large fleets
+
+max_url_length = int(os.getenv('PURPLEAIR_MAX_URL_LENGTH', 4000)) # Longest query string to send (URL safe)
+chunk_workers = int(os.getenv('PURPLEAIR_CHUNK_WORKERS', 4)) # Batches to request at once
+target_chunk_seconds = float(os.getenv('PURPLEAIR_TARGET_CHUNK_SECONDS', 5)) # Aim for batches to take about this long
+
+chunk_size = {'size' : int(os.getenv('PURPLEAIR_CHUNK_SIZE', 500)), # Sensors per batch (auto-tuned, see Tune_chunk_size)
+              'min' : 25,
+              'max' : 1000
+              }
+_chunk_lock = threading.Lock()
+
+def Chunk_sensor_indices(sensor_strings, fixed_length = 0):
+    '''
+    Splits sensor indices (list of strings) into batches for show_only queries
+    
+    Each batch has at most chunk_size['size'] sensors and its query string stays under max_url_length
+    
+    fixed_length - int - length of the rest of the query string (eg. the fields)
+    
+    returns a list of lists of strings
+    '''
+    
+    with _chunk_lock:
+        size = chunk_size['size']
+    
+    chunks = []
+    chunk = []
+    length = fixed_length + len('&show_only=')
+    
+    for sensor_string in sensor_strings:
+    
+        added_length = len(sensor_string) + len('%2C')
+    
+        if len(chunk) > 0 and (len(chunk) >= size or length + added_length > max_url_length):
+            chunks += [chunk]
+            chunk = []
+            length = fixed_length + len('&show_only=')
+            
+        chunk += [sensor_string]
+        length += added_length
+        
+    if len(chunk) > 0:
+        chunks += [chunk]
+        
+    return chunks
+    
+# ~~~~~~~~~~~~~~~~~~~~~~~~
+    
+def Tune_chunk_size(chunk_seconds):
+    '''
+    Adjusts chunk_size['size'] from how long the last batches took
+    
+    Slower than target_chunk_seconds - halve the batches (a slow response stalls less of the fleet)
+    Faster than half the target - grow them by half (fewer requests)
+    '''
+    
+    if len(chunk_seconds) == 0:
+        return
+    
+    slowest = max(chunk_seconds)
+    
+    with _chunk_lock:
+    
+        if slowest > target_chunk_seconds:
+            chunk_size['size'] = max(chunk_size['min'], chunk_size['size'] // 2)
+            
+        elif slowest < target_chunk_seconds / 2:
+            chunk_size['size'] = min(chunk_size['max'], int(chunk_size['size'] * 1.5)) # Also capped by max_url_length when chunking
+            
+# ~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _timed_getSensorsData(query, timezone = 'America/Chicago'):
+    '''
+    Calls _getSensorsData(query) and returns (purpleAir_df, succeeded, seconds taken)
+    '''
+    
+    start = time.perf_counter()
+    purpleAir_df, succeeded = _getSensorsData(query, timezone = timezone)
+    
+    return purpleAir_df, succeeded, time.perf_counter() - start
+    
+#### ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
    
 ### The Function to get a dataframe from purpleair for select sensor_ids
 
@@ -173,7 +440,7 @@ def Get_with_bounds(fields, nwlng, selat, selng, nwlat, timezone = 'America/Chic
     
     Outputs:
     
-    df = Pandas DataFrame with fields (datatypes not formatted!)
+    df = Pandas DataFrame with fields (datatypes formatted!)
     runtime = datetime object when query was run
     '''
     
@@ -191,6 +458,6 @@ def Get_with_bounds(fields, nwlng, selat, selng, nwlat, timezone = 'America/Chic
     ### Call the api
     
     runtime = dt.datetime.now(pytz.timezone(timezone)) # When we call - datetime in our timezone
-    purpleAir_df = getSensorsData(query_string, name_filter) # The response is a requests.response object
+    purpleAir_df = getSensorsData(query_string, name_filter, timezone) # The response is a requests.response object
             
     return purpleAir_df, runtime
@@ -11,7 +11,6 @@ import pytz # Timezones
 
 import numpy as np
 import pandas as pd
-import geopandas as gpd
 
 # Database
 
@@ -246,33 +245,20 @@ def Add_new_PurpleAir_Stations(sensor_indices, timezone):
 
     if len(df) > 0:
 
-        # Spatializing
-                                             
-        gdf = gpd.GeoDataFrame(df, 
-                                geometry = gpd.points_from_xy(
-                                    df.longitude,
-                                    df.latitude,
-                                    crs = 'EPSG:4326')
-                                   )
-
         # Format dataframe for database
         
         # Create sensor_type column
-        gdf['sensor_type'] = 'papm25'
+        df['sensor_type'] = 'papm25'
         # Dates to strings
-        gdf['date_created'] = gdf.date_created.apply(lambda x : x.strftime('%Y-%m-%d %H:%M:%S'))
-        gdf['last_seen'] = gdf.last_seen.apply(lambda x : x.strftime('%Y-%m-%d %H:%M:%S'))
-        # Select columns
+        df['date_created'] = df.date_created.apply(lambda x : x.strftime('%Y-%m-%d %H:%M:%S'))
+        df['last_seen'] = df.last_seen.apply(lambda x : x.strftime('%Y-%m-%d %H:%M:%S'))
+        # Select columns (the point geometry is built from longitude/latitude in the database)
         cols_for_db = ['api_id', 'sensor_type', 'date_created', 'last_seen',
-         'name', 'channel_flags', 'altitude']
+         'name', 'channel_flags', 'altitude', 'longitude', 'latitude']
          
-        sorted_df = gdf.copy()[cols_for_db] 
-        
-        # Get Well Known Text of the geometry
-                             
-        sorted_df['geometry'] = gdf.geometry.apply(lambda x: x.wkt)
+        sorted_df = df.copy()[cols_for_db]
 
-        # Insert into database
+        # Insert into database (one COPY)
         psql.insert_into(sorted_df, "Sensors", is_spatial = True)    
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~`
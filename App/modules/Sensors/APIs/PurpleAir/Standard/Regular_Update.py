@@ -47,19 +47,19 @@ def Workflow(monitor_dict, monitor_api_df, timezone):
     returned sensors_df fields are:
 
     sensor_id - int - our unique identifier
+    sensor_type - str - our sensor_type identifier
     current_reading - float - the raw sensor value
     update_frequency - int - frequency this sensor is updated (in minutes)
     pollutant - str - abbreviated name of pollutant sensor reads
     metric - str - unit to append to readings
-    health_descriptor - str - current_reading related to current health benchmarks
     radius_meters - int - max distance sensor is relevant
     is_flagged - binary - is the sensor flagged?
     '''
     
     # Initialize storage
     
-    sensors_df = pd.DataFrame(columns = ['sensor_id', 'current_reading', 'update_frequency',
-                              'pollutant', 'metric', 'health_descriptor',
+    sensors_df = pd.DataFrame(columns = ['sensor_id', 'sensor_type', 'current_reading', 'update_frequency',
+                              'pollutant', 'metric',
                               'radius_meters', 'is_flagged']
                              )
     
@@ -81,7 +81,7 @@ def Workflow(monitor_dict, monitor_api_df, timezone):
 
         fields = ['sensor_index', 'channel_flags', 'last_seen', sensor_dict['api_fieldname']] # The PurpleAir fields we want
         
-        purpleAir_df, runtime = purp.Get_with_sensor_index(sensor_indices, fields, timezone)
+        purpleAir_df = Get_readings(sensor_type, sensor_indices, fields, timezone)
         
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # Merge purpleAir & temp_api_df
@@ -108,10 +108,9 @@ def Workflow(monitor_dict, monitor_api_df, timezone):
         for key in sensor_dict_vals:
             merged_df[key] = sensor_dict[key]
             
-        # Health Descriptor
+        # Sensor Type (health descriptors are classified for every monitor at once in modules/Call_APIs.py)
         
-        merged_df['health_descriptor'] = sensors.Map_to_Health_Descriptors(merged_df.current_reading,
-                                                                   sensor_dict['thresholds'])
+        merged_df['sensor_type'] = sensor_type
                                                               
         # Flagged status
         
@@ -125,7 +124,101 @@ def Workflow(monitor_dict, monitor_api_df, timezone):
                                 temp_sensors_df.astype(sensors_df.dtypes)], # if not temp_sensors_df.empty else None], 
                                 ignore_index = True)
         
-        return sensors_df
+    return sensors_df
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# Incremental polling state, by sensor_type (kept between regular updates)
+
+last_readings = {} # sensor_type : {'fields' : list, 'df' : the last reading of every sensor, 'last_full' : datetime}
+high_water_marks = {} # sensor_type : int - PurpleAir's data_time_stamp from the last successful poll
+
+def Get_readings(sensor_type, sensor_indices, fields, timezone):
+    '''
+    This function gets the latest readings from PurpleAir for the sensor_indices
+    
+    returns purpleAir_df (formatted, see API_functions.Get_with_sensor_index)
+    
+    With incremental polling on (PURPLEAIR_INCREMENTAL) only sensors modified since the last successful poll
+    (the high water mark) are downloaded. Their rows replace the last readings we have,
+    the rest are carried forward unchanged (so QAQC still flags sensors that stop reporting by their last_seen).
+    
+    Every sensor is downloaded when
+    
+    we have nothing to carry forward (first poll, the fields changed)
+    it's been full_refresh_minutes since the last full download
+    
+    and sensors we haven't seen before are always downloaded in full.
+    
+    A failed call leaves the last readings and high water mark alone (so the next poll asks for everything since then)
+    '''
+    
+    now = dt.datetime.now(pytz.timezone(timezone))
+    sensor_indices = pd.Series(sensor_indices).astype(int)
+    
+    cache = last_readings.get(sensor_type)
+    high_water_mark = high_water_marks.get(sensor_type)
+    
+    is_full = (not purp.incremental
+               or cache is None
+               or high_water_mark is None
+               or cache['fields'] != fields
+               or now - cache['last_full'] > dt.timedelta(minutes = purp.full_refresh_minutes))
+    
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # Full download
+    
+    if is_full:
+    
+        purpleAir_df, runtime = purp.Get_with_sensor_index(sensor_indices, fields, timezone)
+        
+        if purpleAir_df.attrs.get('succeeded', False):
+            last_readings[sensor_type] = {'fields' : fields, 'df' : purpleAir_df.copy(), 'last_full' : now}
+            high_water_marks[sensor_type] = purpleAir_df.attrs['data_time_stamp']
+            
+        return purpleAir_df
+        
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # Incremental download
+    
+    is_known = sensor_indices.isin(cache['df'].api_id)
+    
+    dfs = []
+    
+    if is_known.any(): # Only what changed
+        delta_df, runtime = purp.Get_with_sensor_index(sensor_indices[is_known], fields, timezone,
+                                                       modified_since = high_water_mark)
+        dfs += [delta_df]
+    
+    if (~is_known).any(): # New to us - get everything
+        new_df, runtime = purp.Get_with_sensor_index(sensor_indices[~is_known], fields, timezone)
+        dfs += [new_df]
+        
+    if not all(df.attrs.get('succeeded', False) for df in dfs):
+        return pd.DataFrame() # Same as a failed full download
+        
+    # Merge the delta over the last readings
+    
+    updated_dfs = [df for df in dfs if len(df) > 0]
+    updated_ids = pd.concat([df.api_id for df in updated_dfs]) if len(updated_dfs) > 0 else []
+    
+    is_unchanged = ~cache['df'].api_id.isin(updated_ids)
+    is_current = cache['df'].api_id.isin(sensor_indices) # Drop sensors we no longer poll
+    
+    purpleAir_df = pd.concat([cache['df'][is_unchanged & is_current]] + updated_dfs,
+                             ignore_index = True)
+    
+    # Move the high water mark (the oldest of the calls)
+    
+    time_stamps = [df.attrs['data_time_stamp'] for df in dfs if df.attrs['data_time_stamp'] is not None]
+    
+    cache['df'] = purpleAir_df.copy()
+    if len(time_stamps) > 0:
+        high_water_marks[sensor_type] = min(time_stamps)
+    
+    print(f'{sensor_type}: {sum(len(df) for df in dfs)} of {len(sensor_indices)} sensors downloaded (incremental)')
+    
+    return purpleAir_df
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~        
 def QAQC(merged_df, timezone):
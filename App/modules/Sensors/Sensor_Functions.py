@@ -2,6 +2,7 @@
 
 # Data Manipulation
 
+import numpy as np
 import pandas as pd
 
 # Database
@@ -9,6 +10,89 @@ import pandas as pd
 from psycopg2 import sql
 import modules.Database.Basic_PSQL as psql
     
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# Health Classification
+
+# Readings are classified into integer health codes (the index in health_descriptors, -1 = no reading)
+# Same order as map_to_health() in Database/initialize_tables.sql
+
+health_descriptors = ['ERROR (too low)', 'good', 'moderate', 'unhealthy for sensitive groups',
+                      'unhealthy', 'very unhealthy', 'hazardous', 'ERROR (too high)']
+
+sensitive_spike_codes = [3, 4, 5, 6] # unhealthy for sensitive groups -> hazardous
+spike_codes = [4, 5, 6] # unhealthy -> hazardous
+        
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~        
+
+def Classify_Health_Codes(values, sensor_types, thresholds_dict):
+    '''
+    This function classifies readings from any number of sensor types into health codes in one vectorized pass
+    
+    parameters
+    
+    values - array-like of floats - raw sensor values
+    sensor_types - array-like of strings - the sensor_type of each value (same indexing as values)
+    thresholds_dict - dictionary - {sensor_type : list of 7 thresholds (left inclusive)}
+                      eg. built from Get_Sensor_APIs_Information()
+    
+    returns a numpy array of integers (same indexing as values)
+    
+    0 - 7 = index in health_descriptors
+    -1 = missing reading or unknown sensor_type
+    '''
+    
+    values = np.asarray(values, dtype = float)
+    
+    # Integer code for each sensor_type (-1 if no thresholds)
+    
+    type_index = pd.Index(list(thresholds_dict)).get_indexer(np.asarray(sensor_types, dtype = object))
+    
+    health_codes = np.full(len(values), -1, dtype = np.int8)
+    
+    for i, sensor_type in enumerate(thresholds_dict):
+    
+        is_type = (type_index == i)
+        
+        # The number of thresholds <= value is the health code
+        health_codes[is_type] = np.searchsorted(np.asarray(thresholds_dict[sensor_type], dtype = float),
+                                                values[is_type],
+                                                side = 'right')
+    
+    health_codes[np.isnan(values)] = -1
+    
+    return health_codes
+    
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~        
+
+def Health_Codes_to_Descriptors(health_codes):
+    '''
+    Converts health codes (see Classify_Health_Codes) into a pandas categorical of health_descriptors (NaN for -1)
+    '''
+    
+    return pd.Categorical.from_codes(np.asarray(health_codes, dtype = int),
+                                     categories = health_descriptors,
+                                     ordered = True)
+    
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~        
+
+def Get_thresholds_dict(sensor_api_dict):
+    '''
+    Unpacks the thresholds of every sensor_type from sensor_api_dict (see Get_Sensor_APIs_Information)
+    
+    returns a dictionary {sensor_type : list of thresholds}
+    '''
+    
+    thresholds_dict = {}
+    
+    for api_name in sensor_api_dict:
+        for monitor_name in sensor_api_dict[api_name]:
+            for sensor_type, sensor_dict in sensor_api_dict[api_name][monitor_name].items():
+            
+                thresholds_dict[sensor_type] = sensor_dict['thresholds']
+                
+    return thresholds_dict
+        
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~        
 def Map_to_Health_Descriptors(values, thresholds):
     '''
@@ -26,14 +110,13 @@ def Map_to_Health_Descriptors(values, thresholds):
     returns a pandas series with above descriptors
     '''      
     
-    health_descriptors = ['ERROR (too low)', 'good', 'moderate', 'unhealthy for sensitive groups',
-                    'unhealthy', 'very unhealthy', 'hazardous', 'ERROR (too high)']
-                    
-    bins = [-float('inf')] + thresholds + [float('inf')]
+    health_codes = np.searchsorted(np.asarray(thresholds, dtype = float),
+                                   values.to_numpy(dtype = float),
+                                   side = 'right')
+    health_codes[values.isna().to_numpy()] = -1
     
-    descriptor_series = pd.cut(values, bins,
-                 right = False, include_lowest = True,
-                 labels = health_descriptors)
+    descriptor_series = pd.Series(Health_Codes_to_Descriptors(health_codes),
+                                  index = values.index)
 
     return descriptor_series
         
@@ -11,6 +11,14 @@ from modules.Database.Queries import POI as poi_query
 from modules.Database.Queries import General as query
 from psycopg2 import sql
 
+# Spatial
+
+from modules.POIs import POI_Index as poi_index
+
+# How alerts are kept on POIs
+
+from modules.POIs import Alert_Storage as alert_storage
+
 ## Workflow
 
 def workflow(sensor_id_dict, ended_alert_ids, runtime, base_config):
@@ -72,9 +80,19 @@ def workflow(sensor_id_dict, ended_alert_ids, runtime, base_config):
     
     # report_lag - int - minutes to delay writing a report
     
-    # epsg_code - string - epsg code for local UTM coordinate reference system (for distance calculations)
+    report_lag = base_config['REPORT_LAG']
+    
+    # poi_engine - string - 'postgis' or 'memory' - how to find POIs near new alerts (see Add_alerts_to_pois)
+    
+    poi_engine = base_config.get('POI_ENGINE') or 'postgis'
+    
+    # notified - string - 'FALSE' if a separate notify worker messages users about the reports (RUN_MODE = 'workers'),
+    # 'TRUE' if it happens in this cycle (or there are no users)
     
-    report_lag, epsg_code = base_config['REPORT_LAG'], base_config['EPSG_CODE']
+    if base_config.get('RUN_MODE') == 'workers' and base_config['USERS'] == 'y':
+        notified = 'FALSE'
+    else:
+        notified = 'TRUE'
     
     # Initialize dictionary to return
     
@@ -104,7 +122,7 @@ def workflow(sensor_id_dict, ended_alert_ids, runtime, base_config):
             
                 # Update the active_alerts
                 
-                Add_alerts_to_pois(list(sensor_ids), is_sensitive, epsg_code)
+                Add_alerts_to_pois(list(sensor_ids), is_sensitive, poi_engine)
                 
             # ~~~~~~~~~~~~~~~~
             # b) Ended Alerts
@@ -130,29 +148,7 @@ def workflow(sensor_id_dict, ended_alert_ids, runtime, base_config):
         
         if len(poi_ids_to_end_alert) > 0:
         
-            # Get reports_for_day
-        
-            reports_for_day = query.Get_reports_for_day(runtime)
-            
-            new_reports = [] # This is a list of tuples containing (poi_id, report_id)
-        
-            for poi_id in poi_ids_to_end_alert:
-            
-                report_id = Initialize_report(poi_id, reports_for_day, runtime, is_sensitive)
-                
-                new_reports += [(poi_id, report_id)]
-                
-                reports_for_day += 1 
-                
-            reports_dict[is_sensitive] = new_reports # Save for notifications
-                
-            # Update reports for day
-            
-            Update_reports_for_day(runtime, reports_for_day)
-            
-            # Clear the cached alerts
-            
-            Clear_cached_alerts(poi_ids_to_end_alert, is_sensitive)
+            reports_dict[is_sensitive] = Write_reports(poi_ids_to_end_alert, runtime, is_sensitive, notified) # Save for notifications
             
     return reports_dict
 
@@ -162,7 +158,7 @@ def workflow(sensor_id_dict, ended_alert_ids, runtime, base_config):
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def Add_alerts_to_pois(sensor_ids, is_sensitive, epsg_code):
+def Add_alerts_to_pois(sensor_ids, is_sensitive, poi_engine = 'postgis'):
     '''
     This function will update the active_alerts for the POIs
     
@@ -170,29 +166,54 @@ def Add_alerts_to_pois(sensor_ids, is_sensitive, epsg_code):
     
     sensor_ids - list of sensor_ids
     is_sensitive - 'TRUE' or 'FALSE' corresponding to sensitive field in database alert tables 
-    epsg_code - string - epsg code for local UTM coordinate reference system (for distance calculations)
+    poi_engine - string - how to find the nearby POIs
+    
+                  'postgis' = "Sensor POI Adjacency" (maintained by the database, see Database/initialize_tables.sql)
+                  'memory' = the in-memory index in POIs/POI_Index.py
     '''
     
     update_field = 'active_alerts'
     
     if is_sensitive == 'TRUE':
         update_field += '_sensitive'
+        
+    if poi_engine == 'memory':
+        Add_alerts_to_pois_in_memory(sensor_ids, is_sensitive, update_field)
+        return
+        
+    if alert_storage.mode == 'links':
+    
+        cmd = sql.SQL('''
+        INSERT INTO "POI Alerts" (poi_id, alert_id, sensitive, state)
+        SELECT p.poi_id, a.alert_id, a.sensitive, 'active'
+        FROM "Active Alerts" a
+        INNER JOIN "Sensor POI Adjacency" adj ON (adj.sensor_id = a.sensor_id)
+        INNER JOIN "Places of Interest" p ON (p.poi_id = adj.poi_id)
+        WHERE a.sensor_id = ANY ( {} )
+        AND a.sensitive = {}
+        AND p.active = TRUE
+        ON CONFLICT DO NOTHING;
+        ''').format(sql.Literal(sensor_ids),
+                    sql.Literal(is_sensitive))
+        
+        psql.send_update(cmd)
+        
+        return
     
     cmd = sql.SQL('''
     WITH alerts_to_update as
 	(
-	    SELECT alert_id, radius_meters, geometry
-	    FROM alerts_w_info
+	    SELECT alert_id, sensor_id
+	    FROM "Active Alerts"
 	    WHERE sensor_id = ANY ( {} )
 	    AND sensitive = {}
 	), pois_w_alert_ids AS
     (
 	    SELECT p.poi_id, ARRAY_AGG(s.alert_id) as new_alerts
-	    FROM alerts_to_update s, "Places of Interest" p
+	    FROM alerts_to_update s
+	    INNER JOIN "Sensor POI Adjacency" adj ON (adj.sensor_id = s.sensor_id)
+	    INNER JOIN "Places of Interest" p ON (p.poi_id = adj.poi_id)
 	    WHERE p.active = TRUE
-	    AND ST_DWithin(ST_Transform(p.geometry, {}), -- CHANGE THIS!!
-				       ST_Transform(s.geometry, {}), -- CHANGE THIS!!
-				       s.radius_meters)
 	    GROUP BY p.poi_id
     )
     UPDATE "Places of Interest" p
@@ -202,8 +223,74 @@ def Add_alerts_to_pois(sensor_ids, is_sensitive, epsg_code):
     ;
     ''').format(sql.Literal(sensor_ids),
                 sql.Literal(is_sensitive),
-                sql.Literal(int(epsg_code)),
-                sql.Literal(int(epsg_code)),
+                sql.Identifier(update_field),
+                sql.Identifier(update_field))
+    
+    psql.send_update(cmd)
+    
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    
+def Add_alerts_to_pois_in_memory(sensor_ids, is_sensitive, update_field):
+    '''
+    Add_alerts_to_pois with the radius search done in python (see POIs/POI_Index.py)
+    
+    Gets the new alerts' projected locations, finds the nearby POIs for all of them at once,
+    then appends the alert_ids to update_field in one UPDATE
+    '''
+    
+    cmd = sql.SQL('''
+    SELECT alert_id, ST_X(geometry_projected), ST_Y(geometry_projected), radius_meters
+    FROM alerts_w_info
+    WHERE sensor_id = ANY ( {} )
+    AND sensitive = {}
+    AND geometry_projected IS NOT NULL;
+    ''').format(sql.Literal(sensor_ids),
+                sql.Literal(is_sensitive))
+    
+    response = psql.get_response(cmd)
+    
+    if len(response) == 0:
+        return
+    
+    alert_ids, xs, ys, radii = map(list, zip(*response))
+    
+    positions, poi_ids = poi_index.Get_pois_near(xs, ys, radii)
+    
+    if len(poi_ids) == 0:
+        return
+        
+    if alert_storage.mode == 'links':
+    
+        cmd = sql.SQL('''
+        INSERT INTO "POI Alerts" (poi_id, alert_id, sensitive, state)
+        SELECT p.poi_id, pairs.alert_id, {}, 'active'
+        FROM UNNEST({}::bigint[], {}::bigint[]) AS pairs (poi_id, alert_id)
+        INNER JOIN "Places of Interest" p ON (p.poi_id = pairs.poi_id)
+        WHERE p.active = TRUE
+        ON CONFLICT DO NOTHING;
+        ''').format(sql.Literal(is_sensitive),
+                    sql.Literal(poi_ids.tolist()),
+                    sql.Literal([alert_ids[i] for i in positions]))
+        
+        psql.send_update(cmd)
+        
+        return
+    
+    cmd = sql.SQL('''
+    WITH pois_w_alert_ids AS
+    (
+	    SELECT poi_id, ARRAY_AGG(alert_id) as new_alerts
+	    FROM UNNEST({}::bigint[], {}::bigint[]) AS pairs (poi_id, alert_id)
+	    GROUP BY poi_id
+    )
+    UPDATE "Places of Interest" p
+    SET {} = ARRAY_CAT(p.{}, a.new_alerts)
+    FROM pois_w_alert_ids a
+    WHERE p.poi_id = a.poi_id
+    AND p.active = TRUE
+    ;
+    ''').format(sql.Literal(poi_ids.tolist()),
+                sql.Literal([alert_ids[i] for i in positions]),
                 sql.Identifier(update_field),
                 sql.Identifier(update_field))
     
@@ -220,6 +307,10 @@ def Cache_alerts(is_sensitive, ended_alert_ids):
     '''
     This function will update the cached_alerts for the POIs
     
+    Moves every ended alert_id from active_alerts to cached_alerts for all affected POIs in one statement
+    (POIs are found with the GIN index on active_alerts, see Database/initialize_tables.sql)
+    With ALERT_STORAGE=links, their rows in "POI Alerts" become 'cached'
+    
     parameters:
     
     ended_alert_ids - list of integers - the alert_ids that just ended
@@ -231,26 +322,39 @@ def Cache_alerts(is_sensitive, ended_alert_ids):
     if is_sensitive == 'TRUE':
         cache_field += '_sensitive'
         active_field += '_sensitive'
-    
-    for alert_id in ended_alert_ids:
+        
+    if len(ended_alert_ids) == 0:
+        return
+        
+    if alert_storage.mode == 'links':
     
         cmd = sql.SQL('''
-        UPDATE "Places of Interest" p
-        SET {} = ARRAY_REMOVE(p.{}, {}),
-            {} = ARRAY_APPEND(p.{}, {})
-        WHERE {} = ANY ( p.{} )
-        ;
-        ''').format(sql.Identifier(active_field),
-                    sql.Identifier(active_field),
-                    sql.Literal(alert_id),
-                    sql.Identifier(cache_field),
-                    sql.Identifier(cache_field),
-                    sql.Literal(alert_id),
-                    sql.Literal(alert_id),
-                    sql.Identifier(active_field)
-                    )
-    
+        UPDATE "POI Alerts"
+        SET state = 'cached'
+        WHERE alert_id = ANY ( {}::bigint[] )
+        AND sensitive = {}
+        AND state = 'active';
+        ''').format(sql.Literal(list(ended_alert_ids)),
+                    sql.Literal(is_sensitive))
+        
         psql.send_update(cmd)
+        
+        return
+    
+    cmd = sql.SQL('''
+    UPDATE "Places of Interest" p
+    SET {active} = array_diff(p.{active}, {ended}),
+        {cache} = p.{cache} || ARRAY(SELECT e.alert_id
+                                     FROM UNNEST({ended}) WITH ORDINALITY e (alert_id, n)
+                                     WHERE e.alert_id = ANY ( p.{active} )
+                                     ORDER BY e.n)
+    WHERE p.{active} && {ended}
+    ;
+    ''').format(active = sql.Identifier(active_field),
+                cache = sql.Identifier(cache_field),
+                ended = sql.SQL('{}::bigint[]').format(sql.Literal(list(ended_alert_ids))))
+    
+    psql.send_update(cmd)
     
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -258,106 +362,119 @@ def Cache_alerts(is_sensitive, ended_alert_ids):
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def Initialize_report(poi_id, reports_for_day, runtime, is_sensitive):
-    '''
-    This function will initialize a unique report for a poi in the database.
-
-    It will also return the report_id of the report
+def Write_reports(poi_ids, runtime, is_sensitive, notified = 'TRUE'):
     '''
+    This function writes a report for each poi_id into "Reports Archive" and clears their cached_alerts, in one statement
     
-    active_field = 'active_alerts'
-    cache_field = 'cached_alerts'
+    Report ids are numbered by "Daily Log".reports_for_day, which is incremented in the same statement
+    (so the count per day lives in the database - no read then write from python)
     
-    if is_sensitive == 'TRUE':
-        cache_field += '_sensitive'
-        active_field += '_sensitive'
+    parameters:
     
-    # Create Report_id
-    
-    report_date = runtime
-    formatted_runtime = runtime.strftime('%Y-%m-%d %H:%M:%S')
-    
-    report_id = str(reports_for_day).zfill(5) + '-' + report_date.strftime('%m%d%y') # XXXXX-MMDDYY
-    # Use the poi_id to query for the poi's cached_alerts
-    # Then aggregate from those alerts the start_time, time_difference
-    # Lastly, it will insert all the information into "Reports Archive"
-    
-    cmd = sql.SQL('''WITH poi_alert_cache as
-(
-	SELECT name, {} as cached_alerts
-	FROM "Places of Interest"
-	WHERE poi_id = {} --inserted record_id
-), alerts as
-(
-	SELECT MIN(p.start_time) as start_time,
-			{} - MIN(p.start_time) as time_diff
-	FROM "Archived Alerts" p, poi_alert_cache c
-	WHERE p.alert_id = ANY (c.cached_alerts)
-)
-INSERT INTO "Reports Archive" (report_id, poi_name, start_time, duration_minutes, sensitive, alert_ids)
-SELECT {}, -- Inserted report_id
-        p.name,
-        a.start_time, -- start_time
-		(((DATE_PART('day', a.time_diff) * 24) + 
-    		DATE_PART('hour', a.time_diff)) * 60 + 
-		 	DATE_PART('minute', a.time_diff)) as duration_minutes,
-			{}, -- is this report for sensitive populations?
-		p.cached_alerts
-FROM poi_alert_cache p, alerts a; 
-''').format(sql.Identifier(cache_field),
-            sql.Literal(poi_id),
-            sql.Literal(formatted_runtime),
-            sql.Literal(report_id),
-            sql.Literal(is_sensitive))
-
-    psql.send_update(cmd)
-
-    return report_id    
+    poi_ids - list of poi_ids to write reports for (in this order)
+    runtime - datetime - the day to count the reports toward & the end of the alerts
+    is_sensitive - 'TRUE' or 'FALSE' corresponding to sensitive field in database alert tables 
+    notified - 'TRUE' or 'FALSE' - 'FALSE' leaves the reports for the notify worker (see Notify_and_Update_Users.Claim_reports)
     
-# ~~~~~~~~~~~~~~~~
-
-def Update_reports_for_day(runtime, reports_for_day):
-    '''
-    This function updates reports for day to the new value
+    returns a list of tuples of (poi_id, report_id), report_id formatted as #####-MMDDYY
     '''
     
-    formatted_runtime = runtime.strftime('%Y-%m-%d')
-    
-    cmd = sql.SQL(f'''UPDATE "Daily Log"
-                    SET reports_for_day = {reports_for_day}
-                    WHERE date = DATE('{formatted_runtime}');
-                   ''')#.format(sql.Literal(reports_for_day),
-                        #       sql.Literal(formatted_runtime)
-                         #      )
-                   
-    psql.send_update(cmd)
-    
-# ~~~~~~~~~~~~~~~~
-
-# 3) Transfer these alerts from "Sign Up Information" active_alerts to "Sign Up Information" cached_alerts
-
-def Clear_cached_alerts(poi_ids_to_end_alert, is_sensitive):
-    '''
-    This function clears the cached_alerts in the poi_ids given
-    '''
-    active_field = 'active_alerts'
     cache_field = 'cached_alerts'
     
     if is_sensitive == 'TRUE':
         cache_field += '_sensitive'
-        active_field += '_sensitive'
+        
+    if len(poi_ids) == 0:
+        return []
+        
+    # Where the cached alerts are (and how to clear them)
+    
+    if alert_storage.mode == 'links':
+    
+        cached_alerts = sql.SQL('''COALESCE((SELECT ARRAY_AGG(l.alert_id ORDER BY l.alert_id)
+	                     FROM "POI Alerts" l
+	                     WHERE l.poi_id = p.poi_id
+	                     AND l.sensitive = {sensitive}
+	                     AND l.state = 'cached'), {empty}::bigint[])''')
+	                     
+        clear_cache = sql.SQL('''DELETE FROM "POI Alerts" l
+	    USING pois
+	    WHERE l.poi_id = pois.poi_id
+	    AND l.sensitive = {sensitive}
+	    AND l.state = 'cached'
+	    ''')
+    
+    else:
+        
+        cached_alerts = sql.SQL('p.{cache}')
+        
+        clear_cache = sql.SQL('''UPDATE "Places of Interest" p
+	    SET {cache} = {empty}
+	    FROM pois
+	    WHERE p.poi_id = pois.poi_id
+	    ''')
     
     cmd = sql.SQL('''
-    UPDATE "Places of Interest"
-    SET {} = {}
-    WHERE poi_id = ANY ({});
-    ''').format(sql.Identifier(cache_field),
-                sql.Literal('{}'),
-                sql.Literal(poi_ids_to_end_alert)
-               )
-    
-    psql.send_update(cmd) 
-    
-    
-    
-
+    WITH pois as
+    (
+	    SELECT p.poi_id, p.name, {cached_alerts} as cached_alerts,
+	           ROW_NUMBER() OVER (ORDER BY u.n) as n
+	    FROM UNNEST({poi_ids}::bigint[]) WITH ORDINALITY u (poi_id, n)
+	    INNER JOIN "Places of Interest" p ON (p.poi_id = u.poi_id)
+    ), day as
+    (
+	    INSERT INTO "Daily Log" (date, reports_for_day)
+	    VALUES (DATE({runtime}), (SELECT COUNT(*) FROM pois))
+	    ON CONFLICT (date) DO UPDATE
+	    SET reports_for_day = COALESCE("Daily Log".reports_for_day, 0) + EXCLUDED.reports_for_day
+	    RETURNING reports_for_day - (SELECT COUNT(*) FROM pois) as first_number
+    ), numbered as
+    (
+	    SELECT p.poi_id, p.name, p.cached_alerts, p.n,
+	           LPAD((d.first_number + p.n - 1)::text, GREATEST(5, LENGTH((d.first_number + p.n - 1)::text)), '0')
+	           || '-' || {report_date} as report_id
+	    FROM pois p, day d
+    ), alerts as
+    (
+	    SELECT p.poi_id, MIN(a.start_time) as start_time,
+	           {runtime} - MIN(a.start_time) as time_diff
+	    FROM pois p
+	    INNER JOIN "Archived Alerts" a ON (a.alert_id = ANY (p.cached_alerts))
+	    GROUP BY p.poi_id
+    ), reports as
+    (
+	    INSERT INTO "Reports Archive" (report_id, poi_name, start_time, duration_minutes, sensitive, alert_ids, poi_id, notified)
+	    SELECT r.report_id,
+	           r.name,
+	           a.start_time,
+	           (((DATE_PART('day', a.time_diff) * 24) + 
+	               DATE_PART('hour', a.time_diff)) * 60 + 
+	               DATE_PART('minute', a.time_diff)) as duration_minutes,
+	           {sensitive}, -- is this report for sensitive populations?
+	           r.cached_alerts,
+	           r.poi_id,
+	           {notified}
+	    FROM numbered r
+	    LEFT JOIN alerts a ON (a.poi_id = r.poi_id)
+    ), cleared as
+    (
+	    {clear_cache}
+    )
+    SELECT poi_id, report_id
+    FROM numbered
+    ORDER BY n;
+    ''').format(cached_alerts = cached_alerts.format(cache = sql.Identifier(cache_field),
+                                                     sensitive = sql.Literal(is_sensitive),
+                                                     empty = sql.Literal('{}')),
+                clear_cache = clear_cache.format(cache = sql.Identifier(cache_field),
+                                                 sensitive = sql.Literal(is_sensitive),
+                                                 empty = sql.Literal('{}')),
+                poi_ids = sql.Literal(list(poi_ids)),
+                runtime = sql.Literal(runtime.strftime('%Y-%m-%d %H:%M:%S')),
+                report_date = sql.Literal(runtime.strftime('%m%d%y')),
+                sensitive = sql.Literal(is_sensitive),
+                notified = sql.Literal(notified))
+    
+    response = psql.get_response(cmd)
+    
+    return [(poi_id, report_id) for poi_id, report_id in response]
@@ -38,7 +38,7 @@ def get_new_users(max_api_id):
     returns a pandas dataframe with fields:
     
     poi_id, -- int REFERENCES base."Places of Interest" (poi_id), -- Aligns with a POI in the database, might change to an array one day
-	contact_method, -- text, -- How will we get a hold of this user? Should be a script in App/modules/Users/Contact_Methods/{contact_method}.py with a function send_messages()
+	contact_method, -- text, -- How will we get a hold of this user? Should be a script in App/modules/Users/Contact_Methods/{contact_method}.py with a function send_message() (see App/modules/Users/Dispatch.py)
 	api_id, -- text, -- This should be the identifier for wherever the contact info is stored (if not in this database)
 	sensitive, -- boolean, -- True = send alerts when "Unhealthy for sensitive populations"
 	days_to_contact, -- int [] DEFAULT array[1,2,3,4,5,6,7]::int[], -- 1 = Monday, 7 = Sunday
@@ -1,30 +1,50 @@
 import os
-import time
 
-def send_messages(contact_info_list, messages): 
+# The provider's limits (see App/modules/Users/Dispatch.py) - can be overridden in .env with
+# TEMPLATE_MESSAGES_PER_SECOND and TEMPLATE_BURST
+
+messages_per_second = 1
+burst = 1
+
+# Set to True if send_message passes key on to the provider (eg. as an idempotency key or deduplication id),
+# so a message sent again (after a retry or a crash) is only delivered once
+
+idempotency_keys = False
+
+def send_message(contact_info, message, key = None):
     '''
-    basic send function that takes in a list of contact informations + list of messages and sends them out
+    basic send function that takes in one contact information + message and sends it out
+    key - string - the same for every send of one message (only passed with idempotency_keys = True)
     
-    returns unsubscribe_indices that correspond to indices of both above lists
+    returns True if sent, False if the contact has unsubscribed
+    raises an exception if the message failed to send (Dispatch will retry it)
     '''
-
-    # Check Unsubscriptions
     
-    unsubscribed_indices = check_unsubscriptions(contact_info_list)
+    # Check Unsubscriptions
     
-    # pop() unsubscriptions from contact_info_list/messages list
-        
-    for unsubscribed_index in unsubscribed_indices:
-        contact_info_list.pop(unsubscribed_index)
-        messages.pop(unsubscribed_index)
+    if len(check_unsubscriptions([contact_info])) > 0:
+        return False
         
     # CHANGE BELOW
 
-    for contact_info, message in zip(contact_info_list, messages):
-
-        print('contact info: ', contact_info, '\n\n message:\n', message)
+    print('contact info: ', contact_info, '\n\n message:\n', message)
         
-        time.sleep(1) # Sleeping for 1 second between sending messages
+    return True
+
+def send_messages(contact_info_list, messages): 
+    '''
+    basic send function that takes in a list of contact informations + list of messages and sends them out
+    (one at a time, no rate limit - see App/modules/Users/Dispatch.py to send many messages)
+    
+    returns unsubscribe_indices that correspond to indices of both above lists
+    '''
+
+    unsubscribed_indices = []
+    
+    for i, (contact_info, message) in enumerate(zip(contact_info_list, messages)):
+
+        if not send_message(contact_info, message):
+            unsubscribed_indices += [i]
         
     return unsubscribed_indices
     
@@ -0,0 +1,267 @@
+# Sends messages concurrently under a rate limit for each contact method (provider)
+
+# Each contact method in App/modules/Users/Contact_Methods gets a token bucket -
+# a message can only go out when there's a token, and tokens refill at messages_per_second up to burst.
+# Each contact method's sends run in its own thread pool, so delivery time is bounded by each provider's limits
+# instead of a fixed sleep, and a slow provider can't take the workers of a fast one.
+# Failed sends are retried with a backoff, and every message gets an outcome (sent, unsubscribed or failed)
+
+# Contact methods should define
+
+# send_message(contact_info, message) - returns True if sent, False if that contact has unsubscribed, raises if it failed
+# messages_per_second, burst (optional) - the provider's limits
+# idempotency_keys (optional) - True if send_message(contact_info, message, key) passes key on to the provider,
+#                                so it can drop a message it has already accepted (eg. one sent again after a crash)
+
+# Older contact methods with only send_messages(contact_info_list, messages) are sent in one batch
+
+# Configured in the .env file with (METHOD is the contact method's name in capitals, eg. TEMPLATE)
+
+# METHOD_MESSAGES_PER_SECOND, METHOD_BURST - override the contact method's limits
+# DISPATCH_MESSAGES_PER_SECOND, DISPATCH_BURST - limits for contact methods that don't set them (default 1, 1)
+# DISPATCH_MAX_WORKERS - the most messages being sent at once per contact method (default 8)
+# DISPATCH_RETRIES - times to retry a failed message (default 2)
+# DISPATCH_RETRY_SECONDS - wait before the first retry, doubling after each one (default 1)
+
+## Load modules
+
+import os # For working with Operating System
+from dotenv import load_dotenv # Loading .env info
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Data Manipulation
+
+import pandas as pd
+
+# Importing Libraries
+from importlib import import_module
+
+load_dotenv()
+
+# ~~~~~~~~~~~~~~
+
+# Settings
+
+default_messages_per_second = float(os.getenv('DISPATCH_MESSAGES_PER_SECOND', 1))
+default_burst = int(os.getenv('DISPATCH_BURST', 1))
+max_workers = int(os.getenv('DISPATCH_MAX_WORKERS', 8))
+retries = int(os.getenv('DISPATCH_RETRIES', 2))
+retry_seconds = float(os.getenv('DISPATCH_RETRY_SECONDS', 1))
+
+# ~~~~~~~~~~~~~~
+
+def Make_bucket(messages_per_second, burst):
+    '''
+    A token bucket (dictionary) that starts full
+
+    parameters:
+
+    messages_per_second - float - rate the tokens refill
+    burst - int - most tokens the bucket holds (messages that can go out at once)
+    '''
+
+    return {'rate' : float(messages_per_second),
+            'capacity' : max(float(burst), 1.0),
+            'tokens' : max(float(burst), 1.0),
+            'updated' : time.monotonic(),
+            'lock' : threading.Lock()
+            }
+
+# ~~~~~~~~~~~~~~
+
+def Take_token(bucket):
+    '''
+    Waits until the bucket has a token, then takes it
+    '''
+
+    while True:
+
+        with bucket['lock']:
+
+            now = time.monotonic()
+
+            bucket['tokens'] = min(bucket['capacity'],
+                                   bucket['tokens'] + (now - bucket['updated']) * bucket['rate'])
+            bucket['updated'] = now
+
+            if bucket['tokens'] >= 1:
+                bucket['tokens'] -= 1
+                return
+
+            wait = (1 - bucket['tokens']) / bucket['rate']
+
+        time.sleep(wait)
+
+# ~~~~~~~~~~~~~~
+
+def Get_bucket(method, module):
+    '''
+    Makes the token bucket for a contact method from the .env file, the module's limits or the defaults (in that order)
+    '''
+
+    messages_per_second = os.getenv(f'{method.upper()}_MESSAGES_PER_SECOND',
+                                    getattr(module, 'messages_per_second', default_messages_per_second))
+    burst = os.getenv(f'{method.upper()}_BURST', getattr(module, 'burst', default_burst))
+
+    return Make_bucket(float(messages_per_second), int(burst))
+
+# ~~~~~~~~~~~~~~
+
+def Send_one(module, bucket, contact_info, message, key = None):
+    '''
+    Sends one message with module.send_message once there's a token, retrying if it fails
+
+    key (optional) is passed on to contact methods with idempotency_keys = True - every retry uses the same one,
+    so the provider can drop a copy it already accepted
+
+    returns outcome ('sent', 'unsubscribed' or 'failed'), attempts (int), error (string or None)
+    '''
+
+    error = None
+
+    for attempt in range(1, retries + 2):
+
+        Take_token(bucket)
+
+        try:
+            if key is not None and getattr(module, 'idempotency_keys', False):
+                sent = module.send_message(contact_info, message, key)
+            else:
+                sent = module.send_message(contact_info, message)
+
+            if sent:
+                return 'sent', attempt, None
+            else:
+                return 'unsubscribed', attempt, None
+
+        except Exception as e:
+            error = repr(e)
+
+        if attempt <= retries:
+            time.sleep(retry_seconds * 2**(attempt - 1))
+
+    return 'failed', attempt, error
+
+# ~~~~~~~~~~~~~~
+
+def Send_batch(module, contacts, messages):
+    '''
+    Sends a whole batch with an older contact method's send_messages (no rate limit or retries)
+
+    returns a list of (outcome, attempts, error) with the same indexing as contacts/messages
+    '''
+
+    try:
+        unsubscribed_indices = set(module.send_messages(list(contacts), list(messages)))
+
+    except Exception as e:
+        return [('failed', 1, repr(e))] * len(contacts)
+
+    return [('unsubscribed' if i in unsubscribed_indices else 'sent', 1, None) for i in range(len(contacts))]
+
+# ~~~~~~~~~~~~~~
+
+def Send_messages(methods, contacts, messages, keys = None, on_outcome = None):
+    '''
+    Sends every message with its contact method, concurrently and rate limited per contact method
+
+    Each contact method gets its own thread pool (up to DISPATCH_MAX_WORKERS), so workers waiting
+    on one provider's rate limit or retries never hold up the others
+
+    parameters:
+
+    methods - list of strings - contact method for each message (a script name in App/modules/Users/Contact_Methods)
+    contacts - list - contact information for each message
+    messages - list of strings
+    keys - list (optional) - an idempotency key for each message, for contact methods that take one
+    on_outcome - function (optional) - called as on_outcome(i, outcome, attempts, error) as soon as message i is done
+                 (from the sending threads)
+
+    returns outcome_df, a dataframe with the same indexing as the lists and fields:
+
+    contact_method, outcome ('sent', 'unsubscribed' or 'failed'), attempts, error
+
+    If something unexpected is raised, the messages not yet started are cancelled
+    (the ones being sent finish, and get their on_outcome, first)
+    '''
+
+    outcome_df = pd.DataFrame({'contact_method' : list(methods),
+                               'outcome' : 'failed',
+                               'attempts' : 0,
+                               'error' : None})
+
+    if len(outcome_df) == 0:
+        return outcome_df
+
+    keys = list(keys) if keys is not None else [None] * len(outcome_df)
+
+    results = [None] * len(outcome_df)
+
+    def Done(positions, is_batch, future):
+        '''
+        Records a finished job's outcomes (runs in the thread that finished it)
+        '''
+
+        if future.cancelled() or future.exception() is not None:
+            return # Raised when collecting below
+
+        result = future.result() if is_batch else [future.result()]
+
+        for i, outcome in zip(positions, result):
+
+            results[i] = outcome
+
+            if on_outcome is not None:
+                on_outcome(i, *outcome)
+
+    # Submit each contact method's messages to its own pool
+
+    executors = []
+    futures = []
+
+    try:
+        for method, positions in outcome_df.groupby('contact_method', sort = False).indices.items():
+
+            module = import_module(f'modules.Users.Contact_Methods.{method}')
+
+            if hasattr(module, 'send_message'):
+
+                bucket = Get_bucket(method, module)
+
+                executor = ThreadPoolExecutor(max_workers = min(max_workers, len(positions)),
+                                              thread_name_prefix = f'dispatch_{method}')
+                executors += [executor]
+
+                for i in positions:
+                    future = executor.submit(Send_one, module, bucket, contacts[i], messages[i], keys[i])
+                    future.add_done_callback(partial(Done, [i], False))
+                    futures += [future]
+
+            else:
+                executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = f'dispatch_{method}')
+                executors += [executor]
+
+                future = executor.submit(Send_batch, module, [contacts[i] for i in positions], [messages[i] for i in positions])
+                future.add_done_callback(partial(Done, list(positions), True))
+                futures += [future]
+
+        # Wait for them all (raising anything unexpected)
+
+        for future in futures:
+            future.result()
+
+    finally:
+        for executor in executors:
+            executor.shutdown(cancel_futures = True)
+
+    outcome_df[['outcome', 'attempts', 'error']] = pd.DataFrame(results, columns = ['outcome', 'attempts', 'error'])
+
+    failed = outcome_df[outcome_df.outcome == 'failed']
+
+    if len(failed) > 0:
+        print(f'\n~~~\nWarning: {len(failed)} messages failed to send. First error: {failed.error.iloc[0]}\n~~~\n')
+
+    return outcome_df
@@ -0,0 +1,408 @@
+# A durable queue of messages to send (base."Outbox", see Database/readme.md)
+
+# The notify stage (modules/Notify_and_Update_Users.py) only Enqueues messages - in the same statement that updates "Users" -
+# so the sensor loop never waits on SMS/email. A worker then drains the outbox in batches:
+
+# 1) Claim a batch - rows are locked with FOR UPDATE SKIP LOCKED (so workers never claim the same message)
+#    and leased to the worker for OUTBOX_LEASE_SECONDS (status = 'sending')
+# 2) Send them (modules/Users/Send_Messages.py) - the lease is renewed every third of OUTBOX_LEASE_SECONDS while sending,
+#    so slow (rate limited) batches stay ours
+# 3) Mark each one 'sent', 'unsubscribed' or 'failed' by message_id as soon as it's done - only if the claim is still ours (same attempts)
+#    If sending raises, the messages that weren't sent go straight back to 'queued'
+# 4) Then unsubscribe users & count the messages sent (failures there can't stop the marking)
+
+# Delivery is at least once, not exactly once: if a worker dies between a provider accepting a message and marking it,
+# the message is claimed again once the lease runs out (up to OUTBOX_MAX_ATTEMPTS times) and sent again.
+# Contact methods that take an idempotency key get the message_id (see modules/Users/Dispatch.py), so their provider can drop the copy
+
+# Configured in the .env file with
+
+# OUTBOX_WORKER - 'thread' (drain in the background of App/spikealerts.py) or 'separate' (run App/outbox_worker.py)
+# OUTBOX_BATCH_SIZE - most messages to claim at once (default 500)
+# OUTBOX_POLL_SECONDS - seconds to wait when the outbox is empty (default 5)
+# OUTBOX_LEASE_SECONDS - seconds without a renewal before a batch can be claimed again (default 900)
+# OUTBOX_MAX_ATTEMPTS - most claims of a message before giving up on it (default 3)
+
+## Load modules
+
+import os # For working with Operating System
+from dotenv import load_dotenv # Loading .env info
+import queue
+import threading
+import time
+import traceback # Showing full error traceback
+
+# Database
+
+from modules.Database import Basic_PSQL as psql
+from psycopg2 import sql
+
+# Data Manipulation
+
+import pandas as pd
+
+# Sending
+
+from modules.Users import Send_Messages
+
+load_dotenv()
+
+# ~~~~~~~~~~~~~~
+
+# Settings
+
+worker_mode = os.getenv('OUTBOX_WORKER', 'thread').lower() # 'thread' or 'separate'
+
+if worker_mode not in ['thread', 'separate']:
+    raise ValueError(f"OUTBOX_WORKER must be 'thread' or 'separate', not {worker_mode!r}")
+
+batch_size = int(os.getenv('OUTBOX_BATCH_SIZE', 500))
+poll_seconds = float(os.getenv('OUTBOX_POLL_SECONDS', 5))
+lease_seconds = int(os.getenv('OUTBOX_LEASE_SECONDS', 900))
+max_attempts = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 3))
+
+# ~~~~~~~~~~~~~~
+
+def Enqueue(messaging_df, alerted, timezone):
+    '''
+    Adds messages to the outbox and updates their users in one statement (both happen or neither do)
+
+    Changes alerted = True or False and last_contact = CURRENT_TIMESTAMP for the users
+
+    parameters:
+
+    messaging_df - a dataframe with fields: user_id, contact_method, api_id, message
+    alerted - string - TRUE or FALSE (not case senstive)
+    timezone - string - pytz timezone
+    '''
+
+    if len(messaging_df) == 0:
+        return
+
+    cmd = sql.SQL('''
+    WITH queued AS
+    (
+    INSERT INTO "Outbox" (user_id, contact_method, api_id, message, queued_at)
+    SELECT m.user_id, m.contact_method, m.api_id, m.message,
+           (CURRENT_TIMESTAMP AT TIME ZONE {timezone})::timestamp
+    FROM UNNEST({user_ids}::int[], {contact_methods}::text[], {api_ids}::text[], {messages}::text[])
+         AS m(user_id, contact_method, api_id, message)
+    RETURNING user_id
+    )
+    UPDATE "Users"
+    SET alerted = {alerted},
+    last_contact = (CURRENT_TIMESTAMP AT TIME ZONE {timezone})::timestamp
+    WHERE user_id IN (SELECT user_id FROM queued);
+    ''').format(timezone = sql.Literal(timezone),
+                user_ids = sql.Literal([int(user_id) for user_id in messaging_df.user_id]),
+                contact_methods = sql.Literal(messaging_df.contact_method.to_list()),
+                api_ids = sql.Literal([str(api_id) for api_id in messaging_df.api_id]),
+                messages = sql.Literal(messaging_df.message.to_list()),
+                alerted = sql.Literal(alerted)
+                )
+
+    psql.send_update(cmd)
+
+# ~~~~~~~~~~~~~~
+
+def Claim_batch(timezone):
+    '''
+    Claims up to OUTBOX_BATCH_SIZE messages to send - queued ones, or ones whose worker's lease ran out
+    Messages that ran out of attempts are marked 'failed' first
+
+    returns a dataframe indexed by message_id with fields: attempts, contact_method, api_id, message
+    '''
+
+    now = sql.SQL('(CURRENT_TIMESTAMP AT TIME ZONE {})::timestamp').format(sql.Literal(timezone))
+
+    cmd = sql.SQL('''
+    UPDATE "Outbox"
+    SET status = 'failed',
+    lease_until = NULL,
+    error = 'Gave up after ' || attempts || ' attempts (lease ran out)'
+    WHERE status = 'sending'
+    AND lease_until < {now}
+    AND attempts >= {max_attempts};
+    ''').format(now = now,
+                max_attempts = sql.Literal(max_attempts))
+
+    psql.send_update(cmd)
+
+    cmd = sql.SQL('''
+    WITH claimable AS
+    (
+    SELECT message_id
+    FROM "Outbox"
+    WHERE status = 'queued'
+    OR (status = 'sending' AND lease_until < {now})
+    ORDER BY message_id
+    LIMIT {batch_size}
+    FOR UPDATE SKIP LOCKED
+    )
+    UPDATE "Outbox" o
+    SET status = 'sending',
+    attempts = o.attempts + 1,
+    lease_until = {now} + {lease}
+    FROM claimable c
+    WHERE o.message_id = c.message_id
+    RETURNING o.message_id, o.attempts, o.contact_method, o.api_id, o.message;
+    ''').format(now = now,
+                batch_size = sql.Literal(batch_size),
+                lease = sql.Literal(f'{lease_seconds} seconds') + sql.SQL('::interval'))
+
+    response = psql.get_response(cmd)
+
+    claimed_df = pd.DataFrame(response, columns = ['message_id', 'attempts', 'contact_method', 'api_id', 'message'])
+
+    return claimed_df.set_index('message_id').sort_index()
+
+# ~~~~~~~~~~~~~~
+
+def Mark_outcomes(claimed_df, outcome_df, timezone):
+    '''
+    Records how claimed messages went - only where the claim is still ours
+    (the lease hadn't run out and the message been claimed again) and the message isn't marked yet
+
+    parameters:
+
+    claimed_df - dataframe from Claim_batch
+    outcome_df - dataframe indexed by message_id (some or all of claimed_df's) with fields: outcome, error
+    timezone - string - pytz timezone
+    '''
+
+    if len(outcome_df) == 0:
+        return
+
+    cmd = sql.SQL('''
+    UPDATE "Outbox" o
+    SET status = d.status,
+    error = d.error,
+    lease_until = NULL,
+    sent_at = CASE WHEN d.status = 'sent' THEN (CURRENT_TIMESTAMP AT TIME ZONE {timezone})::timestamp END
+    FROM UNNEST({message_ids}::bigint[], {attempts}::int[], {statuses}::text[], {errors}::text[])
+         AS d(message_id, attempts, status, error)
+    WHERE o.message_id = d.message_id
+    AND o.attempts = d.attempts
+    AND o.status = 'sending';
+    ''').format(timezone = sql.Literal(timezone),
+                message_ids = sql.Literal([int(message_id) for message_id in outcome_df.index]),
+                attempts = sql.Literal([int(attempts) for attempts in claimed_df.attempts.loc[outcome_df.index]]),
+                statuses = sql.Literal(outcome_df.outcome.to_list()),
+                errors = sql.Literal([error if isinstance(error, str) else None for error in outcome_df.error])
+                )
+
+    psql.send_update(cmd)
+
+# ~~~~~~~~~~~~~~
+
+def Keep_marking(claimed_df, timezone, outcome_queue):
+    '''
+    Marks messages as the senders finish them (run in a thread while sending), until a None is put in outcome_queue
+
+    Each UPDATE marks every outcome waiting in outcome_queue - (message_id, outcome, error) tuples
+    If one fails, Send_batch marks them again at the end of the batch
+    '''
+
+    finished = False
+
+    while not finished:
+
+        rows = [outcome_queue.get()]
+
+        while not outcome_queue.empty():
+            rows += [outcome_queue.get()]
+
+        finished = None in rows
+
+        outcome_df = pd.DataFrame([row for row in rows if row is not None],
+                                  columns = ['message_id', 'outcome', 'error']).set_index('message_id')
+
+        try:
+            Mark_outcomes(claimed_df, outcome_df, timezone)
+
+        except Exception as e:
+            print(f'\n~~~\nWarning: Could not mark {len(outcome_df)} outbox messages ({e})\n~~~\n')
+
+# ~~~~~~~~~~~~~~
+
+def Requeue(claimed_df, timezone):
+    '''
+    Puts claimed messages straight back in the queue (only the ones still claimed by us)
+    They weren't sent, so this claim doesn't count towards OUTBOX_MAX_ATTEMPTS
+
+    parameters:
+
+    claimed_df - dataframe from Claim_batch (or some of its rows)
+    timezone - string - pytz timezone
+    '''
+
+    if len(claimed_df) == 0:
+        return
+
+    cmd = sql.SQL('''
+    UPDATE "Outbox" o
+    SET status = 'queued',
+    attempts = o.attempts - 1,
+    lease_until = NULL
+    FROM UNNEST({message_ids}::bigint[], {attempts}::int[]) AS d(message_id, attempts)
+    WHERE o.message_id = d.message_id
+    AND o.attempts = d.attempts
+    AND o.status = 'sending';
+    ''').format(message_ids = sql.Literal([int(message_id) for message_id in claimed_df.index]),
+                attempts = sql.Literal([int(attempts) for attempts in claimed_df.attempts])
+                )
+
+    psql.send_update(cmd)
+
+# ~~~~~~~~~~~~~~
+
+def Renew_lease(claimed_df, timezone):
+    '''
+    Extends the lease on a claimed batch by OUTBOX_LEASE_SECONDS (only the messages still claimed by us)
+
+    parameters:
+
+    claimed_df - dataframe from Claim_batch
+    timezone - string - pytz timezone
+    '''
+
+    cmd = sql.SQL('''
+    UPDATE "Outbox" o
+    SET lease_until = (CURRENT_TIMESTAMP AT TIME ZONE {timezone})::timestamp + {lease}
+    FROM UNNEST({message_ids}::bigint[], {attempts}::int[]) AS d(message_id, attempts)
+    WHERE o.message_id = d.message_id
+    AND o.attempts = d.attempts
+    AND o.status = 'sending';
+    ''').format(timezone = sql.Literal(timezone),
+                lease = sql.Literal(f'{lease_seconds} seconds') + sql.SQL('::interval'),
+                message_ids = sql.Literal([int(message_id) for message_id in claimed_df.index]),
+                attempts = sql.Literal([int(attempts) for attempts in claimed_df.attempts])
+                )
+
+    psql.send_update(cmd)
+
+# ~~~~~~~~~~~~~~
+
+def Keep_lease(claimed_df, timezone, done_event):
+    '''
+    Renews the lease every third of OUTBOX_LEASE_SECONDS until done_event is set (run in a thread while sending)
+    '''
+
+    while not done_event.wait(lease_seconds / 3):
+
+        try:
+            Renew_lease(claimed_df, timezone)
+
+        except Exception as e:
+            print(f'\n~~~\nWarning: Could not renew the outbox lease ({e})\n~~~\n')
+
+# ~~~~~~~~~~~~~~
+
+def Send_batch(claimed_df, contact_info_api, timezone):
+    '''
+    Sends a claimed batch - keeping its lease and marking each message as soon as it's done -
+    then unsubscribes users & counts the messages sent
+
+    If sending raises, the messages without an outcome (not sent) go straight back in the queue, and the error is raised
+    '''
+
+    done_event = threading.Event()
+    outcome_queue = queue.Queue()
+    finished_ids = [] # message_ids with an outcome
+
+    def On_outcome(message_id, outcome, error):
+        finished_ids.append(message_id)
+        outcome_queue.put((message_id, outcome, error))
+
+    renewer = threading.Thread(target = Keep_lease, args = (claimed_df, timezone, done_event),
+                               name = 'outbox_lease', daemon = True)
+    marker = threading.Thread(target = Keep_marking, args = (claimed_df, timezone, outcome_queue),
+                              name = 'outbox_marker', daemon = True)
+    renewer.start()
+    marker.start()
+
+    # The message_id lets contact methods that take an idempotency key drop a message they already accepted
+
+    messaging_df = claimed_df[['contact_method', 'api_id', 'message']].assign(
+                                    idempotency_key = [f'spikealerts-outbox-{message_id}' for message_id in claimed_df.index])
+
+    outcome_df = None
+
+    try:
+        outcome_df = Send_Messages.Send(messaging_df, contact_info_api, on_outcome = On_outcome)
+
+    finally:
+        done_event.set()
+        outcome_queue.put(None) # Mark what's left, then stop
+        renewer.join()
+        marker.join()
+
+        if outcome_df is None: # Sending raised
+            Requeue(claimed_df[~claimed_df.index.isin(finished_ids)], timezone)
+
+    Mark_outcomes(claimed_df, outcome_df, timezone) # Any the marker couldn't (the rest are no longer 'sending')
+
+    Send_Messages.Record_outcomes(outcome_df, timezone)
+
+# ~~~~~~~~~~~~~~
+
+def Drain(contact_info_api, timezone):
+    '''
+    Claims, sends, and marks batches until the outbox is empty
+
+    returns the number of messages handled (int)
+    '''
+
+    handled = 0
+
+    while True:
+
+        claimed_df = Claim_batch(timezone)
+
+        if len(claimed_df) == 0:
+            return handled
+
+        Send_batch(claimed_df, contact_info_api, timezone)
+
+        handled += len(claimed_df)
+
+# ~~~~~~~~~~~~~~
+
+def Run_worker(contact_info_api, timezone, stop_event = None):
+    '''
+    Drains the outbox, then checks again every OUTBOX_POLL_SECONDS until stop_event is set (forever if None)
+    Errors are printed and the worker carries on (unmarked messages are claimed again once their lease runs out)
+    '''
+
+    stop_event = stop_event or threading.Event()
+
+    while not stop_event.is_set():
+
+        try:
+            handled = Drain(contact_info_api, timezone)
+
+            if handled > 0:
+                print(f'Outbox: handled {handled} messages')
+
+        except Exception:
+            print('\n~~~~~~~~~~~~~~OUTBOX ERROR~~~~~~~~~~~~\n')
+            traceback.print_exc()
+
+        stop_event.wait(poll_seconds)
+
+# ~~~~~~~~~~~~~~
+
+def Start_worker_thread(contact_info_api, timezone):
+    '''
+    Runs Run_worker in a background (daemon) thread of this process
+
+    returns the thread and its stop_event (set it to stop the worker)
+    '''
+
+    stop_event = threading.Event()
+
+    thread = threading.Thread(target = Run_worker, args = (contact_info_api, timezone, stop_event),
+                              name = 'outbox_worker', daemon = True)
+    thread.start()
+
+    return thread, stop_event
@@ -19,21 +19,53 @@ import pandas as pd
 
 # Importing Libraries
 from importlib import import_module
+
+# Sending
+
+from modules.Users import Dispatch
   
 # ~~~~~~~~~~~~~~ 
    
 def workflow(messaging_df, contact_info_api, timezone):
     '''
     This function will send each message to the corresponding users
+    (concurrently, rate limited for each contact method - see modules/Users/Dispatch.py)
+    then unsubscribe users & count the messages sent (see Record_outcomes)
 
     parameters:
     
     messaging_df - a dataframe with fields: contact_method, api_id, message
+    
+    returns outcome_df (see Send)
+    '''
+    
+    outcome_df = Send(messaging_df, contact_info_api)
+    
+    Record_outcomes(outcome_df, timezone)
+    
+    return outcome_df
+    
+# ~~~~~~~~~~~~~
+
+def Send(messaging_df, contact_info_api, on_outcome = None):
     '''
+    Sends each message to the corresponding users - nothing is written to our database
+    
+    Each message gets the outcome of its own row of messaging_df (matched by api_id & message),
+    so a Contact_Info_API that skips a user can't shift the outcomes of the others
+    
+    parameters:
+    
+    messaging_df - a dataframe with fields: contact_method, api_id, message
+                   (and optionally idempotency_key - passed to contact methods that take one, see modules/Users/Dispatch.py)
+    on_outcome - function (optional) - called as on_outcome(index, outcome, error) as soon as each message is done
+                 (index is the message's index in messaging_df)
     
-    # Initialize count for number of messages sent
+    returns outcome_df - messaging_df's contact_method & api_id with the fields outcome ('sent', 'unsubscribed' or 'failed'), attempts, error
+                 (same index as messaging_df - messages without contact information are 'failed')
+    '''
     
-    messages_sent = len(messaging_df)
+    index, methods, api_ids, contacts, messages, keys = [], [], [], [], [], []
     
     # Get contact methods to iterate through
     
@@ -48,23 +80,93 @@ def workflow(messaging_df, contact_info_api, timezone):
         # Get the contact information (from the more secure external storage)
         
         module = f'modules.Users.Contact_Info_APIs.{contact_info_api}'
-        api_ids, contacts, messages = import_module(module).get_contacts(temp_df) # Make sure this returns these 3 lists with same indexing!!
+        temp_api_ids, temp_contacts, temp_messages = import_module(module).get_contacts(temp_df) # Make sure this returns these 3 lists with same indexing!!
         
-        # Send Messages (Using this method)
-        # Returns indices of the above tuples that have unsubscribed
+        # Match them back to the rows of temp_df
         
-        module = f'modules.Users.Contact_Methods.{method}'
-        unsubscribed_indices = import_module(module).send_messages(contacts, messages) 
+        rows = {}
         
-        # If any of these users have unsubscribed, change active in our database
-        if len(unsubscribed_indices) > 0:
+        for i, api_id, message in zip(temp_df.index, temp_df.api_id, temp_df.message):
+            rows.setdefault((str(api_id), message), []).append(i)
         
-            api_ids_to_unsubscribe = list(np.array(api_ids)[unsubscribed_indices])
-            Unsubscribe_users(method, api_ids_to_unsubscribe)
+        for api_id, contact, message in zip(temp_api_ids, temp_contacts, temp_messages):
+            
+            matches = rows.get((str(api_id), message))
+            
+            if not matches: # Not one of our messages
+                continue
             
-            messages_sent -= unsubscribed_indices # Didn't send these messages
+            index += [matches.pop(0)]
+            methods += [method]
+            api_ids += [api_id]
+            contacts += [contact]
+            messages += [message]
+            
+            if 'idempotency_key' in messaging_df:
+                keys += [messaging_df.at[index[-1], 'idempotency_key']]
+    
+    # Messages without contact information
+    
+    missing_df = messaging_df.loc[~messaging_df.index.isin(index), ['contact_method', 'api_id']].assign(
+                                                                    outcome = 'failed', attempts = 0,
+                                                                    error = 'No contact information')
     
-    update_daily_log(messages_sent, timezone)
+    if len(missing_df) > 0:
+        print(f'\n~~~\nWarning: No contact information for {len(missing_df)} messages\n~~~\n')
+        
+        if on_outcome is not None:
+            for i in missing_df.index:
+                on_outcome(i, 'failed', 'No contact information')
+        
+    # Send Messages
+    
+    if on_outcome is not None:
+        report = lambda position, outcome, attempts, error: on_outcome(index[position], outcome, error)
+    else:
+        report = None
+        
+    outcome_df = Dispatch.Send_messages(methods, contacts, messages, keys = keys or None, on_outcome = report)
+    outcome_df.insert(1, 'api_id', api_ids)
+    outcome_df.index = index
+    
+    if len(missing_df) > 0:
+        outcome_df = pd.concat([outcome_df, missing_df])
+    
+    return outcome_df.loc[messaging_df.index]
+    
+# ~~~~~~~~~~~~~
+
+def Record_outcomes(outcome_df, timezone):
+    '''
+    Unsubscribes users & adds the messages sent to the "Daily Log"
+    
+    Failures are printed, not raised (the messages have already gone out)
+    
+    parameters:
+    
+    outcome_df - dataframe from Send
+    timezone - string - pytz timezone
+    '''
+    
+    # If any of these users have unsubscribed, change active in our database
+    
+    unsubscribed_df = outcome_df[outcome_df.outcome == 'unsubscribed']
+    
+    for method, api_ids_to_unsubscribe in unsubscribed_df.groupby('contact_method').api_id:
+    
+        try:
+            Unsubscribe_users(api_ids_to_unsubscribe.to_list(), method)
+            
+        except Exception as e:
+            print(f'\n~~~\nWarning: Could not unsubscribe {len(api_ids_to_unsubscribe)} {method} users ({e})\n~~~\n')
+    
+    messages_sent = int((outcome_df.outcome == 'sent').sum()) # Didn't send the unsubscribed or failed messages
+    
+    try:
+        update_daily_log(messages_sent, timezone)
+        
+    except Exception as e:
+        print(f'\n~~~\nWarning: Could not add {messages_sent} messages sent to the "Daily Log" ({e})\n~~~\n')
     
 # ~~~~~~~~~~~~~
 
@@ -85,14 +187,19 @@ def update_daily_log(messages_sent, timezone):
     
 def Unsubscribe_users(api_ids, contact_method):
     '''
-    Change record_ids to subscribed = FALSE in our database
+    Change these users to active = FALSE in our "Users" table
+    
+    parameters:
+    
+    api_ids - list - api_ids of the users that unsubscribed
+    contact_method - string - the contact method they unsubscribed from
     '''
     
-    cmd = sql.SQL('''UPDATE "Sign Up Information"
+    cmd = sql.SQL('''UPDATE "Users"
     SET active = FALSE
-WHERE api_id = ANY ( {} )
+WHERE api_id = ANY ( {}::text[] )
 AND contact_method = {};
-    ''').format(sql.Literal(api_ids),
+    ''').format(sql.Literal([str(api_id) for api_id in api_ids]),
                 sql.Literal(contact_method))
     
     psql.send_update(cmd)
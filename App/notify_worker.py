@@ -0,0 +1,73 @@
+# Messages users about alerts on its own schedule (see Run_worker in modules/Notify_and_Update_Users.py)
+
+# Started by App/spikealerts.py when RUN_MODE='workers' in .env (or run it yourself with a command like "python App/notify_worker.py")
+# Coordinates with the sensor loop through the database - new alerts on "Places of Interest" & reports with notified = FALSE
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# Prep
+
+### Import python libraries
+
+# File Manipulation
+
+import os # For working with Operating System
+from dotenv import load_dotenv # Loading .env info
+
+# Add App to system path
+
+import sys
+
+extra_path = os.path.join('App')
+if extra_path not in sys.path:
+    sys.path.append(extra_path)
+
+# Time
+
+import datetime as dt # Working with dates/times
+import pytz # Timezones
+
+# Our modules
+
+from modules.Database.db_init import db_need_init # Has the database been initialized?
+from modules import Notify_and_Update_Users # The notify worker
+from modules.Users import Outbox # Sends the messages to users (see OUTBOX_WORKER in .env)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+### Load Configuration (.env)
+
+load_dotenv()
+
+base_config = {} # A dictionary to store the configuration variables
+
+# environment variables unpacked into dicionary
+base_config_keys = ['DAYS_TO_RUN', 'TIMEZONE', 'EPSG_CODE', 'USERS', 'WEBMAP_LINK', 'CONTACT_INFO_API', 'OBSERVATION_BASEURL']
+for key in base_config_keys:
+    base_config[key] = os.getenv(key)
+
+# stoptime = When will we stop the program? (datetime) - same as App/spikealerts.py
+days_to_run = int(base_config['DAYS_TO_RUN'])
+stoptime = dt.datetime.now(pytz.timezone(base_config['TIMEZONE'])) + dt.timedelta(days=days_to_run)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+if db_need_init():
+    print('\nERROR:\nNeed to create a database. Please see /Database directory')
+
+else:
+
+    print(f'Beginning notify worker\n\nRunning until {stoptime}\n')
+
+    # Send the messages in the background (unless OUTBOX_WORKER = 'separate', then run App/outbox_worker.py)
+
+    if Outbox.worker_mode == 'thread':
+        Outbox.Start_worker_thread(base_config['CONTACT_INFO_API'], base_config['TIMEZONE'])
+
+    try:
+        Notify_and_Update_Users.Run_worker(base_config, stoptime)
+
+    except KeyboardInterrupt:
+        pass
+
+print("Terminating Notify Worker")
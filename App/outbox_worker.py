@@ -0,0 +1,57 @@
+# Sends the messages in the "Outbox" (see modules/Users/Outbox.py)
+
+# Run this alongside App/spikealerts.py when OUTBOX_WORKER='separate' in .env
+# More than one can run at once (each claims different messages)
+
+# change directories to this repository
+# Run with a command like "python App/outbox_worker.py"
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# Prep
+
+### Import python libraries
+
+# File Manipulation
+
+import os # For working with Operating System
+from dotenv import load_dotenv # Loading .env info
+
+# Add App to system path
+
+import sys
+
+extra_path = os.path.join('App')
+if extra_path not in sys.path:
+    sys.path.append(extra_path)
+
+# Our modules
+
+from modules.Database.db_init import db_need_init # Has the database been initialized?
+from modules.Users import Outbox # The outbox worker
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+### Load Configuration (.env)
+
+load_dotenv()
+
+contact_info_api = os.getenv('CONTACT_INFO_API')
+timezone = os.getenv('TIMEZONE')
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+if db_need_init():
+    print('\nERROR:\nNeed to create a database. Please see /Database directory')
+
+else:
+
+    print(f'Sending messages from the "Outbox" every {Outbox.poll_seconds} seconds (Ctrl+C to stop)')
+
+    try:
+        Outbox.Run_worker(contact_info_api, timezone)
+
+    except KeyboardInterrupt:
+        pass
+
+print("Terminating Outbox Worker")
@@ -41,11 +41,17 @@ import datetime as dt # Working with dates/times
 import pytz # Timezones
 import time # For Sleeping
 
+# Workers
+
+import subprocess # Running the notify worker (RUN_MODE = 'workers')
+
 # Our modules
 
 from modules.Database.db_init import db_need_init # Has the database been initialized?
 from modules.MAIN import main # The Main Loop
+from modules.POIs.POI_Functions import Sync_projected_geometry # Keep projected geometries in sync with EPSG_CODE
 from modules.Users.Send_Messages import Message_mgmt # For messaging Management that the app errored
+from modules.Users import Outbox # Sends the messages to users (see OUTBOX_WORKER in .env)
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -56,10 +62,15 @@ load_dotenv()
 base_config = {} # A dictionary to store the configuration variables
 
 # environment variables unpacked into dicionary
-base_config_keys = ['DAYS_TO_RUN', 'TIMEZONE', 'REPORT_LAG', 'MIN_MESSAGE_FREQUENCY', 'EPSG_CODE', 'USERS', 'WEBMAP_LINK', 'CONTACT_INFO_API', 'SIGN_UP_FORM', 'OBSERVATION_FORM', 'OBSERVATION_BASEURL']
+base_config_keys = ['DAYS_TO_RUN', 'TIMEZONE', 'REPORT_LAG', 'MIN_MESSAGE_FREQUENCY', 'EPSG_CODE', 'USERS', 'WEBMAP_LINK', 'CONTACT_INFO_API', 'SIGN_UP_FORM', 'OBSERVATION_FORM', 'OBSERVATION_BASEURL', 'POI_ENGINE', 'RUN_MODE']
 for key in base_config_keys:
     base_config[key] = os.getenv(key)
 
+# RUN_MODE - 'single' (one loop does everything) or 'workers' (users are notified by App/notify_worker.py, on its own schedule)
+base_config['RUN_MODE'] = (base_config['RUN_MODE'] or 'single').lower()
+if base_config['RUN_MODE'] not in ['single', 'workers']:
+    raise ValueError(f"RUN_MODE must be 'single' or 'workers', not {base_config['RUN_MODE']!r}")
+
 # Print Config
 print('Base Configuration:\n')
 pprint(base_config)
@@ -87,11 +98,36 @@ Running until {stoptime}
 
 # Check database
 
+notify_worker = None # The notify worker's process (RUN_MODE = 'workers')
+
+def Start_notify_worker():
+    '''
+    Starts App/notify_worker.py in its own process - returns the process (subprocess.Popen)
+    '''
+
+    return subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'notify_worker.py')])
+
 if db_need_init():
     print('\nERROR:\nNeed to create a database. Please see /Database directory')
 
 else: 
 
+    # Make sure the projected geometries match EPSG_CODE (for distance calculations)
+
+    Sync_projected_geometry(base_config['EPSG_CODE'])
+
+    if base_config['USERS'] == 'y' and base_config['RUN_MODE'] == 'workers':
+
+        # Notify users from a separate process (it sends the messages too), so this loop only polls sensors
+
+        notify_worker = Start_notify_worker()
+
+    elif base_config['USERS'] == 'y' and Outbox.worker_mode == 'thread':
+
+        # Send messages to users in the background (unless OUTBOX_WORKER = 'separate', then run App/outbox_worker.py)
+
+        Outbox.Start_worker_thread(base_config['CONTACT_INFO_API'], base_config['TIMEZONE'])
+
     # Start the loop
 
     while True:
@@ -101,6 +137,21 @@ else:
 
         if stoptime < now: # Check if we've hit stoptime
             break
+            
+        # Restart the notify worker if its process stopped (RUN_MODE = 'workers')
+        
+        if notify_worker is not None and notify_worker.poll() is not None:
+        
+            mgmt_message = f'SpikeAlerts notify worker stopped (exit code {notify_worker.returncode}). Restarting it'
+            print(mgmt_message)
+            
+            try:
+                Message_mgmt(mgmt_message) # Message Manager
+            except Exception as e:
+                print('Could not message management:', e)
+            
+            notify_worker = Start_notify_worker()
+            
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # Try Main
         
@@ -146,5 +197,8 @@ else:
 
 # Terminate Program
 
+if notify_worker is not None:
+    notify_worker.terminate()
+
 print("Terminating Program")
 # our_twilio.send_texts([os.environ['LOCAL_PHONE']], ['Terminating Program'])
@@ -0,0 +1,494 @@
+# A local stand-in for the PurpleAir API (GET /v1/sensors) for load-testing SpikeAlerts offline
+
+# Serves a synthetic fleet (or a recorded /v1/sensors response) with PurpleAir's
+# fields, show_only, bounding box (nwlng, nwlat, selng, selat) and modified_since query parameters.
+# Readings drift every tick, and latency/errors can be injected.
+
+# Run from the repository with commands like
+
+# python Benchmarks/PurpleAir_Stand_In.py serve --sensors 5000 --port 8080 --latency 0.2 --error-rate 0.01
+# python Benchmarks/PurpleAir_Stand_In.py record --out Benchmarks/recorded_sensors.json (needs PURPLEAIR_API_TOKEN)
+# python Benchmarks/PurpleAir_Stand_In.py serve --replay Benchmarks/recorded_sensors.json
+
+# then point SpikeAlerts at it with PURPLEAIR_BASE_URL='http://localhost:8080/v1'
+
+# Or use it in-process (see Benchmarks/readme.md):
+
+# server = Start(Make_dataset(5000), port = 8080)
+# Spike(sensor_indices, 200) ... Set_faults(latency = 0.5) ... Stop(server)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# Default extent - Minneapolis (minlng, minlat, maxlng, maxlat)
+
+default_bounds = (-93.33, 44.89, -93.19, 45.05)
+
+# Fields we can serve
+
+info_fields = ['sensor_index', 'name', 'model', 'location_type', 'private',
+               'latitude', 'longitude', 'altitude',
+               'channel_flags', 'channel_state', 'confidence',
+               'date_created', 'last_seen', 'last_modified']
+
+# Particulate fields as a multiple of the sensor's pm2.5 level
+
+pm_fields = {'pm2.5' : 1, 'pm2.5_alt' : 0.9, 'pm2.5_atm' : 1, 'pm2.5_cf_1' : 1.05,
+             'pm2.5_10minute' : 1, 'pm2.5_30minute' : 1, 'pm2.5_60minute' : 1,
+             'pm2.5_6hour' : 1, 'pm2.5_24hour' : 1, 'pm2.5_1week' : 1,
+             'pm1.0' : 0.7, 'pm1.0_atm' : 0.7, 'pm10.0' : 1.3, 'pm10.0_atm' : 1.3}
+
+weather_fields = ['humidity', 'temperature', 'pressure']
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# Shared state (the handler threads read it, ticks/scenarios write it)
+
+stand_in = {'dataset' : None, # pd.DataFrame, one row per sensor (see Make_dataset)
+            'spikes' : {}, # sensor_index : pm2.5 level held until Clear_spikes()
+            'faults' : {'latency' : 0, # seconds added to every response
+                        'jitter' : 0, # up to this many more seconds (uniform)
+                        'error_rate' : 0, # fraction of requests that fail
+                        'error_status' : 503}, # HTTP status of those failures (429 adds Retry-After)
+            'online_fraction' : 0.95, # Sensors that report on each tick
+            'requests' : [] # One dictionary per request (see Get_request_log)
+            }
+
+_lock = threading.Lock()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Make_dataset(n_sensors, bounds = default_bounds, seed = 0):
+    '''
+    Makes a synthetic fleet of n_sensors spread uniformly over bounds (minlng, minlat, maxlng, maxlat)
+
+    returns a dataframe with a column per field in info_fields, pm_fields, and weather_fields
+    '''
+
+    rng = np.random.default_rng(seed)
+    now = int(time.time())
+    minlng, minlat, maxlng, maxlat = bounds
+
+    pm = rng.gamma(2, 4, n_sensors).round(1) # A quiet day
+
+    dataset = pd.DataFrame({'sensor_index' : np.arange(100000, 100000 + n_sensors),
+                            'name' : [f'Stand-In Sensor {i}' for i in range(n_sensors)],
+                            'model' : 'PA-II',
+                            'location_type' : 0,
+                            'private' : 0,
+                            'latitude' : rng.uniform(minlat, maxlat, n_sensors).round(5),
+                            'longitude' : rng.uniform(minlng, maxlng, n_sensors).round(5),
+                            'altitude' : rng.integers(800, 1000, n_sensors),
+                            'channel_flags' : rng.choice([0, 0, 0, 0, 0, 0, 0, 0, 1, 3], n_sensors),
+                            'channel_state' : 3,
+                            'confidence' : 100,
+                            'date_created' : now - rng.integers(30 * 86400, 5 * 365 * 86400, n_sensors),
+                            'last_seen' : now - rng.integers(0, 120, n_sensors),
+                            'humidity' : rng.integers(20, 80, n_sensors),
+                            'temperature' : rng.integers(50, 90, n_sensors),
+                            'pressure' : rng.uniform(975, 990, n_sensors).round(2)
+                            })
+
+    dataset['last_modified'] = dataset.last_seen
+
+    for field, multiple in pm_fields.items():
+        dataset[field] = (pm * multiple).round(1)
+
+    return dataset
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Load_recorded(filename):
+    '''
+    Loads a recorded /v1/sensors response (json with fields & data, see Record) as a dataset
+
+    Fields the recording doesn't have are filled in like Make_dataset
+    (the recording should have sensor_index, latitude, and longitude for bounding box queries)
+    '''
+
+    with open(filename) as f:
+        response_dict = json.load(f)
+
+    recorded = pd.DataFrame(response_dict['data'], columns = response_dict['fields'])
+
+    bounds = default_bounds
+    if {'latitude', 'longitude'}.issubset(recorded.columns):
+        bounds = (recorded.longitude.min(), recorded.latitude.min(), recorded.longitude.max(), recorded.latitude.max())
+
+    dataset = Make_dataset(len(recorded), bounds)
+
+    for field in recorded.columns:
+        dataset[field] = recorded[field].to_numpy()
+
+    if 'last_modified' not in recorded.columns:
+        dataset['last_modified'] = dataset.last_seen
+
+    return dataset
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Record(filename, fields, bounds = default_bounds):
+    '''
+    Saves a real /v1/sensors response for the bounds (minlng, minlat, maxlng, maxlat) to replay later
+
+    Uses PURPLEAIR_API_TOKEN from the .env (through App/modules/Sensors/APIs/PurpleAir/API_functions.py)
+    '''
+
+    extra_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'App')
+    if extra_path not in sys.path:
+        sys.path.append(extra_path)
+
+    from modules.Sensors.APIs.PurpleAir import API_functions as purp
+
+    minlng, minlat, maxlng, maxlat = bounds
+    query = '&'.join(['fields=' + '%2C'.join(fields),
+                      f'nwlng={minlng}', f'nwlat={maxlat}', f'selng={maxlng}', f'selat={minlat}'])
+
+    response = purp.session.get('https://api.purpleair.com/v1/sensors?' + query,
+                                timeout = (purp.connect_timeout, purp.read_timeout))
+    response.raise_for_status()
+
+    with open(filename, 'w') as f:
+        f.write(response.text)
+
+    print(f'Recorded {len(response.json()["data"])} sensors to {filename}')
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Tick(seed = None):
+    '''
+    Moves the fleet forward - online sensors (online_fraction) get new readings and are last_seen/last_modified now
+
+    Sensors in a spike (see Spike) read their spike level
+    '''
+
+    rng = np.random.default_rng(seed)
+    now = int(time.time())
+
+    with _lock:
+
+        dataset = stand_in['dataset'].copy() # Copy on write (requests in flight keep the old one)
+
+        is_online = rng.random(len(dataset)) < stand_in['online_fraction']
+        n_online = int(is_online.sum())
+
+        pm = (dataset.loc[is_online, 'pm2.5'] * rng.lognormal(0, 0.1, n_online)).clip(0, 60).round(1)
+
+        is_spiked = dataset.sensor_index.isin(list(stand_in['spikes']))
+        pm[is_spiked[is_online]] = dataset.loc[is_online & is_spiked, 'sensor_index'].map(stand_in['spikes'])
+
+        for field, multiple in pm_fields.items():
+            dataset.loc[is_online, field] = (pm * multiple).round(1)
+
+        dataset.loc[is_online, 'last_seen'] = now
+        dataset.loc[is_online, 'last_modified'] = now
+
+        stand_in['dataset'] = dataset
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Spike(sensor_indices, level):
+    '''
+    Holds the sensor_indices (list of ints) at a pm2.5 level (float) from now on, until Clear_spikes()
+
+    The spiked sensors are modified now (like a tick)
+    '''
+
+    now = int(time.time())
+
+    with _lock:
+
+        for sensor_index in sensor_indices:
+            stand_in['spikes'][int(sensor_index)] = float(level)
+
+        dataset = stand_in['dataset'].copy()
+        is_spiked = dataset.sensor_index.isin(list(sensor_indices))
+
+        for field, multiple in pm_fields.items():
+            dataset.loc[is_spiked, field] = round(level * multiple, 1)
+
+        dataset.loc[is_spiked, 'last_seen'] = now
+        dataset.loc[is_spiked, 'last_modified'] = now
+
+        stand_in['dataset'] = dataset
+
+def Clear_spikes():
+    '''
+    Lets spiked sensors go back to drifting on the next Tick()
+    '''
+
+    with _lock:
+        level = 4.0 # A quiet reading to come back down to
+
+        dataset = stand_in['dataset'].copy()
+        is_spiked = dataset.sensor_index.isin(list(stand_in['spikes']))
+
+        for field, multiple in pm_fields.items():
+            dataset.loc[is_spiked, field] = round(level * multiple, 1)
+
+        stand_in['dataset'] = dataset
+        stand_in['spikes'] = {}
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Set_faults(**faults):
+    '''
+    Changes the injected faults - latency, jitter (seconds), error_rate (0-1), error_status (HTTP status)
+    '''
+
+    with _lock:
+        for key, value in faults.items():
+            if key not in stand_in['faults']:
+                raise KeyError(f'Unknown fault {key} - expected one of {list(stand_in["faults"])}')
+            stand_in['faults'][key] = value
+
+def Get_request_log(reset = False):
+    '''
+    Returns a list of dictionaries, one per request served:
+
+    time - float - seconds since epoch
+    status - int - HTTP status sent
+    sensors - int - rows sent
+    points - int - rows * fields (what PurpleAir would charge)
+    bytes - int - size of the body sent
+    seconds - float - time to respond (including injected latency)
+    '''
+
+    with _lock:
+        request_log = list(stand_in['requests'])
+        if reset:
+            stand_in['requests'] = []
+
+    return request_log
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Query_sensors(query):
+    '''
+    Answers a /v1/sensors query (dictionary from parse_qs) like PurpleAir
+
+    returns (status, response dictionary, number of fields)
+    '''
+
+    with _lock:
+        dataset = stand_in['dataset']
+
+    now = int(time.time())
+
+    fields = query.get('fields', [''])[0].split(',')
+    fields = [field for field in fields if field != '']
+
+    unknown_fields = [field for field in fields if field not in dataset.columns]
+    if len(fields) == 0 or len(unknown_fields) > 0:
+        return 400, {'error' : 'InvalidFieldValueError',
+                     'description' : f'Unknown or missing fields: {unknown_fields}'}, 0
+
+    is_selected = pd.Series(True, index = dataset.index)
+
+    if 'show_only' in query:
+        show_only = [int(i) for i in query['show_only'][0].split(',') if i != '']
+        is_selected &= dataset.sensor_index.isin(show_only)
+
+    if {'nwlng', 'nwlat', 'selng', 'selat'}.issubset(query):
+        nwlng, nwlat, selng, selat = [float(query[key][0]) for key in ['nwlng', 'nwlat', 'selng', 'selat']]
+        is_selected &= dataset.longitude.between(nwlng, selng) & dataset.latitude.between(selat, nwlat)
+
+    if 'modified_since' in query:
+        is_selected &= dataset.last_modified > int(query['modified_since'][0])
+
+    if 'max_age' in query and int(query['max_age'][0]) > 0:
+        is_selected &= dataset.last_seen >= now - int(query['max_age'][0])
+
+    # sensor_index always comes first (like PurpleAir)
+
+    fields = ['sensor_index'] + [field for field in fields if field != 'sensor_index']
+
+    selected = dataset.loc[is_selected, fields].astype(object)
+    selected = selected.where(selected.notna(), None)
+
+    response_dict = {'api_version' : 'V1.0.0-stand-in',
+                     'time_stamp' : now,
+                     'data_time_stamp' : now,
+                     'max_age' : int(query.get('max_age', [604800])[0]),
+                     'firmware_default_version' : '7.02',
+                     'fields' : fields,
+                     'data' : selected.values.tolist()
+                     }
+
+    return 200, response_dict, len(fields)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class Sensors_Handler(BaseHTTPRequestHandler):
+    '''
+    GET /v1/sensors (needs an X-API-Key header, like PurpleAir)
+    '''
+
+    protocol_version = 'HTTP/1.1' # Keep-alive
+
+    def do_GET(self):
+
+        start = time.perf_counter()
+
+        with _lock:
+            faults = dict(stand_in['faults'])
+
+        time.sleep(faults['latency'] + random.uniform(0, faults['jitter']))
+
+        url = urlparse(self.path)
+        n_fields = 0
+        headers = {}
+
+        if url.path.rstrip('/') != '/v1/sensors':
+            status, response_dict = 404, {'error' : 'NotFoundError', 'description' : url.path}
+
+        elif not self.headers.get('X-API-Key'):
+            status, response_dict = 403, {'error' : 'ApiKeyMissingError', 'description' : 'No API key was found in the request.'}
+
+        elif random.random() < faults['error_rate']:
+            status, response_dict = faults['error_status'], {'error' : 'InjectedError', 'description' : 'Injected by the stand-in'}
+            if status == 429:
+                headers['Retry-After'] = '1'
+
+        else:
+            try:
+                status, response_dict, n_fields = Query_sensors(parse_qs(url.query))
+            except ValueError as e:
+                status, response_dict = 400, {'error' : 'InvalidParameterError', 'description' : str(e)}
+
+        body = json.dumps(response_dict).encode()
+
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel = 5)
+            headers['Content-Encoding'] = 'gzip'
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+        n_sensors = len(response_dict.get('data', []))
+
+        with _lock:
+            stand_in['requests'].append({'time' : time.time(), 'status' : status,
+                                         'sensors' : n_sensors, 'points' : n_sensors * n_fields,
+                                         'bytes' : len(body), 'seconds' : time.perf_counter() - start})
+
+    def log_message(self, format, *args):
+        pass # Quiet (see Get_request_log)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Start(dataset, port = 8080, tick_seconds = 60, host = '127.0.0.1'):
+    '''
+    Serves the dataset (see Make_dataset/Load_recorded) on http://host:port/v1/sensors in background threads
+
+    tick_seconds - float - how often to Tick() (0 for never, call Tick() yourself)
+
+    returns the server (pass to Stop)
+    '''
+
+    with _lock:
+        stand_in['dataset'] = dataset
+        stand_in['spikes'] = {}
+        stand_in['requests'] = []
+
+    server = ThreadingHTTPServer((host, port), Sensors_Handler)
+    server.daemon_threads = True
+    server.stop_event = threading.Event()
+
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+
+    if tick_seconds > 0:
+
+        def Ticker():
+            while not server.stop_event.wait(tick_seconds):
+                Tick()
+
+        threading.Thread(target = Ticker, daemon = True).start()
+
+    return server
+
+def Stop(server):
+    '''
+    Stops a server from Start()
+    '''
+
+    server.stop_event.set()
+    server.shutdown()
+    server.server_close()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Local stand-in for the PurpleAir API')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    serve = subparsers.add_parser('serve', help = 'serve a synthetic or recorded fleet')
+    serve.add_argument('--sensors', type = int, default = 5000, help = 'synthetic fleet size')
+    serve.add_argument('--replay', help = 'a recorded /v1/sensors response to serve instead')
+    serve.add_argument('--bounds', type = float, nargs = 4, default = default_bounds, metavar = ('MINLNG', 'MINLAT', 'MAXLNG', 'MAXLAT'))
+    serve.add_argument('--port', type = int, default = 8080)
+    serve.add_argument('--host', default = '127.0.0.1')
+    serve.add_argument('--tick', type = float, default = 60, help = 'seconds between new readings')
+    serve.add_argument('--online', type = float, default = 0.95, help = 'fraction of sensors reporting each tick')
+    serve.add_argument('--latency', type = float, default = 0, help = 'seconds added to every response')
+    serve.add_argument('--jitter', type = float, default = 0, help = 'up to this many more seconds')
+    serve.add_argument('--error-rate', type = float, default = 0, help = 'fraction of requests that fail')
+    serve.add_argument('--error-status', type = int, default = 503, help = 'HTTP status of failed requests')
+    serve.add_argument('--spike', type = float, nargs = 2, metavar = ('FRACTION', 'LEVEL'), help = 'hold a random fraction of sensors at a pm2.5 level')
+
+    record = subparsers.add_parser('record', help = 'save a real response to replay')
+    record.add_argument('--out', required = True)
+    record.add_argument('--bounds', type = float, nargs = 4, default = default_bounds, metavar = ('MINLNG', 'MINLAT', 'MAXLNG', 'MAXLAT'))
+    record.add_argument('--fields', nargs = '+', default = ['sensor_index', 'name', 'latitude', 'longitude', 'altitude',
+                                                           'channel_flags', 'date_created', 'last_seen', 'pm2.5_10minute'])
+
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        Record(args.out, args.fields, args.bounds)
+        sys.exit()
+
+    dataset = Load_recorded(args.replay) if args.replay else Make_dataset(args.sensors, args.bounds)
+
+    stand_in['online_fraction'] = args.online
+    server = Start(dataset, args.port, args.tick, args.host)
+    Set_faults(latency = args.latency, jitter = args.jitter,
+               error_rate = args.error_rate, error_status = args.error_status)
+
+    if args.spike:
+        fraction, level = args.spike
+        Spike(dataset.sensor_index.sample(frac = fraction, random_state = 0), level)
+
+    print(f'Serving {len(dataset)} sensors on http://{args.host}:{args.port}/v1/sensors (Ctrl+C to stop)')
+    print(f"Set PURPLEAIR_BASE_URL='http://{args.host}:{args.port}/v1'")
+
+    try:
+        while True:
+            time.sleep(60)
+            request_log = Get_request_log(reset = True)
+            if len(request_log) > 0:
+                print(f'{len(request_log)} requests, {sum(r["sensors"] for r in request_log)} sensors, '
+                      f'{sum(r["points"] for r in request_log)} points, {sum(r["bytes"] for r in request_log) / 1e6:.2f} MB in the last minute')
+    except KeyboardInterrupt:
+        Stop(server)
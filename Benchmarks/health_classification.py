@@ -0,0 +1,104 @@
+# Micro-benchmark for classifying sensor readings into health codes/descriptors
+
+# Compares the original per-sensor_type pd.cut + string isin() filtering
+# with the shared numeric classifier in App/modules/Sensors/Sensor_Functions.py
+
+# Run from the repository with a command like "python Benchmarks/health_classification.py --readings 100000"
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+# Add App to system path
+
+extra_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'App')
+if extra_path not in sys.path:
+    sys.path.append(extra_path)
+
+from modules.Sensors import Sensor_Functions as sensors
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+thresholds_dict = {'papm25' : [0, 12.1, 35.5, 55.5, 150.5, 250.5, 1000],
+                   'papm10' : [0, 55, 155, 255, 355, 425, 2000],
+                   'ozone' : [0, 55, 71, 86, 106, 201, 1000]
+                   }
+
+sensitive_spike_descriptors = ['unhealthy for sensitive groups', 'unhealthy', 'very unhealthy', 'hazardous']
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Make_readings(n, seed = 0):
+    '''
+    Makes a dataframe of n random readings (with a few missing) across the sensor types above
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    df = pd.DataFrame({'sensor_type' : rng.choice(list(thresholds_dict), n),
+                       'current_reading' : rng.gamma(2, 30, n)})
+
+    df.loc[rng.random(n) < 0.01, 'current_reading'] = np.nan
+
+    return df
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Original_path(df):
+    '''
+    pd.cut per sensor_type, then string isin() to find spiked sensors
+    '''
+
+    descriptors = pd.Series(index = df.index, dtype = object)
+
+    for sensor_type, thresholds in thresholds_dict.items():
+
+        is_type = df.sensor_type == sensor_type
+        bins = [-float('inf')] + thresholds + [float('inf')]
+
+        descriptors[is_type] = pd.cut(df.current_reading[is_type], bins,
+                                      right = False, include_lowest = True,
+                                      labels = sensors.health_descriptors).astype(object)
+
+    return descriptors.isin(sensitive_spike_descriptors)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Numeric_path(df):
+    '''
+    One pass into integer health codes, then an integer comparison to find spiked sensors
+    '''
+
+    health_codes = sensors.Classify_Health_Codes(df.current_reading, df.sensor_type, thresholds_dict)
+
+    return pd.Series((health_codes >= 3) & (health_codes <= 6), index = df.index)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Health classification micro-benchmark')
+    parser.add_argument('--readings', type = int, default = 100000, help = 'number of readings per cycle')
+    parser.add_argument('--repeat', type = int, default = 20, help = 'number of timed runs')
+    args = parser.parse_args()
+
+    df = Make_readings(args.readings)
+
+    # Both paths must agree
+
+    assert (Original_path(df) == Numeric_path(df)).all()
+
+    print(f'Classifying {args.readings} readings ({len(thresholds_dict)} sensor types), best of {args.repeat}:\n')
+
+    for name, func in [('pd.cut + isin (original)', Original_path),
+                       ('numeric health codes', Numeric_path)]:
+
+        seconds = min(timeit.repeat(lambda: func(df), number = 1, repeat = args.repeat))
+
+        print(f'{name:<28} {seconds * 1000:8.2f} ms per cycle')
@@ -0,0 +1,136 @@
+# Micro-benchmark for reading PurpleAir /v1/sensors responses into dataframes
+
+# Compares the original np.array(data) -> pd.DataFrame -> Reformat_PurpleAir_data path (kept below)
+# with the column by column parser in App/modules/Sensors/APIs/PurpleAir/API_functions.py
+
+# Run from the repository with a command like "python Benchmarks/purpleair_parsing.py --sensors 30000"
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import argparse
+import json
+import os
+import sys
+import time
+import timeit
+
+import numpy as np
+import pandas as pd
+
+# Add App to system path
+
+extra_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'App')
+if extra_path not in sys.path:
+    sys.path.append(extra_path)
+
+from modules.Sensors.APIs.PurpleAir import API_functions as purp
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# The fields requested by the daily update (Add_new_PurpleAir_Stations) - the widest call we make
+
+fields = ['sensor_index', 'date_created', 'last_seen', 'name', 'channel_flags', 'altitude',
+          'latitude', 'longitude', 'pm2.5_10minute']
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Make_response(n, seed = 0):
+    '''
+    Makes the json text of a /v1/sensors response with n sensors
+    '''
+
+    rng = np.random.default_rng(seed)
+    now = int(time.time())
+
+    columns = [range(100000, 100000 + n), # sensor_index
+               (now - rng.integers(0, 10**8, n)).tolist(), # date_created
+               (now - rng.integers(0, 3600, n)).tolist(), # last_seen
+               [f'Sensor {i}' for i in range(n)], # name
+               rng.integers(0, 4, n).tolist(), # channel_flags
+               rng.integers(600, 1200, n).tolist(), # altitude
+               rng.uniform(44.8, 45.1, n).round(5).tolist(), # latitude
+               rng.uniform(-93.4, -93.1, n).round(5).tolist(), # longitude
+               rng.gamma(2, 5, n).round(1).tolist() # pm2.5_10minute
+               ]
+
+    return json.dumps({'fields' : fields, 'data' : [list(row) for row in zip(*columns)]})
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Reformat_PurpleAir_data(df, timezone):
+    '''
+    The App's original column formatting (before Parse_PurpleAir_response):
+    
+    integers - sensor_index, channel_flags, channel_state, altitude
+    datetimes in timezone - last_seen, date_created
+    
+    then sensor_index renamed to api_id
+    '''
+    
+    cols = set(df.columns.to_list())
+    
+    for col in cols.intersection({'channel_flags', 'channel_state', 'altitude', 'sensor_index'}):
+        df[col] = df[col].astype(int)
+    
+    for col in cols.intersection(['last_seen', 'date_created']):
+        df[col] = pd.to_datetime(df[col].astype(int),
+                                 utc = True,
+                                 unit = 's').dt.tz_convert(timezone)
+    
+    return df.rename(columns = {'sensor_index' : 'api_id'}).copy()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Original_path(response_text, timezone):
+    '''
+    np.array of the rows (everything becomes a string), then cast columns back
+    '''
+
+    response_dict = json.loads(response_text)
+    data = np.array(response_dict['data'])
+    df = pd.DataFrame(data, columns = response_dict['fields'])
+
+    return Reformat_PurpleAir_data(df, timezone)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Columnar_path(response_text, timezone):
+    '''
+    Typed columns straight from the rows
+    '''
+
+    return purp.Parse_PurpleAir_response(json.loads(response_text), timezone)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'PurpleAir response parsing micro-benchmark')
+    parser.add_argument('--sensors', type = int, default = 30000, help = 'number of sensors in the response')
+    parser.add_argument('--repeat', type = int, default = 10, help = 'number of timed runs')
+    parser.add_argument('--timezone', default = 'America/Chicago')
+    args = parser.parse_args()
+
+    response_text = Make_response(args.sensors)
+
+    # Both paths must agree (the original path leaves floats as strings when a text field is requested)
+
+    original_df = Original_path(response_text, args.timezone)
+    columnar_df = Columnar_path(response_text, args.timezone)
+
+    for col in ['latitude', 'longitude', 'pm2.5_10minute']:
+        original_df[col] = original_df[col].astype(float)
+
+    pd.testing.assert_frame_equal(original_df, columnar_df, check_dtype = False)
+
+    print(f'Parsing a response with {args.sensors} sensors ({len(fields)} fields, {len(response_text) / 1e6:.1f} MB), best of {args.repeat}:\n')
+
+    for name, func in [('np.array + Reformat (original)', Original_path),
+                       ('columnar parser', Columnar_path)]:
+
+        seconds = min(timeit.repeat(lambda: func(response_text, args.timezone), number = 1, repeat = args.repeat))
+
+        print(f'{name:<32} {seconds * 1000:8.2f} ms per response')
+
+    print('\ncolumnar dtypes:')
+    print(columnar_df.dtypes.to_string())
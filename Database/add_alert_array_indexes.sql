@@ -0,0 +1,12 @@
+-- Run this file to add the alert array indexes to a database made with an older initialize_tables.sql
+
+-- New databases already have these (see initialize_tables.sql)
+-- You can run this by using a psql command like:
+-- psql "host=<host> dbname='SpikeAlerts' user=<your_username> password=<your_password>" -f add_alert_array_indexes.sql
+
+-- ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+SET SEARCH_PATH = base, public;
+
+CREATE INDEX IF NOT EXISTS poi_active_alerts ON "Places of Interest" USING GIN(active_alerts); -- Find POIs with any of a list of alert_ids (&&)
+CREATE INDEX IF NOT EXISTS poi_active_alerts_sensitive ON "Places of Interest" USING GIN(active_alerts_sensitive);
@@ -0,0 +1,26 @@
+-- Run this file to add the "Outbox" (messages waiting to be sent) to a database with the "Users" extension
+
+-- New databases get it with the "Users" table (see readme.md)
+-- You can run this by using a psql command like:
+-- psql "host=<host> dbname='SpikeAlerts' user=<your_username> password=<your_password>" -f add_outbox.sql
+
+-- ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+SET SEARCH_PATH = base, public;
+
+CREATE TABLE IF NOT EXISTS "Outbox" -- Messages waiting to be sent, drained by the outbox worker (see App/modules/Users/Outbox.py)
+(
+	message_id bigserial PRIMARY KEY, -- Our Unique Identifier
+	user_id int REFERENCES "Users" (user_id) ON DELETE CASCADE, -- Who the message is for
+	contact_method text, -- Same as the user's
+	api_id text, -- Same as the user's
+	message text,
+	status text DEFAULT 'queued' CHECK (status IN ('queued', 'sending', 'sent', 'unsubscribed', 'failed')),
+	attempts int DEFAULT 0, -- Number of times a worker has claimed this message
+	queued_at timestamp, -- When the message was added
+	lease_until timestamp, -- A worker is sending this message until then (status = 'sending')
+	sent_at timestamp, -- When the message was sent
+	error text -- Why the message failed
+);
+
+CREATE INDEX IF NOT EXISTS outbox_to_send ON "Outbox" (message_id) WHERE status IN ('queued', 'sending'); -- Claiming messages
@@ -0,0 +1,37 @@
+-- Run this file to add "POI Alerts" to a database made with an older initialize_tables.sql
+
+-- New databases already have it (see initialize_tables.sql)
+-- You can run this by using a psql command like:
+-- psql "host=<host> dbname='SpikeAlerts' user=<your_username> password=<your_password>" -f add_poi_alerts.sql
+
+-- ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+SET SEARCH_PATH = base, public;
+
+CREATE TABLE IF NOT EXISTS "POI Alerts" -- The alerts on each POI, used instead of the alert arrays of "Places of Interest" when ALERT_STORAGE=links in .env
+	(poi_id bigint REFERENCES "Places of Interest" (poi_id) ON DELETE CASCADE,
+	alert_id bigint, -- In "Active Alerts", then "Archived Alerts" once it ends
+	sensitive boolean, -- Same as the alert's
+	state text DEFAULT 'active' CHECK (state IN ('active', 'cached')), -- active = like active_alerts, cached = like cached_alerts
+	PRIMARY KEY (poi_id, alert_id)
+	);
+
+CREATE INDEX IF NOT EXISTS poi_alerts_alert_id ON "POI Alerts" (alert_id); -- Caching ended alerts
+CREATE INDEX IF NOT EXISTS poi_alerts_state ON "POI Alerts" (sensitive, state, poi_id); -- Finding alerted/unalerted POIs
+
+-- ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+-- Switching from ALERT_STORAGE=arrays to links while alerts are out?
+-- Stop the App, run the following to copy the alert arrays into "POI Alerts", then restart it with ALERT_STORAGE=links
+
+/*
+INSERT INTO "POI Alerts" (poi_id, alert_id, sensitive, state)
+SELECT poi_id, UNNEST(active_alerts_sensitive), TRUE, 'active' FROM "Places of Interest"
+UNION ALL
+SELECT poi_id, UNNEST(cached_alerts_sensitive), TRUE, 'cached' FROM "Places of Interest"
+UNION ALL
+SELECT poi_id, UNNEST(active_alerts), FALSE, 'active' FROM "Places of Interest"
+UNION ALL
+SELECT poi_id, UNNEST(cached_alerts), FALSE, 'cached' FROM "Places of Interest"
+ON CONFLICT DO NOTHING;
+*/
@@ -0,0 +1,81 @@
+-- Run this file to add the projected geometry columns to a database made with an older initialize_tables.sql
+
+-- New databases already have these (see initialize_tables.sql)
+-- You can run this by using a psql command like:
+-- psql "host=<host> dbname='SpikeAlerts' user=<your_username> password=<your_password>" -f add_projected_geometry.sql
+
+-- Afterwards, the App fills in the new columns from EPSG_CODE in .env when it starts (see Sync_projected_geometry in App/modules/POIs/POI_Functions.py)
+
+-- ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+SET SEARCH_PATH = base, public;
+
+-- The local projected coordinate reference system for distances
+
+ALTER TABLE "extent"
+ADD COLUMN IF NOT EXISTS epsg_code int;
+
+-- Projected copies (in meters) of the geometries
+
+ALTER TABLE "Sensors"
+ADD COLUMN IF NOT EXISTS geometry_projected geometry;
+CREATE INDEX IF NOT EXISTS sensor_gid_projected ON "Sensors" USING GIST(geometry_projected);
+
+ALTER TABLE "Places of Interest"
+ADD COLUMN IF NOT EXISTS geometry_projected geometry;
+CREATE INDEX IF NOT EXISTS poi_gid_projected ON "Places of Interest" USING GIST(geometry_projected);
+
+-- ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+-- Keep geometry_projected = geometry in the project's projected coordinate reference system (extent.epsg_code)
+
+CREATE or REPLACE function base.set_geometry_projected()
+returns trigger language plpgsql
+SET search_path = base, public as $$
+DECLARE srid int;
+BEGIN
+	SELECT epsg_code INTO srid FROM "extent" WHERE epsg_code IS NOT NULL LIMIT 1;
+	
+	IF NEW.geometry IS NULL OR srid IS NULL THEN
+		NEW.geometry_projected := NULL;
+	ELSE
+		NEW.geometry_projected := ST_Transform(NEW.geometry, srid);
+	END IF;
+	
+	RETURN NEW;
+END$$;
+
+DROP TRIGGER IF EXISTS sensors_geometry_projected ON base."Sensors";
+CREATE TRIGGER sensors_geometry_projected
+BEFORE INSERT OR UPDATE OF geometry ON base."Sensors"
+FOR EACH ROW EXECUTE FUNCTION base.set_geometry_projected();
+
+DROP TRIGGER IF EXISTS pois_geometry_projected ON base."Places of Interest";
+CREATE TRIGGER pois_geometry_projected
+BEFORE INSERT OR UPDATE OF geometry ON base."Places of Interest"
+FOR EACH ROW EXECUTE FUNCTION base.set_geometry_projected();
+
+-- ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+-- Add the column to the views (appended, so CREATE OR REPLACE works)
+
+CREATE OR REPLACE VIEW base.alerted_sensors AS
+(
+SELECT s.sensor_id, s.name, s.sensor_type,
+       a.alert_id, a.sensitive, a.start_time, s.last_seen,
+       s.current_reading, a.avg_reading, a.max_reading,
+	   s.geometry, s.geometry_projected
+FROM base."Active Alerts" a
+INNER JOIN base."Sensors" s ON (a.sensor_id = s.sensor_id)
+);
+
+CREATE OR REPLACE VIEW base.alerts_w_info AS
+(
+SELECT s.sensor_id, s.name, s.alert_id, s.sensitive, s.start_time, s.last_seen,
+	   i.pollutant, i.metric, i.thresholds, i.radius_meters,
+       s.current_reading, s.avg_reading, s.max_reading,
+       map_to_health(s.current_reading, i.thresholds) as health_descriptor,
+	   s.geometry, s.geometry_projected
+FROM base.alerted_sensors s
+INNER JOIN base.sensor_ids_w_info i ON (s.sensor_id = i.sensor_id)
+);
@@ -0,0 +1,18 @@
+-- Run this file to add poi_id & notified to the "Reports Archive" of a database made with an older initialize_tables.sql
+
+-- New databases already have them (see initialize_tables.sql)
+-- You can run this by using a psql command like:
+-- psql "host=<host> dbname='SpikeAlerts' user=<your_username> password=<your_password>" -f add_report_notifications.sql
+
+-- ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+SET SEARCH_PATH = base, public;
+
+ALTER TABLE "Reports Archive"
+ADD COLUMN IF NOT EXISTS poi_id bigint, -- The POI the report is for (empty for older reports)
+ADD COLUMN IF NOT EXISTS notified boolean DEFAULT TRUE; -- Older reports have been handled already
+
+ALTER TABLE "Reports Archive"
+ALTER COLUMN notified SET DEFAULT FALSE; -- Have the users of the POI been sent the end of alert message? (FALSE = waiting for the notify worker, RUN_MODE=workers in .env)
+
+CREATE INDEX IF NOT EXISTS reports_to_notify ON "Reports Archive" (poi_id) WHERE notified = FALSE; -- For the notify worker
@@ -0,0 +1,123 @@
+-- Run this file to add "Sensor POI Adjacency" to a database made with an older initialize_tables.sql
+
+-- Run add_projected_geometry.sql first if your database doesn't have the geometry_projected columns
+-- New databases already have these (see initialize_tables.sql)
+-- You can run this by using a psql command like:
+-- psql "host=<host> dbname='SpikeAlerts' user=<your_username> password=<your_password>" -f add_sensor_poi_adjacency.sql
+
+-- ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+SET SEARCH_PATH = base, public;
+
+CREATE TABLE IF NOT EXISTS "Sensor POI Adjacency" -- Which POIs are within radius_meters of each sensor (kept up to date by triggers below)
+	(sensor_id int REFERENCES "Sensors" (sensor_id) ON DELETE CASCADE,
+	poi_id bigint REFERENCES "Places of Interest" (poi_id) ON DELETE CASCADE,
+	PRIMARY KEY (sensor_id, poi_id)
+	);
+
+CREATE INDEX IF NOT EXISTS adjacency_poi_id ON "Sensor POI Adjacency" (poi_id); -- For lookups by POI
+
+-- ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+DROP TRIGGER IF EXISTS sensors_adjacency ON base."Sensors";
+DROP TRIGGER IF EXISTS pois_adjacency ON base."Places of Interest";
+DROP TRIGGER IF EXISTS sensor_types_adjacency ON base."Sensor Type Information";
+
+-- Keep "Sensor POI Adjacency" up to date
+-- Rows are rebuilt for a sensor/POI when it is added or moved, and for every sensor of a type when its radius_meters changes
+-- Deleted sensors/POIs are removed by ON DELETE CASCADE
+-- Skipped while spikealerts.skip_adjacency = 'on' (set by Sync_projected_geometry in App/modules/POIs/POI_Functions.py while it re-projects everything)
+
+CREATE or REPLACE function base.refresh_sensor_adjacency(sensor_ids int [])
+returns void language sql
+SET search_path = base, public as $$
+	DELETE FROM "Sensor POI Adjacency"
+	WHERE sensor_id = ANY (sensor_ids);
+	
+	INSERT INTO "Sensor POI Adjacency" (sensor_id, poi_id)
+	SELECT s.sensor_id, p.poi_id
+	FROM "Sensors" s
+	INNER JOIN "Sensor Type Information" i ON (i.sensor_type = s.sensor_type)
+	INNER JOIN "Places of Interest" p ON ST_DWithin(p.geometry_projected, s.geometry_projected, i.radius_meters)
+	WHERE s.sensor_id = ANY (sensor_ids);
+$$;
+
+CREATE or REPLACE function base.refresh_poi_adjacency(poi_ids bigint [])
+returns void language sql
+SET search_path = base, public as $$
+	DELETE FROM "Sensor POI Adjacency"
+	WHERE poi_id = ANY (poi_ids);
+	
+	INSERT INTO "Sensor POI Adjacency" (sensor_id, poi_id)
+	SELECT s.sensor_id, p.poi_id
+	FROM "Places of Interest" p
+	CROSS JOIN "Sensor Type Information" i
+	INNER JOIN "Sensors" s ON (s.sensor_type = i.sensor_type)
+	                      AND ST_DWithin(p.geometry_projected, s.geometry_projected, i.radius_meters)
+	WHERE p.poi_id = ANY (poi_ids);
+$$;
+
+CREATE or REPLACE function base.sensor_adjacency_changed()
+returns trigger language plpgsql
+SET search_path = base, public as $$
+BEGIN
+	IF current_setting('spikealerts.skip_adjacency', true) = 'on' THEN -- Sync_projected_geometry rebuilds the whole table itself
+		RETURN NULL;
+	END IF;
+	
+	IF TG_OP = 'INSERT'
+	OR NEW.geometry_projected IS DISTINCT FROM OLD.geometry_projected
+	OR NEW.sensor_type IS DISTINCT FROM OLD.sensor_type THEN
+		PERFORM refresh_sensor_adjacency(ARRAY[NEW.sensor_id]);
+	END IF;
+	
+	RETURN NULL;
+END$$;
+
+CREATE or REPLACE function base.poi_adjacency_changed()
+returns trigger language plpgsql
+SET search_path = base, public as $$
+BEGIN
+	IF current_setting('spikealerts.skip_adjacency', true) = 'on' THEN -- Sync_projected_geometry rebuilds the whole table itself
+		RETURN NULL;
+	END IF;
+	
+	IF TG_OP = 'INSERT'
+	OR NEW.geometry_projected IS DISTINCT FROM OLD.geometry_projected THEN
+		PERFORM refresh_poi_adjacency(ARRAY[NEW.poi_id]);
+	END IF;
+	
+	RETURN NULL;
+END$$;
+
+CREATE or REPLACE function base.sensor_type_adjacency_changed()
+returns trigger language plpgsql
+SET search_path = base, public as $$
+BEGIN
+	IF TG_OP = 'INSERT'
+	OR NEW.radius_meters IS DISTINCT FROM OLD.radius_meters THEN
+		PERFORM refresh_sensor_adjacency(ARRAY(SELECT sensor_id FROM "Sensors" WHERE sensor_type = NEW.sensor_type));
+	END IF;
+	
+	RETURN NULL;
+END$$;
+
+-- geometry is listed because the BEFORE triggers above change geometry_projected when it is updated
+
+CREATE TRIGGER sensors_adjacency
+AFTER INSERT OR UPDATE OF geometry, geometry_projected, sensor_type ON base."Sensors"
+FOR EACH ROW EXECUTE FUNCTION base.sensor_adjacency_changed();
+
+CREATE TRIGGER pois_adjacency
+AFTER INSERT OR UPDATE OF geometry, geometry_projected ON base."Places of Interest"
+FOR EACH ROW EXECUTE FUNCTION base.poi_adjacency_changed();
+
+CREATE TRIGGER sensor_types_adjacency
+AFTER INSERT OR UPDATE OF radius_meters ON base."Sensor Type Information"
+FOR EACH ROW EXECUTE FUNCTION base.sensor_type_adjacency_changed();
+
+-- ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+-- Fill it in for the sensors already in the database
+
+SELECT base.refresh_sensor_adjacency(ARRAY(SELECT sensor_id FROM base."Sensors"));
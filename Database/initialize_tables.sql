@@ -67,7 +67,8 @@ CREATE TABLE "extent" -- This is to define the bounding box of the project
     (minlng Double Precision,
     maxlng Double Precision,
     minlat Double Precision,
-    maxlat Double Precision
+    maxlat Double Precision,
+    epsg_code int -- The local projected coordinate reference system for distances (set by the App from EPSG_CODE in .env)
     );
     
 -- Sensors
@@ -99,6 +100,7 @@ CREATE TABLE "Sensors" -- Storage for all sensors
 	altitude int,
 	current_reading float DEFAULT -1 -- The last value seen of the sensor
 --	geometry geometry -- A Point, added later in this script
+--	geometry_projected geometry -- The above in extent.epsg_code, added later in this script
 );
 
 -- Alerts
@@ -134,8 +136,32 @@ CREATE TABLE "Places of Interest"-- This is our internal record keeping for POIs
 	active_alerts bigint [] DEFAULT array[]::bigint [], -- List of Active Alert ids (for all populations)
 	cached_alerts bigint [] DEFAULT array[]::bigint [], -- List of ended Alerts ids in same event as above
 	active boolean DEFAULT TRUE -- Are we monitoring this point?
+--	geometry geometry -- Any geometry, added later in this script
+--	geometry_projected geometry -- The above in extent.epsg_code, added later in this script
 	);
 
+CREATE INDEX poi_active_alerts ON "Places of Interest" USING GIN(active_alerts); -- Find POIs with any of a list of alert_ids (&&)
+CREATE INDEX poi_active_alerts_sensitive ON "Places of Interest" USING GIN(active_alerts_sensitive);
+
+CREATE TABLE "POI Alerts" -- The alerts on each POI, used instead of the alert arrays above when ALERT_STORAGE=links in .env
+	(poi_id bigint REFERENCES "Places of Interest" (poi_id) ON DELETE CASCADE,
+	alert_id bigint, -- In "Active Alerts", then "Archived Alerts" once it ends
+	sensitive boolean, -- Same as the alert's
+	state text DEFAULT 'active' CHECK (state IN ('active', 'cached')), -- active = like active_alerts, cached = like cached_alerts
+	PRIMARY KEY (poi_id, alert_id)
+	);
+
+CREATE INDEX poi_alerts_alert_id ON "POI Alerts" (alert_id); -- Caching ended alerts
+CREATE INDEX poi_alerts_state ON "POI Alerts" (sensitive, state, poi_id); -- Finding alerted/unalerted POIs
+
+CREATE TABLE "Sensor POI Adjacency" -- Which POIs are within radius_meters of each sensor (kept up to date by triggers, see Spatial Stuff)
+	(sensor_id int REFERENCES "Sensors" (sensor_id) ON DELETE CASCADE,
+	poi_id bigint REFERENCES "Places of Interest" (poi_id) ON DELETE CASCADE,
+	PRIMARY KEY (sensor_id, poi_id)
+	);
+
+CREATE INDEX adjacency_poi_id ON "Sensor POI Adjacency" (poi_id); -- For lookups by POI
+
 -- Reports
 
 CREATE TABLE "Reports Archive"-- These are for keeping track of reports for each POI
@@ -144,8 +170,12 @@ CREATE TABLE "Reports Archive"-- These are for keeping track of reports for each
 	start_time timestamp,
 	duration_minutes integer,
 	sensitive boolean, -- Indicates whether this is a report only for sensitive groups
-	alert_ids bigint [] -- List of alert_ids
+	alert_ids bigint [], -- List of alert_ids
+	poi_id bigint, -- The POI the report is for
+	notified boolean DEFAULT FALSE -- Have the users of the POI been sent the end of alert message? (FALSE = waiting for the notify worker, RUN_MODE=workers in .env)
     );
+
+CREATE INDEX reports_to_notify ON "Reports Archive" (poi_id) WHERE notified = FALSE; -- For the notify worker
     
 -- ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -167,10 +197,141 @@ execute format('SET SEARCH_PATH = "$user", public, topology;
 			   ALTER TABLE %I."Places of Interest"
 			   ADD geometry geometry; -- A Point
 			   CREATE INDEX poi_gid ON %I."Places of Interest" USING GIST(geometry);  -- Create spatial index for POIs
+			   
+			   -- Projected copies (in meters) for distance queries - kept in sync by the triggers below
+			   
+			   ALTER TABLE %I."Sensors"
+			   ADD geometry_projected geometry;
+			   CREATE INDEX sensor_gid_projected ON %I."Sensors" USING GIST(geometry_projected);
+			   
+			   ALTER TABLE %I."Places of Interest"
+			   ADD geometry_projected geometry;
+			   CREATE INDEX poi_gid_projected ON %I."Places of Interest" USING GIST(geometry_projected);
 			   '
-			   , schemaname, schemaname, schemaname, schemaname);
+			   , schemaname, schemaname, schemaname, schemaname,
+			   schemaname, schemaname, schemaname, schemaname);
 END$$;
 
+-- Keep geometry_projected = geometry in the project's projected coordinate reference system (extent.epsg_code)
+-- The App sets extent.epsg_code from EPSG_CODE and fills in existing rows (see Sync_projected_geometry in App/modules/POIs/POI_Functions.py)
+
+CREATE or REPLACE function base.set_geometry_projected()
+returns trigger language plpgsql
+SET search_path = base, public as $$
+DECLARE srid int;
+BEGIN
+	SELECT epsg_code INTO srid FROM "extent" WHERE epsg_code IS NOT NULL LIMIT 1;
+	
+	IF NEW.geometry IS NULL OR srid IS NULL THEN
+		NEW.geometry_projected := NULL;
+	ELSE
+		NEW.geometry_projected := ST_Transform(NEW.geometry, srid);
+	END IF;
+	
+	RETURN NEW;
+END$$;
+
+CREATE TRIGGER sensors_geometry_projected
+BEFORE INSERT OR UPDATE OF geometry ON base."Sensors"
+FOR EACH ROW EXECUTE FUNCTION base.set_geometry_projected();
+
+CREATE TRIGGER pois_geometry_projected
+BEFORE INSERT OR UPDATE OF geometry ON base."Places of Interest"
+FOR EACH ROW EXECUTE FUNCTION base.set_geometry_projected();
+
+-- Keep "Sensor POI Adjacency" up to date
+-- Rows are rebuilt for a sensor/POI when it is added or moved, and for every sensor of a type when its radius_meters changes
+-- Deleted sensors/POIs are removed by ON DELETE CASCADE
+-- Skipped while spikealerts.skip_adjacency = 'on' (set by Sync_projected_geometry in App/modules/POIs/POI_Functions.py while it re-projects everything)
+
+CREATE or REPLACE function base.refresh_sensor_adjacency(sensor_ids int [])
+returns void language sql
+SET search_path = base, public as $$
+	DELETE FROM "Sensor POI Adjacency"
+	WHERE sensor_id = ANY (sensor_ids);
+	
+	INSERT INTO "Sensor POI Adjacency" (sensor_id, poi_id)
+	SELECT s.sensor_id, p.poi_id
+	FROM "Sensors" s
+	INNER JOIN "Sensor Type Information" i ON (i.sensor_type = s.sensor_type)
+	INNER JOIN "Places of Interest" p ON ST_DWithin(p.geometry_projected, s.geometry_projected, i.radius_meters)
+	WHERE s.sensor_id = ANY (sensor_ids);
+$$;
+
+CREATE or REPLACE function base.refresh_poi_adjacency(poi_ids bigint [])
+returns void language sql
+SET search_path = base, public as $$
+	DELETE FROM "Sensor POI Adjacency"
+	WHERE poi_id = ANY (poi_ids);
+	
+	INSERT INTO "Sensor POI Adjacency" (sensor_id, poi_id)
+	SELECT s.sensor_id, p.poi_id
+	FROM "Places of Interest" p
+	CROSS JOIN "Sensor Type Information" i
+	INNER JOIN "Sensors" s ON (s.sensor_type = i.sensor_type)
+	                      AND ST_DWithin(p.geometry_projected, s.geometry_projected, i.radius_meters)
+	WHERE p.poi_id = ANY (poi_ids);
+$$;
+
+CREATE or REPLACE function base.sensor_adjacency_changed()
+returns trigger language plpgsql
+SET search_path = base, public as $$
+BEGIN
+	IF current_setting('spikealerts.skip_adjacency', true) = 'on' THEN -- Sync_projected_geometry rebuilds the whole table itself
+		RETURN NULL;
+	END IF;
+	
+	IF TG_OP = 'INSERT'
+	OR NEW.geometry_projected IS DISTINCT FROM OLD.geometry_projected
+	OR NEW.sensor_type IS DISTINCT FROM OLD.sensor_type THEN
+		PERFORM refresh_sensor_adjacency(ARRAY[NEW.sensor_id]);
+	END IF;
+	
+	RETURN NULL;
+END$$;
+
+CREATE or REPLACE function base.poi_adjacency_changed()
+returns trigger language plpgsql
+SET search_path = base, public as $$
+BEGIN
+	IF current_setting('spikealerts.skip_adjacency', true) = 'on' THEN -- Sync_projected_geometry rebuilds the whole table itself
+		RETURN NULL;
+	END IF;
+	
+	IF TG_OP = 'INSERT'
+	OR NEW.geometry_projected IS DISTINCT FROM OLD.geometry_projected THEN
+		PERFORM refresh_poi_adjacency(ARRAY[NEW.poi_id]);
+	END IF;
+	
+	RETURN NULL;
+END$$;
+
+CREATE or REPLACE function base.sensor_type_adjacency_changed()
+returns trigger language plpgsql
+SET search_path = base, public as $$
+BEGIN
+	IF TG_OP = 'INSERT'
+	OR NEW.radius_meters IS DISTINCT FROM OLD.radius_meters THEN
+		PERFORM refresh_sensor_adjacency(ARRAY(SELECT sensor_id FROM "Sensors" WHERE sensor_type = NEW.sensor_type));
+	END IF;
+	
+	RETURN NULL;
+END$$;
+
+-- geometry is listed because the BEFORE triggers above change geometry_projected when it is updated
+
+CREATE TRIGGER sensors_adjacency
+AFTER INSERT OR UPDATE OF geometry, geometry_projected, sensor_type ON base."Sensors"
+FOR EACH ROW EXECUTE FUNCTION base.sensor_adjacency_changed();
+
+CREATE TRIGGER pois_adjacency
+AFTER INSERT OR UPDATE OF geometry, geometry_projected ON base."Places of Interest"
+FOR EACH ROW EXECUTE FUNCTION base.poi_adjacency_changed();
+
+CREATE TRIGGER sensor_types_adjacency
+AFTER INSERT OR UPDATE OF radius_meters ON base."Sensor Type Information"
+FOR EACH ROW EXECUTE FUNCTION base.sensor_type_adjacency_changed();
+
 -- ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     
 -- Create Views
@@ -194,7 +355,7 @@ CREATE VIEW base.alerted_sensors AS
 SELECT s.sensor_id, s.name, s.sensor_type,
        a.alert_id, a.sensitive, a.start_time, s.last_seen,
        s.current_reading, a.avg_reading, a.max_reading,
-	   s.geometry 
+	   s.geometry, s.geometry_projected
 FROM base."Active Alerts" a
 INNER JOIN base."Sensors" s ON (a.sensor_id = s.sensor_id)
 );
@@ -208,7 +369,7 @@ SELECT s.sensor_id, s.name, s.alert_id, s.sensitive, s.start_time, s.last_seen,
 	   i.pollutant, i.metric, i.thresholds, i.radius_meters,
        s.current_reading, s.avg_reading, s.max_reading,
        map_to_health(s.current_reading, i.thresholds) as health_descriptor,
-	   s.geometry
+	   s.geometry, s.geometry_projected
 FROM base.alerted_sensors s
 INNER JOIN base.sensor_ids_w_info i ON (s.sensor_id = i.sensor_id)
 );
@@ -0,0 +1,13 @@
+# Shared setup for the unit tests
+
+# Run from the repository with "python -m pytest tests"
+# These only test pure functions - nothing connects to the database or PurpleAir
+
+import os
+import sys
+
+# Add App to system path (the App imports its modules as modules.*)
+
+extra_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'App')
+if extra_path not in sys.path:
+    sys.path.append(extra_path)
@@ -0,0 +1,129 @@
+# Tests for App/modules/Users/Dispatch.py
+
+import sys
+import types
+
+import pytest
+
+from modules.Users import Dispatch as dispatch
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class Fake_clock:
+    '''
+    Stands in for the time module - sleep() moves the clock forward instead of waiting
+    '''
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+
+    clock = Fake_clock()
+    monkeypatch.setattr(dispatch, 'time', clock)
+
+    return clock
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_burst_then_rate(clock):
+    '''
+    A full bucket lets burst messages out at once, then one every 1/messages_per_second
+    '''
+
+    bucket = dispatch.Make_bucket(messages_per_second = 2, burst = 3)
+
+    times = []
+
+    for i in range(7):
+        dispatch.Take_token(bucket)
+        times.append(clock.now)
+
+    assert times == pytest.approx([0, 0, 0, 0.5, 1.0, 1.5, 2.0])
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_tokens_refill_while_idle_up_to_burst(clock):
+
+    bucket = dispatch.Make_bucket(messages_per_second = 1, burst = 2)
+
+    dispatch.Take_token(bucket)
+    dispatch.Take_token(bucket)
+
+    clock.now += 60 # Idle for a minute - still only burst tokens
+
+    start = clock.now
+
+    for i in range(3):
+        dispatch.Take_token(bucket)
+
+    assert clock.now - start == pytest.approx(1.0)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_burst_is_at_least_one(clock):
+
+    bucket = dispatch.Make_bucket(messages_per_second = 4, burst = 0)
+
+    dispatch.Take_token(bucket)
+    assert clock.now == 0
+
+    dispatch.Take_token(bucket)
+    assert clock.now == pytest.approx(0.25)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_retries_back_off_and_reuse_the_key(clock, monkeypatch):
+
+    monkeypatch.setattr(dispatch, 'retries', 2)
+    monkeypatch.setattr(dispatch, 'retry_seconds', 1)
+
+    keys = []
+
+    def send_message(contact_info, message, key):
+        keys.append(key)
+        if len(keys) < 3:
+            raise ConnectionError('provider down')
+        return True
+
+    module = types.SimpleNamespace(send_message = send_message, idempotency_keys = True)
+    bucket = dispatch.Make_bucket(messages_per_second = 1000, burst = 10)
+
+    outcome = dispatch.Send_one(module, bucket, '000-000-0000', 'hi', key = 'outbox-1')
+
+    assert outcome == ('sent', 3, None)
+    assert keys == ['outbox-1'] * 3
+    assert clock.sleeps == [1, 2]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_every_message_gets_an_outcome(monkeypatch):
+
+    sent = types.ModuleType('sent')
+    sent.messages_per_second, sent.burst = 1000, 100
+    sent.send_message = lambda contact_info, message: contact_info != 'unsubscribed'
+
+    old = types.ModuleType('old') # Only send_messages (one batch)
+    old.send_messages = lambda contacts, messages: [1]
+
+    monkeypatch.setitem(sys.modules, 'modules.Users.Contact_Methods.sent', sent)
+    monkeypatch.setitem(sys.modules, 'modules.Users.Contact_Methods.old', old)
+
+    reported = {}
+
+    outcome_df = dispatch.Send_messages(['sent', 'old', 'sent', 'old'],
+                                        ['a', 'b', 'unsubscribed', 'c'],
+                                        ['m1', 'm2', 'm3', 'm4'],
+                                        on_outcome = lambda i, outcome, attempts, error: reported.update({i : outcome}))
+
+    assert outcome_df.outcome.tolist() == ['sent', 'sent', 'unsubscribed', 'unsubscribed']
+    assert reported == {0 : 'sent', 1 : 'sent', 2 : 'unsubscribed', 3 : 'unsubscribed'}
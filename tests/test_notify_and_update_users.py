@@ -0,0 +1,62 @@
+# Tests for App/modules/Notify_and_Update_Users.py
+
+import numpy as np
+import pandas as pd
+
+from modules import Notify_and_Update_Users as notify
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_one_compose_per_distinct_message():
+
+    user_df = pd.DataFrame({'duration_minutes' : [30, 60, 30, 30, 60],
+                            'severity' : ['moderate', 'moderate', 'moderate', 'unhealthy', 'moderate']},
+                           index = [10, 11, 12, 13, 14])
+
+    calls = []
+
+    def compose(duration_minutes, severity):
+        calls.append((duration_minutes, severity))
+        return f'{duration_minutes} minutes, {severity}'
+
+    messages = notify.Compose_unique_messages(user_df, ['duration_minutes', 'severity'], compose)
+
+    assert messages.tolist() == ['30 minutes, moderate', '60 minutes, moderate', '30 minutes, moderate',
+                                 '30 minutes, unhealthy', '60 minutes, moderate']
+    assert sorted(calls) == sorted(set(calls)) # Once each
+    assert len(calls) == 3
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_same_as_composing_every_row():
+    '''
+    Including missing values (grouped together, like any other value)
+    '''
+
+    rng = np.random.default_rng(0)
+
+    user_df = pd.DataFrame({'poi_name' : rng.choice(['Park', 'School', None], 200),
+                            'severity' : rng.choice(['good', 'moderate'], 200)})
+
+    compose = lambda poi_name, severity: f'{poi_name} is {severity}'
+
+    messages = notify.Compose_unique_messages(user_df, ['poi_name', 'severity'], compose)
+
+    assert messages.tolist() == [compose(*row) for row in user_df.itertuples(index = False, name = None)]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_parse_new_alert_user_df_keeps_the_index(monkeypatch):
+
+    monkeypatch.setattr(notify.Compose_Messages, 'new_alert_message', lambda poi_name, link: f'Alert near {poi_name}')
+
+    new_alert_user_df = pd.DataFrame({'poi_name' : ['Park', 'School', 'Park'],
+                                      'contact_method' : 'Template',
+                                      'api_id' : ['a', 'b', 'c']},
+                                     index = [7, 3, 5])
+
+    messaging_df = notify.Parse_new_alert_user_df(new_alert_user_df, 26915, 'https://example.com')
+
+    assert messaging_df.index.tolist() == [7, 3, 5]
+    assert messaging_df.message.tolist() == ['Alert near Park', 'Alert near School', 'Alert near Park']
+    assert messaging_df.api_id.tolist() == ['a', 'b', 'c']
@@ -0,0 +1,119 @@
+# Tests for App/modules/POIs/POI_Index.py (POI_ENGINE=memory), checked against brute force distances
+
+import numpy as np
+import pytest
+import shapely
+
+import modules.POIs.POI_Index as poi_index
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def Brute_force(poi_ids, geometries, xs, ys, radii):
+    '''
+    Every (position, poi_id) with the geometry within the location's radius - one distance per pair
+    '''
+
+    pairs = set()
+
+    for position, (x, y, radius) in enumerate(zip(xs, ys, radii)):
+
+        distances = shapely.distance(geometries, shapely.Point(x, y))
+
+        pairs.update((position, int(poi_id)) for poi_id in np.asarray(poi_ids)[distances <= radius])
+
+    return pairs
+
+def Pairs(positions, poi_ids):
+
+    pairs = list(zip(positions.tolist(), poi_ids.tolist()))
+
+    assert len(pairs) == len(set(pairs)) # No duplicates
+
+    return set(pairs)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+@pytest.fixture
+def random_pois(monkeypatch):
+    '''
+    Points & polygons around the origin (so some grid cells are negative), set as the current index
+    '''
+
+    rng = np.random.default_rng(0)
+
+    n_points, n_shapes = 2000, 100
+    xs, ys = rng.uniform(-20000, 20000, (2, n_points))
+    corners = rng.uniform(-20000, 20000, (n_shapes, 2))
+    sizes = rng.uniform(10, 3000, (n_shapes, 2))
+
+    point_ids = np.arange(n_points)
+    shape_ids = np.arange(n_points, n_points + n_shapes)
+    shapes = shapely.box(corners[:, 0], corners[:, 1], corners[:, 0] + sizes[:, 0], corners[:, 1] + sizes[:, 1])
+
+    monkeypatch.setattr(poi_index, 'current_index', poi_index.Make_index(point_ids, xs, ys, 1000, shape_ids, shapes))
+
+    poi_ids = np.concatenate([point_ids, shape_ids])
+    geometries = np.concatenate([shapely.points(xs, ys), shapes])
+
+    return poi_ids, geometries
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_matches_brute_force(random_pois):
+
+    rng = np.random.default_rng(1)
+
+    xs, ys = rng.uniform(-21000, 21000, (2, 500))
+    radii = rng.choice([250, 500, 1000], 500)
+
+    positions, poi_ids = poi_index.Get_pois_near(xs, ys, radii)
+
+    assert Pairs(positions, poi_ids) == Brute_force(*random_pois, xs, ys, radii)
+    assert len(positions) > 0
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_radius_is_inclusive(monkeypatch):
+    '''
+    Like ST_DWithin, a POI exactly radius away is near (also across a cell boundary)
+    '''
+
+    monkeypatch.setattr(poi_index, 'current_index',
+                        poi_index.Make_index([1, 2], [999.0, 1500.0], [0.0, 0.0], 1000,
+                                             [3], [shapely.box(0, 600, 10, 700)]))
+
+    positions, poi_ids = poi_index.Get_pois_near([1499.0, 0.0], [0.0, 0.0], [500, 600])
+
+    assert Pairs(positions, poi_ids) == {(0, 1), (0, 2), (1, 3)}
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_nothing_to_find(monkeypatch):
+
+    monkeypatch.setattr(poi_index, 'current_index', poi_index.Make_index([], [], [], 1000))
+
+    positions, poi_ids = poi_index.Get_pois_near([0.0], [0.0], [1000])
+    assert len(positions) == len(poi_ids) == 0
+
+    positions, poi_ids = poi_index.Get_pois_near([], [], [])
+    assert len(positions) == len(poi_ids) == 0
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_builds_from_the_database_when_needed(monkeypatch):
+    '''
+    Get_pois_near builds the index first (points from x/y, other geometries from well known binary)
+    '''
+
+    responses = [[(1, 0.0, 0.0, None),
+                  (2, 5000.0, 0.0, None),
+                  (3, None, None, memoryview(shapely.to_wkb(shapely.box(100, 100, 200, 200))))],
+                 [(500,)]]
+
+    monkeypatch.setattr(poi_index.psql, 'get_response', lambda cmd: responses.pop(0))
+    monkeypatch.setattr(poi_index, 'current_index', None)
+
+    positions, poi_ids = poi_index.Get_pois_near([50.0, 5000.0], [50.0, 400.0], [200, 500])
+
+    assert Pairs(positions, poi_ids) == {(0, 1), (0, 3), (1, 2)}
+    assert poi_index.current_index['cell_size'] == 500
@@ -0,0 +1,127 @@
+# Tests for App/modules/Sensors/APIs/PurpleAir/API_functions.py
+
+import pandas as pd
+
+import modules.Sensors.APIs.PurpleAir.API_functions as purp
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# Batching show_only queries
+
+def test_chunks_keep_every_sensor_in_order(monkeypatch):
+
+    monkeypatch.setitem(purp.chunk_size, 'size', 3)
+    monkeypatch.setattr(purp, 'max_url_length', 10**6)
+
+    sensor_strings = [str(i) for i in range(10)]
+
+    chunks = purp.Chunk_sensor_indices(sensor_strings)
+
+    assert chunks == [['0', '1', '2'], ['3', '4', '5'], ['6', '7', '8'], ['9']]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_chunks_stay_under_max_url_length(monkeypatch):
+
+    monkeypatch.setitem(purp.chunk_size, 'size', 1000)
+    monkeypatch.setattr(purp, 'max_url_length', 100)
+
+    sensor_strings = [str(100000 + i) for i in range(50)]
+    fixed_length = 20
+
+    chunks = purp.Chunk_sensor_indices(sensor_strings, fixed_length = fixed_length)
+
+    assert sum(chunks, []) == sensor_strings
+
+    for chunk in chunks:
+        query_length = fixed_length + len('&show_only=') + sum(len(s) + len('%2C') for s in chunk)
+        assert query_length <= 100
+
+    assert len(chunks) > 1
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_chunks_of_nothing():
+
+    assert purp.Chunk_sensor_indices([]) == []
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_tune_chunk_size(monkeypatch):
+    '''
+    Slow batches halve the size, fast ones grow it by half, both within min & max
+    '''
+
+    monkeypatch.setattr(purp, 'target_chunk_seconds', 4)
+    monkeypatch.setitem(purp.chunk_size, 'size', 100)
+    monkeypatch.setitem(purp.chunk_size, 'min', 25)
+    monkeypatch.setitem(purp.chunk_size, 'max', 200)
+
+    purp.Tune_chunk_size([1, 5]) # Slowest is over the target
+    assert purp.chunk_size['size'] == 50
+
+    purp.Tune_chunk_size([3]) # Between half the target and the target
+    assert purp.chunk_size['size'] == 50
+
+    purp.Tune_chunk_size([1, 1.5]) # Under half the target
+    assert purp.chunk_size['size'] == 75
+
+    purp.Tune_chunk_size([]) # Nothing to go on
+    assert purp.chunk_size['size'] == 75
+
+    for i in range(10):
+        purp.Tune_chunk_size([0.1])
+    assert purp.chunk_size['size'] == 200
+
+    for i in range(10):
+        purp.Tune_chunk_size([10])
+    assert purp.chunk_size['size'] == 25
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# Reading responses
+
+def test_parse_dtypes():
+
+    response_dict = {'fields' : ['sensor_index', 'last_seen', 'name', 'channel_flags', 'latitude', 'pm2.5_10minute'],
+                     'data' : [[131075, 1700000000, 'Sensor A', 0, 44.97, 12.5],
+                               [131079, 1700000060, 'Sensor B', 3, 44.98, None]]}
+
+    df = purp.Parse_PurpleAir_response(response_dict, 'America/Chicago')
+
+    assert list(df.columns) == ['api_id', 'last_seen', 'name', 'channel_flags', 'latitude', 'pm2.5_10minute']
+
+    assert df.api_id.dtype == 'int64'
+    assert df.channel_flags.dtype == 'int64'
+    assert str(df.last_seen.dt.tz) == 'America/Chicago'
+    assert pd.api.types.is_string_dtype(df.name)
+    assert df.latitude.dtype == 'float64'
+    assert df['pm2.5_10minute'].dtype == 'float64'
+
+    assert df.api_id.tolist() == [131075, 131079]
+    assert df.last_seen[0] == pd.Timestamp(1700000000, unit = 's', tz = 'UTC')
+    assert df['pm2.5_10minute'].isna().tolist() == [False, True]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_parse_missing_integers_become_floats():
+    '''
+    An integer field PurpleAir left out for a sensor can't be int64 (NaN)
+    '''
+
+    response_dict = {'fields' : ['sensor_index', 'altitude'],
+                     'data' : [[1, 900], [2, None]]}
+
+    df = purp.Parse_PurpleAir_response(response_dict)
+
+    assert df.altitude.dtype == 'float64'
+    assert df.altitude.isna().tolist() == [False, True]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_parse_empty_response():
+
+    df = purp.Parse_PurpleAir_response({'fields' : ['sensor_index', 'last_seen'], 'data' : []})
+
+    assert len(df) == 0
+    assert list(df.columns) == ['api_id', 'last_seen']
@@ -0,0 +1,151 @@
+# Tests for incremental polling in App/modules/Sensors/APIs/PurpleAir/Standard/Regular_Update.py
+
+import pandas as pd
+import pytest
+
+import modules.Sensors.APIs.PurpleAir.API_functions as purp
+import modules.Sensors.APIs.PurpleAir.Standard.Regular_Update as regular_update
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+fields = ['sensor_index', 'channel_flags', 'last_seen', 'pm2.5_10minute']
+
+class Fake_PurpleAir:
+    '''
+    Stands in for API_functions.Get_with_sensor_index - answers from readings ({api_id : pm2.5})
+    and records each call's sensor indices & modified_since
+    '''
+
+    def __init__(self):
+        self.readings = {}
+        self.modified = set() # api_ids returned when modified_since is given
+        self.data_time_stamp = 100
+        self.succeeded = True
+        self.calls = []
+
+    def __call__(self, sensor_indices, fields, timezone, modified_since = None):
+
+        sensor_indices = [int(i) for i in sensor_indices]
+        self.calls += [(sensor_indices, modified_since)]
+
+        if modified_since is not None:
+            sensor_indices = [i for i in sensor_indices if i in self.modified]
+
+        df = pd.DataFrame({'api_id' : sensor_indices,
+                           'channel_flags' : 0,
+                           'last_seen' : pd.Timestamp('2023-12-01', tz = timezone),
+                           'pm2.5_10minute' : [self.readings[i] for i in sensor_indices]})
+
+        df.attrs = {'succeeded' : self.succeeded, 'data_time_stamp' : self.data_time_stamp}
+
+        return df, None
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+@pytest.fixture
+def fake(monkeypatch):
+    '''
+    A Fake_PurpleAir in place of Get_with_sensor_index, with incremental polling on and empty polling state
+    '''
+
+    fake = Fake_PurpleAir()
+
+    monkeypatch.setattr(purp, 'Get_with_sensor_index', fake)
+    monkeypatch.setattr(purp, 'incremental', True)
+    monkeypatch.setattr(purp, 'full_refresh_minutes', 60)
+    monkeypatch.setattr(regular_update, 'last_readings', {})
+    monkeypatch.setattr(regular_update, 'high_water_marks', {})
+
+    return fake
+
+def Readings(df):
+    '''
+    {api_id : pm2.5} from a purpleAir_df
+    '''
+
+    return dict(zip(df.api_id.astype(int), df['pm2.5_10minute']))
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_first_poll_is_full(fake):
+
+    fake.readings = {1 : 5.0, 2 : 6.0}
+
+    df = regular_update.Get_readings('pm25', [1, 2], fields, 'America/Chicago')
+
+    assert Readings(df) == {1 : 5.0, 2 : 6.0}
+    assert fake.calls == [([1, 2], None)]
+    assert regular_update.high_water_marks['pm25'] == 100
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_delta_is_merged_over_last_readings(fake):
+
+    fake.readings = {1 : 5.0, 2 : 6.0}
+    regular_update.Get_readings('pm25', [1, 2], fields, 'America/Chicago')
+
+    # Only sensor 2 changed
+
+    fake.readings = {1 : 50.0, 2 : 7.0}
+    fake.modified = {2}
+    fake.data_time_stamp = 160
+
+    df = regular_update.Get_readings('pm25', [1, 2], fields, 'America/Chicago')
+
+    assert fake.calls[-1] == ([1, 2], 100) # Asked for changes since the high water mark
+    assert Readings(df) == {1 : 5.0, 2 : 7.0} # Sensor 1 carried forward
+    assert regular_update.high_water_marks['pm25'] == 160
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_new_sensors_are_fetched_in_full_and_dropped_ones_removed(fake):
+
+    fake.readings = {1 : 5.0, 2 : 6.0}
+    regular_update.Get_readings('pm25', [1, 2], fields, 'America/Chicago')
+
+    fake.readings = {1 : 5.0, 2 : 6.0, 3 : 8.0}
+    fake.modified = set()
+    fake.data_time_stamp = 160
+
+    df = regular_update.Get_readings('pm25', [1, 3], fields, 'America/Chicago')
+
+    assert fake.calls[1:] == [([1], 100), ([3], None)]
+    assert Readings(df) == {1 : 5.0, 3 : 8.0}
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_failed_poll_keeps_the_high_water_mark(fake):
+
+    fake.readings = {1 : 5.0}
+    regular_update.Get_readings('pm25', [1], fields, 'America/Chicago')
+
+    fake.succeeded = False
+    fake.data_time_stamp = 160
+
+    df = regular_update.Get_readings('pm25', [1], fields, 'America/Chicago')
+
+    assert len(df) == 0
+    assert regular_update.high_water_marks['pm25'] == 100
+    assert Readings(regular_update.last_readings['pm25']['df']) == {1 : 5.0}
+
+    # The next poll asks for everything since the last success
+
+    fake.succeeded = True
+    regular_update.Get_readings('pm25', [1], fields, 'America/Chicago')
+
+    assert fake.calls[-1] == ([1], 100)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_changed_fields_or_incremental_off_poll_in_full(fake, monkeypatch):
+
+    fake.readings = {1 : 5.0}
+    regular_update.Get_readings('pm25', [1], fields, 'America/Chicago')
+
+    regular_update.Get_readings('pm25', [1], fields + ['altitude'], 'America/Chicago')
+    assert fake.calls[-1] == ([1], None)
+
+    monkeypatch.setattr(purp, 'incremental', False)
+
+    regular_update.Get_readings('pm25', [1], fields + ['altitude'], 'America/Chicago')
+    assert fake.calls[-1] == ([1], None)
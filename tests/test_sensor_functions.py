@@ -0,0 +1,61 @@
+# Tests for App/modules/Sensors/Sensor_Functions.py
+
+import numpy as np
+
+import modules.Sensors.Sensor_Functions as sensors
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# Like the PM2.5 sensor type in Database/readme.md
+
+thresholds_dict = {'pm25' : [0, 12.1, 35.5, 55.5, 150.5, 250.5, 500],
+                   'other' : [0, 1, 2, 3, 4, 5, 6]}
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_bin_edges_are_left_inclusive():
+    '''
+    A reading equal to a threshold is in the higher category
+    '''
+
+    values = [-0.1, 0, 12.0, 12.1, 35.4, 35.5, 55.5, 150.5, 250.4, 250.5, 499.9, 500, 10000]
+    expected = [0, 1, 1, 2, 2, 3, 4, 5, 5, 6, 6, 7, 7]
+
+    codes = sensors.Classify_Health_Codes(values, ['pm25'] * len(values), thresholds_dict)
+
+    assert codes.tolist() == expected
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_missing_readings_and_unknown_types():
+    '''
+    NaN/None readings and sensor types without thresholds are -1
+    '''
+
+    values = [np.nan, None, 40, 40]
+    sensor_types = ['pm25', 'pm25', 'unknown', 'pm25']
+
+    codes = sensors.Classify_Health_Codes(values, sensor_types, thresholds_dict)
+
+    assert codes.tolist() == [-1, -1, -1, 3]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_each_type_uses_its_own_thresholds():
+
+    codes = sensors.Classify_Health_Codes([3.5, 3.5], ['other', 'pm25'], thresholds_dict)
+
+    assert codes.tolist() == [4, 1]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_descriptors():
+    '''
+    Codes map onto health_descriptors, -1 onto NaN
+    '''
+
+    descriptors = sensors.Health_Codes_to_Descriptors(np.array([1, 3, -1], dtype = np.int8))
+
+    assert descriptors[0] == 'good'
+    assert descriptors[1] == 'unhealthy for sensitive groups'
+    assert descriptors.isna().tolist() == [False, False, True]